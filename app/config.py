@@ -12,6 +12,46 @@ BASE_DIR = os.getenv("DDT_BASE_DIR", "/var/www/DDT")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = os.getenv("MODEL", "gpt-4o-mini")
 
+# Formato immagine inviata a OpenAI Vision: "jpeg" (default, encoding più rapido e payload
+# più piccolo) oppure "png" (lossless)
+VISION_IMAGE_FORMAT = os.getenv("DDT_VISION_IMAGE_FORMAT", "jpeg").lower()
+VISION_JPEG_QUALITY = int(os.getenv("DDT_VISION_JPEG_QUALITY", "85"))
+# Livello zlib dei PNG inviati a Vision (0-9): immagini transitorie decodificate una volta,
+# la compressione rapida dimezza circa l'encoding a fronte di un payload poco più grande
+VISION_PNG_COMPRESS_LEVEL = int(os.getenv("DDT_VISION_PNG_COMPRESS_LEVEL", "1"))
+
+# Risoluzione del rendering per OpenAI Vision: il modello ridimensiona comunque
+# l'immagine, 150 DPI su A4 (~1240x1754 px) bastano per testi e numeri.
+# Il lato lungo non supera comunque VISION_MAX_LONG_EDGE pixel: 1568 (A4 ~1109x1568)
+# resta entro il ridimensionamento lato server dei modelli Vision, quindi pixel
+# in più aumenterebbero solo encoding e upload, non il dettaglio visto dal modello
+VISION_RENDER_DPI = int(os.getenv("DDT_RENDER_DPI", "150"))
+VISION_MAX_LONG_EDGE = int(os.getenv("DDT_VISION_MAX_LONG_EDGE", "1568"))
+
+# Risoluzione dell'anteprima PNG per il browser: rendering separato da quello
+# Vision, senza il limite VISION_MAX_LONG_EDGE
+PREVIEW_RENDER_DPI = int(os.getenv("DDT_PREVIEW_RENDER_DPI", "200"))
+
+# Numero massimo di chiamate OpenAI Vision concorrenti (percorso async)
+MAX_CONCURRENT_VISION = int(os.getenv("DDT_MAX_CONCURRENT_VISION", str(min(32, (os.cpu_count() or 1) * 4))))
+
+# Limite richieste OpenAI Vision al minuto per l'elaborazione batch (0 = nessun limite)
+VISION_REQUESTS_PER_MINUTE = int(os.getenv("DDT_VISION_REQUESTS_PER_MINUTE", "500"))
+
+# Nuovi tentativi Vision quando la risposta non supera la validazione: l'errore
+# viene rimandato al modello come feedback (0 = nessun retry)
+VISION_VALIDATION_RETRIES = int(os.getenv("DDT_VISION_VALIDATION_RETRIES", "2"))
+
+# Estrazione dal solo testo dei PDF nativi quando tutti i campi hanno un'etichetta
+# esplicita e un valore univoco: salta rendering e chiamata Vision (default disattivata)
+TEXT_ONLY_EXTRACTION = os.getenv("DDT_TEXT_ONLY_EXTRACTION", "false").lower() in ("1", "true", "yes")
+
+# Durata (giorni) della cache su disco delle risposte Vision (0 = cache disabilitata)
+VISION_CACHE_TTL_DAYS = int(os.getenv("DDT_VISION_CACHE_TTL_DAYS", "30"))
+
+# Durata (giorni) della cache su disco del testo estratto dai PDF (0 = cache disabilitata)
+EXTRACT_CACHE_TTL_DAYS = int(os.getenv("DDT_EXTRACT_CACHE_TTL_DAYS", "30"))
+
 # Path assoluti per filesystem produzione
 # NOTA: Questi vengono inizializzati lazy quando necessario per evitare importazioni circolari
 # Usa le funzioni da app.paths invece di queste costanti quando possibile
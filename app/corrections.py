@@ -22,6 +22,9 @@ AUTO_RULE_THRESHOLD = 5
 
 # Cache delle correzioni
 _corrections_cache: Optional[Dict[str, Any]] = None
+# Numero di correzioni con annotazioni grafiche (calcolato al primo uso,
+# invalidato a ogni salvataggio/ricaricamento delle correzioni)
+_annotations_count: Optional[int] = None
 
 
 def _ensure_corrections_dir():
@@ -115,8 +118,9 @@ def _save_corrections(corrections: Dict[str, Any]) -> None:
     Args:
         corrections: Dizionario con tutte le correzioni
     """
-    global _corrections_cache
+    global _corrections_cache, _annotations_count
     _corrections_cache = corrections
+    _annotations_count = None
     
     _ensure_corrections_dir()
     
@@ -463,11 +467,30 @@ def get_auto_rules_created() -> List[str]:
 
 def reload_corrections_cache():
     """Ricarica la cache delle correzioni"""
-    global _corrections_cache
+    global _corrections_cache, _annotations_count
     _corrections_cache = None
+    _annotations_count = None
     _load_corrections()
 
 
+def has_any_annotations() -> bool:
+    """
+    Verifica se almeno una correzione salvata contiene annotazioni grafiche
+    
+    Il conteggio viene calcolato una sola volta e riusato fino al prossimo
+    salvataggio: senza annotazioni (caso tipico) l'estrazione salta la
+    ricerca del mittente e get_annotations_for_mittente.
+    
+    Returns:
+        True se esistono annotazioni, False altrimenti
+    """
+    global _annotations_count
+    if _annotations_count is None:
+        corrections = _load_corrections().get("corrections", {})
+        _annotations_count = sum(1 for correction in corrections.values() if correction.get("annotations"))
+    return _annotations_count > 0
+
+
 def get_annotations_for_mittente(mittente: str, similarity_threshold: float = 0.7) -> Optional[Dict[str, Any]]:
     """
     Ottiene le annotazioni grafiche salvate per un mittente simile
@@ -3,14 +3,88 @@ Estrazione dati da DDT PDF usando OpenAI Vision
 Con gestione robusta degli errori e validazione dati
 Supporto per regole dinamiche e estrazione testo
 """
-import base64
+import asyncio
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
+import random
+import re
 import sys
 import os
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date
+from io import BytesIO
 from pathlib import Path
-from typing import Dict, Any, Optional
-from openai import OpenAI, OpenAIError
-from openai.types.chat import ChatCompletion
+from types import MappingProxyType
+from typing import Awaitable, Callable, Dict, Any, Generator, Optional, Union
+import httpx
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    InternalServerError,
+    OpenAI,
+    OpenAIError,
+    RateLimitError,
+)
+from PIL import Image
+
+# pybase64 (SIMD) è opzionale: fallback trasparente alla libreria standard
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# Backend di rendering PDF opzionali, risolti una sola volta all'import:
+# PyMuPDF (consigliato, non richiede Poppler) e pdf2image come fallback
+try:
+    import fitz  # PyMuPDF
+    _HAS_FITZ = True
+except ImportError:
+    fitz = None
+    _HAS_FITZ = False
+
+try:
+    from pdf2image import convert_from_bytes
+    _HAS_PDF2IMAGE = True
+except ImportError:
+    convert_from_bytes = None
+    _HAS_PDF2IMAGE = False
+
+# fastjsonschema è opzionale: validatore compilato (codice generato all'import)
+# per il fast path della validazione dei dati DDT già in forma canonica
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# h2 è opzionale: se installato, il client HTTP verso OpenAI negozia HTTP/2
+# (più richieste Vision multiplexate sulla stessa connessione TLS)
+try:
+    import h2  # noqa: F401
+    _HAS_H2 = True
+except ImportError:
+    _HAS_H2 = False
+
+# orjson è opzionale: parsing JSON più veloce delle risposte Vision.
+# orjson.JSONDecodeError è sottoclasse di json.JSONDecodeError, quindi
+# la gestione errori resta invariata.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # Gestione path quando eseguito come script diretto
 if __name__ == "__main__":
@@ -19,20 +93,362 @@ if __name__ == "__main__":
     if root_dir not in sys.path:
         sys.path.insert(0, root_dir)
 
-from app.config import OPENAI_API_KEY, MODEL
+from app.config import (
+    OPENAI_API_KEY, MODEL, VISION_IMAGE_FORMAT, VISION_JPEG_QUALITY, MAX_CONCURRENT_VISION,
+    VISION_REQUESTS_PER_MINUTE, VISION_VALIDATION_RETRIES, VISION_PNG_COMPRESS_LEVEL, VISION_RENDER_DPI, VISION_MAX_LONG_EDGE, PREVIEW_RENDER_DPI, TEXT_ONLY_EXTRACTION,
+)
 from app.models import DDTData
 from app.utils import normalize_date, normalize_float, normalize_text, clean_company_name
-from app.rules.rules import detect_rule, build_prompt_additions, reload_rules
-from app.corrections import apply_learning_suggestions, get_annotations_for_mittente
+from app.rules.rules import detect_rule, build_prompt_additions, reload_rules, rule_keeps_color
+from app.corrections import apply_learning_suggestions, get_annotations_for_mittente, has_any_annotations
+from app.vision_cache import make_cache_key, get_cached_response, set_cached_response
+from app.extract_cache import get_cached_text_result, set_cached_text_result
 from app.text_extraction.orchestrator import extract_text_pipeline, extract_text_for_rule_detection
 from app.text_extraction.decision import TextExtractionResult
-from app.layout_rules.manager import match_layout_rule
+from app.layout_rules.manager import (
+    load_layout_rules, match_layout_rule, normalize_sender, detect_layout_model_advanced, detect_layout_model_without_text,
+)
+from app.text_extraction.ocr_fallback import is_ocr_available
+from app.paths import get_base_dir, get_preview_dir, safe_open, ensure_dir
 from app.layout_rules.extractor import extract_with_layout_rule, normalize_extracted_box_data
 from pydantic import ValidationError
 
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Pool di connessioni condiviso (keep-alive) per tutte le chiamate OpenAI del processo
+_OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+# max_retries=0: i retry sono gestiti da _call_with_vision_retry (unica policy di backoff).
+# DefaultHttpxClient mantiene i timeout di default dell'SDK; quelli dello stream
+# Vision sono passati per singola richiesta.
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,
+    http_client=DefaultHttpxClient(http2=_HAS_H2, limits=_OPENAI_HTTP_LIMITS),
+)
+
+# Retry per errori transitori (429, timeout, connessione, 5xx) con backoff esponenziale
+VISION_MAX_ATTEMPTS = 4
+VISION_MAX_BACKOFF = 60.0
+_RETRYABLE_OPENAI_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+# Streaming: il timeout di lettura vale tra un chunk e l'altro, quindi interrompe
+# uno stream bloccato senza imporre una durata massima alla risposta intera.
+# Gli errori di trasporto a metà stream (non incapsulati dall'SDK) sono transitori.
+VISION_STREAM_IDLE_TIMEOUT = 30.0
+_VISION_STREAM_TIMEOUT = httpx.Timeout(VISION_STREAM_IDLE_TIMEOUT, connect=10.0)
+_RETRYABLE_VISION_ERRORS = _RETRYABLE_OPENAI_ERRORS + (httpx.TransportError, asyncio.TimeoutError)
+# Errori che i chiamanti convertono in ValueError con messaggio chiaro
+_VISION_CALL_ERRORS = (OpenAIError, httpx.TransportError, asyncio.TimeoutError)
+
+# Tabelle costanti dei campi DDT usate nei prompt
+FIELD_DESCRIPTIONS = MappingProxyType({
+    'data': 'Data del documento DDT (formato YYYY-MM-DD)',
+    'mittente': 'Azienda che emette il DDT (chi spedisce)',
+    'destinatario': 'Azienda che riceve la merce',
+    'numero_documento': 'Numero del DDT',
+    'totale_kg': 'Peso totale in chilogrammi (solo numero, float)'
+})
+
+FIELD_LABELS = MappingProxyType({
+    'data': 'Data DDT',
+    'mittente': 'Mittente',
+    'destinatario': 'Destinatario',
+    'numero_documento': 'Numero Documento',
+    'totale_kg': 'Totale Kg'
+})
+
+FIELD_DESC_LINE = "- **{field}**: {desc}".format
+
+# Tipi JSON dei campi per le Structured Outputs (json_schema strict): il modello
+# restituisce sempre oggetti conformi, quindi niente JSON malformati né chiavi extra
+_FIELD_JSON_TYPES = MappingProxyType({
+    'data': 'string',
+    'mittente': 'string',
+    'destinatario': 'string',
+    'numero_documento': 'string',
+    'totale_kg': 'number'
+})
+
+
+@functools.lru_cache(maxsize=32)
+def _vision_response_format(fields: tuple[str, ...]) -> Dict[str, Any]:
+    """
+    Costruisce il response_format json_schema (strict) per i campi richiesti
+
+    Lo schema è scritto a mano invece di usare DDTData.model_json_schema():
+    la modalità strict accetta solo un sottoinsieme di JSON Schema e richiede
+    tutti i campi in "required" con additionalProperties false.
+    _normalize_extracted_data resta come rifinitura (date, numeri, ragioni sociali).
+
+    Args:
+        fields: Campi da estrarre, nell'ordine del prompt
+
+    Returns:
+        Dizionario da passare come response_format alla Chat Completions API
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "DDTData",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    f: {
+                        "type": _FIELD_JSON_TYPES.get(f, "string"),
+                        "description": FIELD_DESCRIPTIONS.get(f, f),
+                    }
+                    for f in fields
+                },
+                "required": list(fields),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+_DDT_RESPONSE_FORMAT = _vision_response_format(tuple(FIELD_DESCRIPTIONS))
+
+# Pattern comuni del mittente nell'intestazione del DDT (ricerca annotazioni preliminari),
+# in ordine di priorità: etichetta esplicita, poi ragione sociale con forma societaria
+_MITTENTE_PATTERNS = (
+    re.compile(r'(?:Mittente|Da:|Fornitore|Spett\.le)\s*:?\s*([A-Z][A-Za-z0-9\s&\.]+)', re.IGNORECASE),
+    re.compile(r'([A-Z][A-Za-z0-9\s&\.]+)\s*(?:S\.r\.l\.|S\.p\.A\.|S\.A\.S\.|S\.A\.)', re.IGNORECASE),
+)
+_MITTENTE_SEARCH_CHARS = 500
+
+# Etichette dei campi nel testo dei PDF nativi (varianti di BASE_PROMPT) per il percorso
+# solo testo: il valore deve seguire l'etichetta sulla stessa riga
+_TEXT_ONLY_PATTERNS = (
+    ("data", re.compile(
+        r'(?:Data\s+DDT|Data\s+documento|Data\s+emissione|Emissione|\bDel)[ \t]*:?[ \t]*(\d{1,2}[./-]\d{1,2}[./-]\d{2,4})\b',
+        re.IGNORECASE)),
+    ("mittente", re.compile(r'(?:\bMittente|\bFornitore)[ \t]*:[ \t]*([^\n]+)', re.IGNORECASE)),
+    ("destinatario", re.compile(
+        r'(?:\bDestinatario|\bCliente|\bConsegna\s+a|\bSpedire\s+a)[ \t]*:[ \t]*([^\n]+)', re.IGNORECASE)),
+    ("numero_documento", re.compile(
+        r'(?:Numero\s+DDT|DDT\s+N[.°º]?|N[.°º]\s*documento|Documento\s+N[.°º]?)[ \t]*:?[ \t]*([A-Z0-9][A-Z0-9/\-]*)',
+        re.IGNORECASE)),
+    ("totale_kg", re.compile(
+        r'(?:Totale\s+Kg|Peso\s+totale|Kg\s+complessivi|Totale\s+peso|Peso\s*\(kg\))[ \t]*:?[ \t]*(\d[\d. ]*(?:,\d+)?)',
+        re.IGNORECASE)),
+)
+
+# Normalizzazione della risposta Vision: (campo, normalizzatore del valore grezzo, default)
+# iterata una sola volta per documento da _normalize_extracted_data
+_NORMALIZATION_SPEC: tuple[tuple[str, Callable[[Any], Any], Any], ...] = (
+    ("data", lambda v: normalize_date(v) if isinstance(v, str) else None, "1900-01-01"),
+    ("mittente", lambda v: clean_company_name(str(v)), "Non specificato"),
+    ("destinatario", lambda v: clean_company_name(str(v)), "Non specificato"),
+    ("numero_documento", lambda v: normalize_text(str(v)), "Non specificato"),
+    ("totale_kg", normalize_float, 0.0),
+)
+
+# Stessa tabella indicizzata per campo, per il fallback AI mirato: (normalizzatore, default)
+_FIELD_SPECS: "MappingProxyType[str, tuple[Callable[[Any], Any], Any]]" = MappingProxyType({
+    field: (normalizer, default) for field, normalizer, default in _NORMALIZATION_SPEC
+})
+
+
+class _FitzGuard:
+    """
+    Lock globale (per processo) delle operazioni PyMuPDF
+    
+    PyMuPDF non supporta l'uso concorrente da più thread, e i fitz.Document dei
+    generatori di estrazione passano da un thread all'altro a ogni send/throw
+    (asyncio.to_thread): ogni fase che usa fitz gira sotto questo lock.
+    Rientrante per thread (hold annidati non si bloccano); released() lo rilascia
+    durante le attese di rete sincrone dentro una fase, senza serializzarle.
+    Il parallelismo CPU tra documenti si ottiene con i processi (extract_many).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def hold(self):
+        if getattr(self._local, "held", False):
+            yield
+            return
+        with self._lock:
+            self._local.held = True
+            try:
+                yield
+            finally:
+                self._local.held = False
+
+    @contextmanager
+    def released(self):
+        if not getattr(self._local, "held", False):
+            yield
+            return
+        self._local.held = False
+        self._lock.release()
+        try:
+            yield
+        finally:
+            self._lock.acquire()
+            self._local.held = True
+
+
+_fitz_guard = _FitzGuard()
+
+# Cache LRU dei pixmap RGB della prima pagina, chiave SHA256 del PDF: estrazione
+# e fallback AI mirato dello stesso file condividono parsing e rendering MuPDF
+# (~5 MB per pagina A4 a 1109x1568)
+_RENDER_CACHE_MAXSIZE = 8
+_render_cache: "OrderedDict[bytes, Any]" = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+# Client asincrono + semaforo per event loop: httpx.AsyncClient e asyncio.Semaphore
+# sono legati al loop in cui vengono usati, quindi ne teniamo uno per loop
+# (in produzione un solo loop → singleton di fatto)
+_async_vision_resources: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[AsyncOpenAI, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+
+def _build_async_http_client() -> httpx.AsyncClient:
+    """
+    Crea il client HTTP per AsyncOpenAI
+    
+    Con l'extra opzionale openai[aiohttp] installato usa il trasporto aiohttp,
+    che scala meglio di httpx con molte richieste concorrenti (batch ingest);
+    altrimenti ripiega su httpx con pool di connessioni dimensionato (e HTTP/2 se h2 è installato).
+    """
+    try:
+        from openai import DefaultAioHttpClient
+        http_client = DefaultAioHttpClient()
+        logger.debug("Client Vision asincrono: trasporto aiohttp")
+        return http_client
+    except (ImportError, RuntimeError):
+        return DefaultAsyncHttpxClient(http2=_HAS_H2, limits=_OPENAI_HTTP_LIMITS)
+
+
+def _get_async_vision_resources() -> tuple[AsyncOpenAI, asyncio.Semaphore]:
+    """Restituisce (AsyncOpenAI, Semaphore) condivisi per l'event loop corrente"""
+    loop = asyncio.get_running_loop()
+    resources = _async_vision_resources.get(loop)
+    if resources is None:
+        aclient = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            max_retries=0,
+            http_client=_build_async_http_client(),
+        )
+        resources = (aclient, asyncio.Semaphore(MAX_CONCURRENT_VISION))
+        _async_vision_resources[loop] = resources
+    return resources
+
+
+async def _close_async_vision_resources() -> None:
+    """
+    Chiude il client AsyncOpenAI dell'event loop corrente, se creato
+    
+    Da chiamare prima della fine di un event loop creato apposta (asyncio.run):
+    altrimenti il pool di connessioni del client resta aperto.
+    """
+    resources = _async_vision_resources.pop(asyncio.get_running_loop(), None)
+    if resources is not None:
+        await resources[0].close()
+
+
+def _vision_retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Calcola l'attesa prima del prossimo tentativo: rispetta l'header
+    Retry-After se presente, altrimenti backoff esponenziale con jitter
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(VISION_MAX_BACKOFF, float(retry_after))
+            except ValueError:
+                pass
+    return min(VISION_MAX_BACKOFF, 2 ** attempt + random.random())
+
+
+def _log_vision_retry(error: Exception, attempt: int, delay: float) -> None:
+    status_code = getattr(error, "status_code", None)
+    logger.warning(
+        "⚠️ Errore transitorio OpenAI %s (status=%s): %s - tentativo %d/%d, riprovo tra %.1fs",
+        type(error).__name__, status_code, error, attempt + 1, VISION_MAX_ATTEMPTS, delay
+    )
+
+
+def _call_with_vision_retry(call: Callable[[], Any]) -> Any:
+    """
+    Esegue una chiamata OpenAI con retry sugli errori transitori
+    
+    Raises:
+        OpenAIError: Se l'errore non è transitorio o i tentativi sono esauriti
+        httpx.TransportError: Se lo stream si interrompe e i tentativi sono esauriti
+    """
+    for attempt in range(VISION_MAX_ATTEMPTS):
+        try:
+            return call()
+        except _RETRYABLE_VISION_ERRORS as e:
+            if attempt == VISION_MAX_ATTEMPTS - 1:
+                raise
+            delay = _vision_retry_delay(e, attempt)
+            _log_vision_retry(e, attempt, delay)
+            time.sleep(delay)
+
+
+async def _call_with_vision_retry_async(call: Callable[[], Awaitable[Any]]) -> Any:
+    """Versione asincrona di _call_with_vision_retry"""
+    for attempt in range(VISION_MAX_ATTEMPTS):
+        try:
+            return await call()
+        except _RETRYABLE_VISION_ERRORS as e:
+            if attempt == VISION_MAX_ATTEMPTS - 1:
+                raise
+            delay = _vision_retry_delay(e, attempt)
+            _log_vision_retry(e, attempt, delay)
+            await asyncio.sleep(delay)
+
+
+def _stream_vision_content(**kwargs) -> str:
+    """
+    Esegue la chiamata Vision in streaming (con retry) e restituisce il testo completo
+    
+    Returns:
+        Contenuto della risposta del modello (stringa vuota se assente)
+    """
+    def _call() -> str:
+        stream = client.chat.completions.create(stream=True, timeout=_VISION_STREAM_TIMEOUT, **kwargs)
+        with stream:
+            return "".join(
+                chunk.choices[0].delta.content or ""
+                for chunk in stream
+                if chunk.choices
+            )
+    
+    return _call_with_vision_retry(_call)
+
+
+async def _stream_vision_content_async(aclient: AsyncOpenAI, **kwargs) -> str:
+    """
+    Versione asincrona di _stream_vision_content
+    
+    Ogni chunk è atteso al massimo VISION_STREAM_IDLE_TIMEOUT secondi.
+    """
+    async def _call() -> str:
+        stream = await aclient.chat.completions.create(stream=True, timeout=_VISION_STREAM_TIMEOUT, **kwargs)
+        parts = []
+        async with stream:
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), VISION_STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+        return "".join(parts)
+    
+    return await _call_with_vision_retry_async(_call)
+
 
 BASE_PROMPT = """Sei un esperto estrattore di dati da Documenti di Trasporto (DDT) italiani.
 La tua missione è estrarre SOLO i seguenti campi e restituire UNICAMENTE un JSON valido e corretto.
@@ -89,6 +505,9 @@ ESEMPIO OUTPUT CORRETTO:
 
 IMPORTANTE: Restituisci SOLO il JSON, senza commenti, senza spiegazioni."""
 
+# Stima (~4 caratteri per token) del prefisso fisso, calcolata una volta per i log sulla dimensione del prompt
+_BASE_PROMPT_LEN_TOKENS = len(BASE_PROMPT) // 4
+
 
 def extract_text_from_pdf(file_path: str) -> str:
     """
@@ -104,61 +523,341 @@ def extract_text_from_pdf(file_path: str) -> str:
     return extract_text_for_rule_detection(file_path)
 
 
-def extract_missing_fields_with_ai(
-    file_path: str,
-    missing_fields: list[str],
-    already_extracted: dict,
+def _vision_render_matrix(page: Any, dpi: int = VISION_RENDER_DPI) -> Any:
+    """
+    Matrice di zoom per il rendering di una pagina fitz a dpi (default VISION_RENDER_DPI)
+    
+    Lo zoom è limitato in modo che il lato lungo non superi VISION_MAX_LONG_EDGE
+    pixel: oltre, OpenAI ridimensiona comunque l'immagine lato server.
+    """
+    rect = page.rect
+    zoom = min(dpi / 72.0, VISION_MAX_LONG_EDGE / max(rect.width, rect.height, 1))
+    return fitz.Matrix(zoom, zoom)
+
+
+def _render_first_page_pixmap(doc: Any, dpi: int = VISION_RENDER_DPI, colorspace: Optional[Any] = None) -> Any:
+    """
+    Rasterizza la prima pagina di un fitz.Document (senza canale alpha)
+    
+    Unico rendering Vision per documento: lo stesso pixmap RGB serve a estrazione
+    e fallback AI mirato (eventualmente convertito in scala di grigi).
+    L'anteprima per il browser ha un rendering proprio (_render_preview_pixmap).
+    
+    Args:
+        doc: fitz.Document aperto
+        dpi: Risoluzione di rendering (default VISION_RENDER_DPI)
+        colorspace: Spazio colore fitz (default fitz.csRGB; fitz.csGRAY = 1 byte/pixel)
+    """
+    if len(doc) == 0:
+        raise ValueError("PDF vuoto o non valido")
+    page = doc[0]
+    return page.get_pixmap(
+        matrix=_vision_render_matrix(page, dpi),
+        colorspace=colorspace or fitz.csRGB,
+        alpha=False,
+    )
+
+
+def _render_first_page_cached(
     pdf_bytes: bytes,
-    pdf_text: Optional[str] = None,
-    text_extraction_result: Optional[Any] = None
-) -> dict:
+    pdf_doc: Optional[Any] = None,
+    pdf_digest: Optional[bytes] = None
+) -> Any:
     """
-    Usa AI_FALLBACK per estrarre SOLO i campi mancanti,
-    usando already_extracted come contesto vincolante.
+    Pixmap RGB della prima pagina, dalla cache LRU se lo stesso PDF è già stato renderizzato
     
-    REGOLE FERREE:
-    - L'AI NON può modificare campi già estratti dal layout
-    - Prompt esplicito: "estrai SOLO questi campi"
-    - Se AI fallisce → solleva ValueError
+    Il rendering avviene fuori dal lock della cache, sotto _fitz_guard.
+    Il pixmap restituito è condiviso e non va modificato.
     
     Args:
-        file_path: Percorso del file PDF
-        missing_fields: Lista di campi da estrarre (es: ['destinatario'])
-        already_extracted: Dizionario con campi già estratti dal layout model
         pdf_bytes: Contenuto del PDF in bytes
-        pdf_text: Testo estratto dal PDF (opzionale, per grounding)
-        text_extraction_result: Risultato estrazione testo (opzionale)
+        pdf_doc: fitz.Document già aperto (riusato, non chiuso)
+        pdf_digest: SHA256 (digest binario) di pdf_bytes, se già calcolato
+    """
+    key = pdf_digest or hashlib.sha256(pdf_bytes).digest()
+    with _render_cache_lock:
+        pix = _render_cache.get(key)
+        if pix is not None:
+            _render_cache.move_to_end(key)
+            return pix
+    
+    with _fitz_guard.hold():
+        doc = pdf_doc if pdf_doc is not None else fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            pix = _render_first_page_pixmap(doc)
+        finally:
+            if doc is not pdf_doc:
+                doc.close()
+    
+    with _render_cache_lock:
+        _render_cache[key] = pix
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > _RENDER_CACHE_MAXSIZE:
+            _render_cache.popitem(last=False)
+    return pix
+
+
+def _is_line_art_page(page: Any, pix: Any) -> bool:
+    """
+    True se la pagina è solo testo/linee: PDF nativo senza immagini raster
+    o pixmap già in bianco e nero puro (es. scansioni fax a 1 bit)
+    
+    Su queste pagine il PNG è più piccolo del JPEG e non introduce artefatti
+    attorno ai caratteri; il JPEG conviene per le scansioni fotografiche.
+    """
+    return not page.get_images() or pix.is_monochrome
+
+
+# Modalità PIL dei pixmap PyMuPDF senza canale alpha (numero componenti → modo)
+_PIL_MODES = MappingProxyType({1: "L", 3: "RGB"})
+
+
+def _pixmap_png_bytes(pix: Any) -> bytes:
+    """
+    Codifica un pixmap PyMuPDF in PNG con livello zlib VISION_PNG_COMPRESS_LEVEL
+    
+    pix.tobytes("png") usa sempre la compressione predefinita di MuPDF: per
+    immagini transitorie (inviate a Vision e decodificate una volta) il livello
+    rapido di Pillow costa meno CPU. Pixmap con alpha o spazi colore diversi
+    restano sull'encoder di MuPDF.
+    """
+    mode = None if pix.alpha else _PIL_MODES.get(pix.n)
+    if mode is None:
+        return pix.tobytes("png")
+    image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    img_buffer = BytesIO()
+    image.save(img_buffer, format='PNG', compress_level=VISION_PNG_COMPRESS_LEVEL)
+    return img_buffer.getvalue()
+
+
+def _render_preview_pixmap(doc: Any) -> Any:
+    """
+    Rasterizza la prima pagina per l'anteprima nel browser a PREVIEW_RENDER_DPI
+    
+    Rendering separato da quello Vision: nessun limite sul lato lungo e
+    pixmap non condiviso con la cache di rendering.
+    """
+    if len(doc) == 0:
+        raise ValueError("PDF vuoto o non valido")
+    zoom = PREVIEW_RENDER_DPI / 72.0
+    return doc[0].get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+
+
+def _encode_vision_pixmap(page: Any, pix: Any, grayscale: bool) -> tuple[bytes, bool]:
+    """
+    Codifica il pixmap RGB della prima pagina per OpenAI Vision
+    
+    Unica regola di formato per estrazione completa e fallback AI mirato:
+    JPEG se VISION_IMAGE_FORMAT è "jpeg", salvo pagine vettoriali/monocromatiche
+    (PNG più piccolo e senza artefatti).
+    
+    Args:
+        page: Prima pagina fitz del documento
+        pix: Pixmap RGB della pagina (condiviso, non viene modificato)
+        grayscale: Conversione in scala di grigi (1 byte/pixel) derivata dallo stesso pixmap
         
     Returns:
-        Dizionario con SOLO i campi mancanti estratti
+        Tupla (bytes immagine, True se JPEG)
+    """
+    vision_pix = fitz.Pixmap(fitz.csGRAY, pix) if grayscale else pix
+    use_jpeg = VISION_IMAGE_FORMAT == "jpeg"
+    if use_jpeg and not _is_line_art_page(page, vision_pix):
+        return vision_pix.tobytes("jpeg", jpg_quality=VISION_JPEG_QUALITY), True
+    if use_jpeg:
+        logger.info("Pagina vettoriale/monocromatica: immagine Vision in PNG")
+    return _pixmap_png_bytes(vision_pix), False
+
+
+def _render_page0_fitz(
+    pdf_bytes: bytes, pdf_doc: Optional[Any] = None, grayscale: bool = True
+) -> tuple[bytes, bool]:
+    """Rendering della prima pagina con PyMuPDF (riusa pdf_doc se fornito, senza chiuderlo)"""
+    doc = pdf_doc if pdf_doc is not None else fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        # Scala di grigi (salvo regole 'keep_color') derivata dal pixmap in cache
+        pix = _render_first_page_cached(pdf_bytes, doc)
+        return _encode_vision_pixmap(doc[0], pix, grayscale)
+    finally:
+        if doc is not pdf_doc:
+            doc.close()
+
+
+def _render_first_page_pdf2image(
+    pdf_bytes: bytes,
+    use_jpeg: bool,
+    grayscale: bool,
+    dpi: int = VISION_RENDER_DPI
+) -> bytes:
+    """Rendering della prima pagina con pdf2image (richiede Poppler)"""
+    images = convert_from_bytes(
+        pdf_bytes, first_page=1, last_page=1, dpi=dpi, grayscale=grayscale
+    )
+    if not images:
+        raise ValueError("Impossibile convertire il PDF in immagine")
+    img_buffer = BytesIO()
+    if use_jpeg:
+        images[0].save(img_buffer, format='JPEG', quality=VISION_JPEG_QUALITY, optimize=False)
+    else:
+        images[0].save(img_buffer, format='PNG', compress_level=VISION_PNG_COMPRESS_LEVEL)
+    # bytes veri (come il percorso PyMuPDF): usati anche per la firma PNG e come chiave/valore
+    return img_buffer.getvalue()
+
+
+def _render_first_page(
+    pdf_bytes: bytes,
+    render_fitz: Callable[[], tuple[bytes, bool]],
+    use_jpeg: bool,
+    grayscale: bool,
+    purpose: str,
+    dpi: int = VISION_RENDER_DPI
+) -> tuple[bytes, bool]:
+    """
+    Rendering della prima pagina: PyMuPDF, con pdf2image come fallback
+    
+    Unica cascata condivisa da estrazione Vision, fallback AI mirato e anteprima:
+    ogni chiamante fornisce solo il proprio rendering PyMuPDF (pixmap in cache,
+    scala di grigi, anteprima, scelta JPEG/PNG).
+    
+    Args:
+        pdf_bytes: Contenuto del PDF in bytes
+        render_fitz: Rendering PyMuPDF del chiamante, restituisce (bytes, is_jpeg)
+        use_jpeg: Formato del fallback pdf2image (JPEG o PNG)
+        grayscale: Fallback pdf2image in scala di grigi
+        purpose: Descrizione dell'operazione per i log
+        dpi: Risoluzione del fallback pdf2image (default VISION_RENDER_DPI)
+        
+    Returns:
+        Tupla (bytes immagine, True se JPEG)
         
     Raises:
-        ValueError: Se l'estrazione AI fallisce o non completa i campi mancanti
+        ImportError: Se né PyMuPDF né pdf2image sono installati
+        ValueError: Se la conversione fallisce con tutti i metodi disponibili
     """
-    logger.info(f"🤖 AI fallback mirato per campi mancanti: {missing_fields}")
-    logger.info(f"   Campi già estratti dal layout (NON modificabili): {list(already_extracted.keys())}")
+    fitz_error = None
+    if _HAS_FITZ:
+        try:
+            logger.info("%s con PyMuPDF...", purpose)
+            with _fitz_guard.hold():
+                img_bytes, is_jpeg = render_fitz()
+            logger.info("%s con PyMuPDF completata (%s bytes)", purpose, len(img_bytes))
+            return img_bytes, is_jpeg
+        except Exception as e:
+            fitz_error = e
+            logger.warning(f"Errore conversione PDF con PyMuPDF: {e}, provo fallback...")
+    else:
+        logger.warning("PyMuPDF non disponibile, provo con pdf2image...")
     
-    # Costruisci prompt specifico per campi mancanti
-    field_descriptions = {
-        'data': 'Data del documento DDT (formato YYYY-MM-DD)',
-        'mittente': 'Azienda che emette il DDT (chi spedisce)',
-        'destinatario': 'Azienda che riceve la merce',
-        'numero_documento': 'Numero del DDT',
-        'totale_kg': 'Peso totale in chilogrammi (solo numero, float)'
-    }
+    if not _HAS_PDF2IMAGE:
+        if fitz_error is None:
+            error_msg = "Nessuna libreria disponibile per convertire PDF. Installa PyMuPDF (consigliato) o pdf2image+Poppler"
+            logger.error(error_msg)
+            raise ImportError(error_msg)
+        error_msg = f"Errore conversione PDF: PyMuPDF fallito ({fitz_error}), pdf2image non installato"
+        logger.error(error_msg)
+        raise ValueError(error_msg) from fitz_error
     
-    missing_fields_desc = "\n".join([
-        f"- **{field}**: {field_descriptions.get(field, field)}"
+    fallback_label = " (fallback)" if fitz_error is not None else ""
+    try:
+        logger.info("%s con pdf2image%s...", purpose, fallback_label)
+        img_bytes = _render_first_page_pdf2image(pdf_bytes, use_jpeg, grayscale, dpi)
+        logger.info("%s con pdf2image%s completata (%s bytes)", purpose, fallback_label, len(img_bytes))
+        return img_bytes, use_jpeg
+    except Exception as e2:
+        if fitz_error is not None:
+            error_msg = f"Errore conversione PDF: PyMuPDF fallito ({fitz_error}), pdf2image fallito ({e2})"
+        else:
+            error_msg = f"Errore conversione PDF con pdf2image: {e2}. Suggerimento: su Windows installa Poppler o usa PyMuPDF"
+        logger.error(error_msg, exc_info=logger.isEnabledFor(logging.DEBUG))
+        raise ValueError(error_msg) from e2
+
+
+def _render_page0_image(
+    pdf_bytes: bytes, pdf_doc: Optional[Any] = None, grayscale: bool = True
+) -> tuple[bytes, str]:
+    """
+    Renderizza la prima pagina del PDF per il fallback AI
+    
+    Args:
+        pdf_bytes: Contenuto del PDF in bytes
+        pdf_doc: fitz.Document già aperto (opzionale): se fornito viene riusato
+                 e NON chiuso, evitando un secondo parsing del PDF
+        grayscale: Scala di grigi (default); False per le regole con 'keep_color'
+        
+    Returns:
+        Tupla (bytes immagine, MIME type): VISION_IMAGE_FORMAT, PNG per le pagine vettoriali
+        
+    Raises:
+        ImportError: Se né PyMuPDF né pdf2image sono installati
+        ValueError: Se la conversione del PDF in immagine fallisce
+    """
+    img_bytes, is_jpeg = _render_first_page(
+        pdf_bytes,
+        lambda: _render_page0_fitz(pdf_bytes, pdf_doc, grayscale),
+        use_jpeg=VISION_IMAGE_FORMAT == "jpeg",
+        grayscale=grayscale,
+        purpose="Rendering prima pagina per fallback AI",
+    )
+    if not img_bytes:
+        raise ValueError("Impossibile convertire il PDF in immagine")
+    
+    return img_bytes, "image/jpeg" if is_jpeg else "image/png"
+
+
+def _image_data_url(img_bytes: bytes, image_format: str) -> str:
+    """
+    Data URL base64 dell'immagine per OpenAI Vision
+    
+    Concatena i bytes e decodifica una sola volta: evita la stringa base64
+    intermedia (~1.33x la dimensione dell'immagine) prima della data URL.
+    
+    L'immagine resta inline: Chat Completions non accetta immagini caricate
+    tramite Files API (file_id), e un upload separato aggiungerebbe un round-trip
+    per un'immagine usata una sola volta. Il peso si riduce a monte (JPEG in
+    scala di grigi a 150 DPI).
+    """
+    return b"".join((
+        b"data:", image_format.encode("ascii"), b";base64,", base64.b64encode(img_bytes)
+    )).decode("ascii")
+
+
+# Lunghezza massima del testo di grounding nel prompt: è la parte non cacheabile
+# della richiesta, l'intestazione del DDT (dove stanno i campi) resta entro il limite
+MAX_GROUNDING_CHARS = 1200
+
+
+def _truncate_for_prompt(text: str, limit: int = MAX_GROUNDING_CHARS) -> str:
+    """Tronca il testo di grounding (senza spazi iniziali/finali) a limit caratteri, segnalando il troncamento"""
+    text = text.strip()
+    if len(text) > limit:
+        return text[:limit] + "\n... (testo troncato)"
+    return text
+
+
+def _build_missing_fields_prompt(
+    missing_fields: list[str],
+    already_extracted: dict,
+    pdf_text: Optional[str] = None,
+    text_extraction_result: Optional[Any] = None
+) -> str:
+    """
+    Costruisce il prompt di sistema mirato per il fallback AI sui campi mancanti
+    
+    Returns:
+        Prompt con campi da estrarre, campi già estratti e grounding del testo (se affidabile)
+    """
+    # Costruisci prompt specifico per campi mancanti
+    missing_fields_desc = "\n".join(
+        FIELD_DESC_LINE(field=field, desc=FIELD_DESCRIPTIONS.get(field, field))
         for field in missing_fields
-    ])
+    )
     
     # Costruisci contesto con campi già estratti (per riferimento ma NON modificabili)
-    context_fields = "\n".join([
-        f"- **{field}**: {already_extracted.get(field, 'N/A')}"
-        for field in already_extracted.keys()
-    ])
+    context_fields = "\n".join(
+        FIELD_DESC_LINE(field=field, desc=value)
+        for field, value in already_extracted.items()
+    )
     
-    targeted_prompt = f"""Sei un esperto estrattore di dati da Documenti di Trasporto (DDT) italiani.
+    parts = [f"""Sei un esperto estrattore di dati da Documenti di Trasporto (DDT) italiani.
 
 ⚠️ IMPORTANTE - REGOLE FERREE:
 1. Estrai SOLO i seguenti campi mancanti (NON modificare gli altri):
@@ -177,15 +876,13 @@ def extract_missing_fields_with_ai(
 CAMPI DA ESTRARRE (SOLO QUESTI):
 {missing_fields_desc}
 
-IMPORTANTE: Restituisci SOLO il JSON con i campi mancanti, senza commenti."""
+IMPORTANTE: Restituisci SOLO il JSON con i campi mancanti, senza commenti."""]
     
     # Aggiungi grounding del testo se disponibile
     if pdf_text and text_extraction_result and text_extraction_result.is_reliable:
-        text_preview = pdf_text[:2000] if len(pdf_text) > 2000 else pdf_text
-        if len(pdf_text) > 2000:
-            text_preview += "\n... (testo troncato)"
+        text_preview = _truncate_for_prompt(pdf_text)
         
-        targeted_prompt += f"""
+        parts.append(f"""
 
 ---
 📄 TESTO ESTRATTO AUTOMATICAMENTE DAL PDF (RIFERIMENTO):
@@ -196,110 +893,101 @@ IMPORTANTE: Restituisci SOLO il JSON con i campi mancanti, senza commenti."""
 ⚠️ IMPORTANTE:
 - Usa questo testo come riferimento per trovare i campi mancanti
 - Privilegia sempre la validazione visiva del documento
-"""
+""")
     
-    # Converti PDF in immagine (riusa logica esistente)
-    img_b64 = None
-    image_format = "image/png"
+    return "".join(parts)
+
+
+def _build_missing_fields_messages(
+    targeted_prompt: str,
+    pdf_bytes: bytes,
+    pdf_doc: Optional[Any] = None,
+    page0_image: Optional[bytes] = None,
+    grayscale: bool = True
+) -> list[dict]:
+    """
+    Costruisce i messaggi OpenAI (prompt mirato + immagine prima pagina)
+    per il fallback AI sui campi mancanti
     
-    try:
-        import fitz
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if len(doc) == 0:
-            raise ValueError("PDF vuoto o non valido")
-        
-        page = doc[0]
-        zoom = 200 / 72.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        img_bytes = pix.tobytes("png")
-        img_b64 = base64.b64encode(img_bytes).decode()
-        doc.close()
-    except ImportError:
-        try:
-            from pdf2image import convert_from_bytes
-            from io import BytesIO
-            images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
-            if not images:
-                raise ValueError("Impossibile convertire il PDF in immagine")
-            img_buffer = BytesIO()
-            images[0].save(img_buffer, format='PNG')
-            img_bytes = img_buffer.getvalue()
-            img_b64 = base64.b64encode(img_bytes).decode()
-        except ImportError:
-            raise ImportError("Nessuna libreria disponibile per convertire PDF")
-    except Exception as e:
-        raise ValueError(f"Errore conversione PDF: {e}") from e
+    Se page0_image è fornita non viene eseguito alcun rendering; altrimenti
+    la prima pagina viene renderizzata riusando pdf_doc (se fornito).
     
-    if not img_b64:
-        raise ValueError("Impossibile convertire il PDF in immagine")
+    Returns:
+        Lista di messaggi pronta per chat.completions.create
+        
+    Raises:
+        ValueError: Se la conversione del PDF in immagine fallisce
+    """
+    # Converti PDF in immagine, salvo immagine già renderizzata dal chiamante
+    if page0_image is None:
+        page0_image, image_format = _render_page0_image(pdf_bytes, pdf_doc, grayscale)
+    else:
+        # Il formato dipende anche dalla pagina (PNG per le pagine vettoriali): dalla firma
+        image_format = "image/png" if page0_image[:8] == b"\x89PNG\r\n\x1a\n" else "image/jpeg"
+    image_url = _image_data_url(page0_image, image_format)
     
-    # Chiama OpenAI Vision
-    try:
-        response: ChatCompletion = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": targeted_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                f"Estrai SOLO i seguenti campi mancanti dal DDT: {', '.join(missing_fields)}. "
-                                f"Non modificare i campi già estratti: {', '.join(already_extracted.keys())}."
-                            )
-                        },
-                        {"type": "image_url", "image_url": {"url": f"data:{image_format};base64,{img_b64}"}}
-                    ],
-                },
+    return [
+        {"role": "system", "content": targeted_prompt},
+        # Solo l'immagine nel turno utente: le istruzioni (campi da estrarre e
+        # campi da non modificare) sono già tutte nel prompt di sistema
+        {
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": image_url}}
             ],
-            response_format={"type": "json_object"},
-            temperature=0.1,
-        )
-    except OpenAIError as e:
-        logger.error(f"Errore API OpenAI durante fallback mirato: {e}")
-        raise ValueError(f"Errore durante estrazione AI campi mancanti: {str(e)}") from e
+        },
+    ]
+
+
+def _parse_missing_fields_response(content: str) -> dict:
+    """
+    Estrae il JSON grezzo dalla risposta OpenAI del fallback mirato
     
+    Returns:
+        Dizionario con i dati grezzi restituiti dal modello
+        
+    Raises:
+        ValueError: Se la risposta è vuota o non è JSON valido
+    """
     # Estrai il JSON dalla risposta
-    if not response.choices or not response.choices[0].message.content:
+    if not content:
         raise ValueError("Risposta vuota da OpenAI durante fallback mirato")
     
-    import json
     try:
-        ai_raw_data = json.loads(response.choices[0].message.content)
+        ai_raw_data = _json_loads(content)
     except json.JSONDecodeError as e:
         logger.error(f"Errore parsing JSON da OpenAI durante fallback mirato: {e}")
         raise ValueError(f"Risposta non valida da OpenAI: {str(e)}") from e
     
-    logger.info(f"🤖 Dati grezzi estratti da AI (solo campi mancanti): {ai_raw_data}")
+    return ai_raw_data
+
+
+def _normalize_missing_fields(ai_raw_data: dict, missing_fields: list[str]) -> dict:
+    """
+    Normalizza e verifica i campi mancanti estratti dal modello
+    
+    Returns:
+        Dizionario con SOLO i campi mancanti estratti
+        
+    Raises:
+        ValueError: Se mancano ancora dei campi
+    """
+    logger.info("🤖 Dati grezzi estratti da AI (solo campi mancanti): %s", ai_raw_data)
     
-    # Normalizza solo i campi mancanti
+    # Normalizza solo i campi mancanti (fallback + normalizzazione in un solo passaggio)
     ai_normalized = {}
     for field in missing_fields:
         if field in ai_raw_data:
-            ai_normalized[field] = ai_raw_data[field]
+            value = ai_raw_data[field]
         else:
             # Campo non estratto da AI → usa fallback
             logger.warning(f"⚠️ Campo '{field}' non estratto da AI, uso fallback")
-            if field == 'data':
-                ai_normalized[field] = "1900-01-01"
-            elif field in ['mittente', 'destinatario', 'numero_documento']:
-                ai_normalized[field] = "Non specificato"
-            elif field == 'totale_kg':
-                ai_normalized[field] = 0.0
-    
-    # Normalizza usando le funzioni esistenti
-    if 'data' in ai_normalized:
-        ai_normalized['data'] = normalize_date(str(ai_normalized['data'])) or "1900-01-01"
-    if 'mittente' in ai_normalized:
-        ai_normalized['mittente'] = clean_company_name(str(ai_normalized['mittente'])) or "Non specificato"
-    if 'destinatario' in ai_normalized:
-        ai_normalized['destinatario'] = clean_company_name(str(ai_normalized['destinatario'])) or "Non specificato"
-    if 'numero_documento' in ai_normalized:
-        ai_normalized['numero_documento'] = normalize_text(str(ai_normalized['numero_documento'])) or "Non specificato"
-    if 'totale_kg' in ai_normalized:
-        ai_normalized['totale_kg'] = normalize_float(ai_normalized['totale_kg']) or 0.0
+            if field not in _FIELD_SPECS:
+                continue
+            value = _FIELD_SPECS[field][1]
+        
+        spec = _FIELD_SPECS.get(field)
+        ai_normalized[field] = _coerce(value, *spec) if spec else value
     
     # Verifica che tutti i campi mancanti siano stati estratti
     extracted_missing = list(ai_normalized.keys())
@@ -313,34 +1001,157 @@ IMPORTANTE: Restituisci SOLO il JSON con i campi mancanti, senza commenti."""
         logger.error(f"❌ {error_msg}")
         raise ValueError(error_msg)
     
-    logger.info(f"✅ AI fallback completato per campi: {extracted_missing}")
+    logger.info("✅ AI fallback completato per campi: %s", extracted_missing)
     return ai_normalized
 
 
-def build_dynamic_prompt(rule_name: Optional[str] = None, extracted_text: Optional[str] = None, annotations: Optional[Dict[str, Any]] = None) -> str:
+def extract_missing_fields_with_ai(
+    file_path: str,
+    missing_fields: list[str],
+    already_extracted: dict,
+    pdf_bytes: bytes,
+    pdf_text: Optional[str] = None,
+    text_extraction_result: Optional[Any] = None,
+    pdf_doc: Optional[Any] = None,
+    page0_image: Optional[bytes] = None,
+    grayscale: bool = True
+) -> dict:
     """
-    Costruisce il prompt dinamico con eventuali regole aggiuntive e grounding del testo
+    Usa AI_FALLBACK per estrarre SOLO i campi mancanti,
+    usando already_extracted come contesto vincolante.
+    
+    REGOLE FERREE:
+    - L'AI NON può modificare campi già estratti dal layout
+    - Prompt esplicito: "estrai SOLO questi campi"
+    - Se AI fallisce → solleva ValueError
     
     Args:
-        rule_name: Nome della regola da applicare (opzionale)
-        extracted_text: Testo estratto automaticamente per grounding (opzionale)
-        annotations: Dizionario con coordinate dei riquadri annotati dall'utente (opzionale)
-                    Formato: {field: {x, y, width, height}}
+        file_path: Percorso del file PDF
+        missing_fields: Lista di campi da estrarre (es: ['destinatario'])
+        already_extracted: Dizionario con campi già estratti dal layout model
+        pdf_bytes: Contenuto del PDF in bytes
+        pdf_text: Testo estratto dal PDF (opzionale, per grounding)
+        text_extraction_result: Risultato estrazione testo (opzionale)
+        pdf_doc: fitz.Document già aperto dal chiamante (opzionale, non viene chiuso)
+        page0_image: Immagine della prima pagina già renderizzata (opzionale),
+                     JPEG o PNG (riconosciuto dalla firma): salta il rendering
+        grayscale: Immagine in scala di grigi (default); False per le regole
+                   con override 'keep_color'
         
     Returns:
-        Prompt completo con eventuali aggiunte e grounding
+        Dizionario con SOLO i campi mancanti estratti
+        
+    Raises:
+        ValueError: Se l'estrazione AI fallisce o non completa i campi mancanti
     """
-    prompt = BASE_PROMPT
+    logger.info("🤖 AI fallback mirato per campi mancanti: %s", missing_fields)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("   Campi già estratti dal layout (NON modificabili): %s", list(already_extracted.keys()))
     
-    # Aggiungi regole specifiche se presenti
-    if rule_name:
-        additions = build_prompt_additions(rule_name)
-        if additions:
-            prompt += additions
+    targeted_prompt = _build_missing_fields_prompt(
+        missing_fields, already_extracted, pdf_text, text_extraction_result
+    )
     
-    # Aggiungi informazioni sulle annotazioni grafiche se disponibili
-    if annotations:
-        prompt += """
+    # Stesso PDF + stesso prompt → riusa la risposta in cache senza chiamare OpenAI
+    cache_key = make_cache_key(pdf_bytes, targeted_prompt, missing_fields, grayscale)
+    ai_raw_data = get_cached_response(cache_key)
+    
+    if ai_raw_data is None:
+        messages = _build_missing_fields_messages(
+            targeted_prompt, pdf_bytes, pdf_doc, page0_image, grayscale
+        )
+        
+        # Chiama OpenAI Vision (attesa di rete: PyMuPDF libero per gli altri documenti)
+        try:
+            with _fitz_guard.released():
+                content = _stream_vision_content(
+                    model=MODEL,
+                    messages=messages,
+                    response_format=_vision_response_format(tuple(missing_fields)),
+                    temperature=0.1,
+                )
+        except _VISION_CALL_ERRORS as e:
+            logger.error(f"Errore API OpenAI durante fallback mirato: {e}")
+            raise ValueError(f"Errore durante estrazione AI campi mancanti: {str(e)}") from e
+        
+        ai_raw_data = _parse_missing_fields_response(content)
+        set_cached_response(cache_key, ai_raw_data)
+    
+    return _normalize_missing_fields(ai_raw_data, missing_fields)
+
+
+async def extract_missing_fields_with_ai_async(
+    file_path: str,
+    missing_fields: list[str],
+    already_extracted: dict,
+    pdf_bytes: bytes,
+    pdf_text: Optional[str] = None,
+    text_extraction_result: Optional[Any] = None,
+    pdf_doc: Optional[Any] = None,
+    page0_image: Optional[bytes] = None,
+    grayscale: bool = True
+) -> dict:
+    """
+    Versione asincrona di extract_missing_fields_with_ai.
+    
+    Usa AsyncOpenAI: più documenti possono attendere la risposta Vision
+    in parallelo invece di serializzarsi. Le chiamate concorrenti sono
+    limitate da un semaforo (MAX_CONCURRENT_VISION).
+    
+    Args/Returns/Raises: come extract_missing_fields_with_ai
+    """
+    logger.info("🤖 AI fallback mirato (async) per campi mancanti: %s", missing_fields)
+    
+    targeted_prompt = _build_missing_fields_prompt(
+        missing_fields, already_extracted, pdf_text, text_extraction_result
+    )
+    cache_key = make_cache_key(pdf_bytes, targeted_prompt, missing_fields, grayscale)
+    ai_raw_data = await asyncio.to_thread(get_cached_response, cache_key)
+    
+    if ai_raw_data is None:
+        # Rendering CPU-bound: fuori dall'event loop
+        messages = await asyncio.to_thread(
+            _build_missing_fields_messages,
+            targeted_prompt, pdf_bytes, pdf_doc, page0_image, grayscale
+        )
+        
+        aclient, semaphore = _get_async_vision_resources()
+        try:
+            async with semaphore:
+                content = await _stream_vision_content_async(
+                    aclient,
+                    model=MODEL,
+                    messages=messages,
+                    response_format=_vision_response_format(tuple(missing_fields)),
+                    temperature=0.1,
+                )
+        except _VISION_CALL_ERRORS as e:
+            logger.error(f"Errore API OpenAI durante fallback mirato (async): {e}")
+            raise ValueError(f"Errore durante estrazione AI campi mancanti: {str(e)}") from e
+        
+        ai_raw_data = _parse_missing_fields_response(content)
+        await asyncio.to_thread(set_cached_response, cache_key, ai_raw_data)
+    
+    return _normalize_missing_fields(ai_raw_data, missing_fields)
+
+
+# Invariante per la prompt cache di OpenAI (basata sul prefisso): il primo messaggio
+# di ogni richiesta Vision è sempre BASE_PROMPT invariato (costruito una volta sola),
+# seguito dalle istruzioni della regola (identiche per tutti i DDT dello stesso
+# fornitore). Annotazioni e testo del documento vanno solo nel turno utente.
+_BASE_SYSTEM_MESSAGE = {"role": "system", "content": BASE_PROMPT}
+
+
+@functools.lru_cache(maxsize=128)
+def _system_messages_for(rule_additions: str) -> tuple[Dict[str, str], ...]:
+    """Messaggi di sistema della richiesta Vision: BASE_PROMPT + istruzioni della regola (se presenti)"""
+    if not rule_additions:
+        return (_BASE_SYSTEM_MESSAGE,)
+    return (_BASE_SYSTEM_MESSAGE, {"role": "system", "content": rule_additions})
+
+
+# Parti fisse del blocco annotazioni (costanti di modulo, non ricostruite a ogni prompt)
+_ANNOTATIONS_HEADER = """
 
 ---
 🎯 ANNOTAZIONI GRAFICHE (POSIZIONI INDICATE DALL'UTENTE):
@@ -348,31 +1159,39 @@ L'utente ha indicato graficamente dove si trovano i dati nel documento.
 Usa queste informazioni come riferimento per cercare i dati nelle aree indicate.
 
 """
-        field_labels = {
-            'data': 'Data DDT',
-            'mittente': 'Mittente',
-            'destinatario': 'Destinatario',
-            'numero_documento': 'Numero Documento',
-            'totale_kg': 'Totale Kg'
-        }
-        
-        for field, rect in annotations.items():
-            field_label = field_labels.get(field, field)
-            prompt += f"- **{field_label}**: Cerca nell'area approssimativa alle coordinate (x: {rect.get('x', 0):.0f}, y: {rect.get('y', 0):.0f}, larghezza: {rect.get('width', 0):.0f}, altezza: {rect.get('height', 0):.0f})\n"
-        
-        prompt += """
+_ANNOTATIONS_FOOTER = """
 ⚠️ NOTA: Le coordinate sono relative all'immagine del documento. 
 Cerca i dati nelle aree indicate, ma verifica sempre che i dati estratti siano corretti.
 """
+
+
+@functools.lru_cache(maxsize=128)
+def _build_document_context_cached(annotations: tuple, text_preview: Optional[str]) -> str:
+    """
+    Assembla la parte del prompt specifica del documento da input già normalizzati e hashable
+    
+    Memoizzato: documenti dello stesso mittente/template rielaborati in batch
+    producono lo stesso testo senza riassemblarlo.
+    
+    Args:
+        annotations: Tuple (campo, x, y, larghezza, altezza) dei riquadri annotati
+        text_preview: Testo di grounding già troncato, o None
+    """
+    parts = []
+    
+    # Aggiungi informazioni sulle annotazioni grafiche se disponibili
+    if annotations:
+        parts.append(_ANNOTATIONS_HEADER)
+        parts.append("".join(
+            f"- **{FIELD_LABELS.get(field, field)}**: Cerca nell'area approssimativa alle coordinate "
+            f"(x: {x:.0f}, y: {y:.0f}, larghezza: {width:.0f}, altezza: {height:.0f})\n"
+            for field, x, y, width, height in annotations
+        ))
+        parts.append(_ANNOTATIONS_FOOTER)
     
     # Aggiungi grounding del testo estratto se disponibile e affidabile
-    if extracted_text and extracted_text.strip():
-        # Limita la lunghezza del testo per evitare prompt troppo lunghi
-        text_preview = extracted_text[:2000] if len(extracted_text) > 2000 else extracted_text
-        if len(extracted_text) > 2000:
-            text_preview += "\n... (testo troncato)"
-        
-        prompt += f"""
+    if text_preview:
+        parts.append(f"""
 
 ---
 📄 TESTO ESTRATTO AUTOMATICAMENTE DAL PDF (RIFERIMENTO):
@@ -386,36 +1205,260 @@ Cerca i dati nelle aree indicate, ma verifica sempre che i dati estratti siano c
 - Il testo serve come RIFERIMENTO per migliorare la precisione, non come fonte unica
 - Se ci sono discrepanze tra testo e immagine, privilegia SEMPRE l'immagine
 - Verifica attentamente numeri, date e nomi aziende confrontandoli con il documento visivo
-"""
+""")
+    
+    return "".join(parts)
+
+
+def build_document_context(extracted_text: Optional[str] = None, annotations: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Costruisce la parte del prompt specifica del documento: annotazioni e grounding del testo
+    
+    Va inviata nel turno utente, DOPO i messaggi di sistema (BASE_PROMPT e
+    istruzioni della regola): il prefisso della richiesta resta identico per
+    tutti i documenti della stessa regola e la prompt cache di OpenAI viene riusata.
+    
+    Args:
+        extracted_text: Testo estratto automaticamente per grounding (opzionale)
+        annotations: Dizionario con coordinate dei riquadri annotati dall'utente (opzionale)
+                    Formato: {field: {x, y, width, height}}
+        
+    Returns:
+        Testo specifico del documento (stringa vuota se non c'è nulla da aggiungere)
+    """
+    annotations_key = tuple(
+        (field, rect.get('x', 0), rect.get('y', 0), rect.get('width', 0), rect.get('height', 0))
+        for field, rect in annotations.items()
+    ) if annotations else ()
+    # Limita la lunghezza del testo per evitare prompt troppo lunghi
+    text_preview = (_truncate_for_prompt(extracted_text) or None) if extracted_text else None
+    return _build_document_context_cached(annotations_key, text_preview)
+
+
+def build_prompt_context(rule_name: Optional[str] = None, extracted_text: Optional[str] = None, annotations: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Costruisce la parte variabile del prompt: regole aggiuntive, annotazioni e grounding del testo
+    
+    Args:
+        rule_name: Nome della regola da applicare (opzionale)
+        extracted_text: Testo estratto automaticamente per grounding (opzionale)
+        annotations: Dizionario con coordinate dei riquadri annotati dall'utente (opzionale)
+                    Formato: {field: {x, y, width, height}}
+        
+    Returns:
+        Testo da accodare a BASE_PROMPT (stringa vuota se non c'è nulla da aggiungere)
+    """
+    additions = build_prompt_additions(rule_name) if rule_name else ""
+    return additions + build_document_context(extracted_text, annotations)
+
+
+def build_dynamic_prompt(rule_name: Optional[str] = None, extracted_text: Optional[str] = None, annotations: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Costruisce il prompt dinamico con eventuali regole aggiuntive e grounding del testo
     
-    return prompt
+    Args: come build_prompt_context
+        
+    Returns:
+        Prompt completo (BASE_PROMPT + parte variabile) in un unico testo
+    """
+    return BASE_PROMPT + build_prompt_context(rule_name, extracted_text, annotations)
+
+
+@dataclass
+class PDFArtifacts:
+    """
+    Artefatti intermedi di un PDF in elaborazione, calcolati una sola volta e su richiesta
+    
+    Hash del contenuto, documento PyMuPDF, risultato dell'estrazione testo e
+    rendering della prima pagina vengono materializzati al primo accesso e poi
+    riusati da tutte le fasi (rule detection, layout, Vision, anteprima).
+    Il documento va chiuso con close() al termine dell'elaborazione.
+    """
+    file_path: str
+    pdf_bytes: bytes
+    _digest: Optional[bytes] = field(default=None, repr=False)
+    _doc: Optional[Any] = field(default=None, repr=False)
+    _doc_opened: bool = field(default=False, repr=False)
+    _text_result: Optional[TextExtractionResult] = field(default=None, repr=False)
+    
+    @property
+    def digest(self) -> bytes:
+        """SHA256 del contenuto: chiave per cache testo, rendering e anteprima"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.pdf_bytes).digest()
+        return self._digest
+    
+    @property
+    def doc(self) -> Optional[Any]:
+        """fitz.Document aperto una sola volta (None se PyMuPDF manca o il PDF non è apribile)"""
+        if not self._doc_opened:
+            self._doc_opened = True
+            if _HAS_FITZ:
+                try:
+                    self._doc = fitz.open(stream=self.pdf_bytes, filetype="pdf")
+                except Exception as e:
+                    logger.debug("PDF non apribile con PyMuPDF: %s", e)
+        return self._doc
+    
+    @property
+    def page_count(self) -> int:
+        return self.doc.page_count if self.doc is not None else 1
+    
+    def ensure_text(self) -> TextExtractionResult:
+        """Risultato dell'estrazione testo (cache per contenuto, poi pipeline sul documento aperto)"""
+        if self._text_result is None:
+            pdf_hash = self.digest.hex()
+            result = get_cached_text_result(pdf_hash)
+            if result is None:
+                result = extract_text_pipeline(self.file_path, max_pages=5, enable_ocr=False, pdf_doc=self.doc)
+                set_cached_text_result(pdf_hash, result)
+            self._text_result = result
+        return self._text_result
+    
+    def ensure_page_pixmap(self) -> Any:
+        """Pixmap RGB della prima pagina (condiviso tramite la cache di rendering)"""
+        return _render_first_page_cached(self.pdf_bytes, self.doc, self.digest)
+    
+    def close(self) -> None:
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+
+
+# "1.250": solo separatori delle migliaia, senza decimali (ambiguo)
+_THOUSANDS_ONLY_RE = re.compile(r'\d{1,3}(?:\.\d{3})+')
+
+
+def _parse_italian_number(value: str) -> Optional[float]:
+    """
+    Converte un numero in formato italiano ("1.250,5", "1250,5", "1250.5") in float
+    
+    "1.250" senza virgola è ambiguo (migliaia o decimali): restituisce None.
+    """
+    value = value.replace(" ", "")
+    if "," in value:
+        value = value.replace(".", "").replace(",", ".")
+    elif _THOUSANDS_ONLY_RE.fullmatch(value):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _try_text_only_extract(pdf_text: str) -> Optional[Dict[str, Any]]:
+    """
+    Estrae i cinque campi direttamente dal testo del PDF, senza OpenAI Vision
+    
+    Conservativo: ogni campo deve comparire con un'etichetta esplicita (le
+    varianti elencate in BASE_PROMPT) e con un solo valore distinto nel testo;
+    basta un campo mancante, ambiguo o non normalizzabile per restituire None
+    e proseguire con Vision.
+    
+    Args:
+        pdf_text: Testo estratto dal PDF (affidabile)
+        
+    Returns:
+        Dati grezzi nel formato della risposta Vision, o None
+    """
+    values: Dict[str, str] = {}
+    for field, pattern in _TEXT_ONLY_PATTERNS:
+        found = {normalize_text(m.group(1)) for m in pattern.finditer(pdf_text)}
+        found.discard("")
+        if len(found) != 1:
+            return None
+        values[field] = found.pop()
+    
+    if normalize_date(values["data"]) is None:
+        return None
+    totale_kg = _parse_italian_number(values["totale_kg"])
+    if not totale_kg or totale_kg <= 0:
+        return None
+    mittente = clean_company_name(values["mittente"])
+    destinatario = clean_company_name(values["destinatario"])
+    if not mittente or not destinatario or mittente.casefold() == destinatario.casefold():
+        return None
+    
+    return {
+        "data": values["data"],
+        "mittente": mittente,
+        "destinatario": destinatario,
+        "numero_documento": values["numero_documento"],
+        "totale_kg": totale_kg,
+    }
+
+
+def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Estrae dati strutturati da un PDF DDT usando OpenAI Vision
+    
+    Args:
+        file_path: Percorso del file PDF
+        template_id: ID del template da applicare forzatamente (opzionale).
+                    Se specificato, salta il matching automatico e usa direttamente questo template.
+        
+    Returns:
+        Dizionario con i dati estratti e validati
+        
+    Raises:
+        ValueError: Se l'estrazione o validazione fallisce
+        OpenAIError: Se c'è un errore con l'API OpenAI
+        FileNotFoundError: Se il file PDF non esiste
+    """
+    return _run_extraction_steps(_extract_from_pdf_steps(file_path, template_id))
+
+
+def _advance_steps(step: Callable[..., Dict[str, Any]], *args: Any) -> tuple[bool, Dict[str, Any]]:
+    """
+    Fa avanzare il generatore di estrazione: (False, richiesta Vision) oppure
+    (True, risultato finale). StopIteration non può attraversare asyncio.to_thread,
+    quindi viene convertita qui.
+    
+    Ogni fase gira sotto _fitz_guard: le fasi di documenti diversi (thread diversi
+    nel percorso async) non usano PyMuPDF in concorrenza.
+    """
+    try:
+        with _fitz_guard.hold():
+            return False, step(*args)
+    except StopIteration as done:
+        return True, done.value
+
+
+def _run_extraction_steps(steps: Generator[Dict[str, Any], str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Esegue le fasi di estrazione con chiamate Vision sincrone"""
+    done, value = _advance_steps(next, steps)
+    while not done:
+        try:
+            content = _stream_vision_content(**value)
+        except Exception as e:
+            done, value = _advance_steps(steps.throw, e)
+        else:
+            done, value = _advance_steps(steps.send, content)
+    return value
 
-def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[str, Any]:
+
+def _extract_from_pdf_steps(
+    file_path: str,
+    template_id: Optional[str] = None
+) -> Generator[Dict[str, Any], str, Dict[str, Any]]:
     """
-    Estrae dati strutturati da un PDF DDT usando OpenAI Vision
+    Fasi di extract_from_pdf come generatore
     
-    Args:
-        file_path: Percorso del file PDF
-        template_id: ID del template da applicare forzatamente (opzionale).
-                    Se specificato, salta il matching automatico e usa direttamente questo template.
-        
-    Returns:
-        Dizionario con i dati estratti e validati
-        
-    Raises:
-        ValueError: Se l'estrazione o validazione fallisce
-        OpenAIError: Se c'è un errore con l'API OpenAI
-        FileNotFoundError: Se il file PDF non esiste
+    La parte CPU/disco (lettura, testo, layout, rendering) gira fino alla
+    chiamata Vision, di cui viene restituita (yield) la richiesta: il chiamante
+    la esegue in modo sincrono o asincrono e rimanda il contenuto della risposta
+    con send() (o l'errore con throw()). Il risultato finale è il valore di ritorno.
     """
     if not file_path:
         raise ValueError("Il percorso del file non può essere vuoto")
     
+    artifacts: Optional[PDFArtifacts] = None
+    layout_rule_name: Optional[str] = None
+    box_extracted_data: Optional[Dict[str, Any]] = None
     try:
         # Leggi il file PDF
-        from app.paths import safe_open
         file_path_obj = Path(file_path)
         if not file_path_obj.is_absolute():
-            from app.paths import get_base_dir
             file_path_obj = get_base_dir() / file_path_obj
         file_path_obj = file_path_obj.resolve()
         
@@ -425,35 +1468,30 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
         if not pdf_bytes:
             raise ValueError(f"Il file {file_path} è vuoto")
         
-        logger.info(f"Elaborazione PDF: {file_path} ({len(pdf_bytes)} bytes)")
+        logger.info("Elaborazione PDF: %s (%d bytes)", file_path, len(pdf_bytes))
         
-        # Controlla numero di pagine per layout rule matching
-        try:
-            import fitz
-            doc_temp = fitz.open(stream=pdf_bytes, filetype="pdf")
-            page_count = len(doc_temp)
-            doc_temp.close()
-        except:
-            page_count = 1
+        # Apri il PDF una sola volta con PyMuPDF: lo stesso documento serve per
+        # estrazione testo, conteggio pagine (layout rule matching) e rendering Vision
+        artifacts = PDFArtifacts(file_path, pdf_bytes)
+        pdf_doc = artifacts.doc
+        page_count = artifacts.page_count
         
-        # Estrai testo usando la nuova pipeline intelligente
-        text_extraction_result = extract_text_pipeline(file_path, max_pages=5, enable_ocr=False)
-        pdf_text = text_extraction_result.text if text_extraction_result else ""
+        # Testo estratto solo quando serve: un layout model riconosciuto senza testo
+        # (geometria o nome file) evita l'intera pipeline di estrazione
+        text_extraction_result: Optional[TextExtractionResult] = None
+        pdf_text = ""
         
         # Carica layout rules (usa cache automatica per performance)
-        from app.layout_rules.manager import load_layout_rules, match_layout_rule, normalize_sender, detect_layout_model_advanced
         layout_rules_loaded = load_layout_rules()
         
         # FASE 1: PRE-DETECTION AVANZATA DEL LAYOUT MODEL
         # Se template_id è specificato, FORZA l'applicazione di quel template (skip matching automatico)
         layout_rule = None
-        layout_rule_name = None
         extraction_mode = None
-        box_extracted_data = None  # Inizializza sempre per evitare errori
         
         if template_id and template_id.strip():
             # TEMPLATE FORZATO: applica direttamente il template specificato dall'operatore
-            logger.info(f"🎯 TEMPLATE FORZATO dall'operatore: '{template_id}' - Skip matching automatico")
+            logger.info("🎯 TEMPLATE FORZATO dall'operatore: '%s' - Skip matching automatico", template_id)
             if template_id not in layout_rules_loaded:
                 error_msg = f"Template '{template_id}' non trovato nei layout rules disponibili"
                 logger.error(f"❌ {error_msg}")
@@ -462,39 +1500,46 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
             layout_rule = layout_rules_loaded[template_id]
             layout_rule_name = template_id
             extraction_mode = "LAYOUT_MODEL_FORCED"
-            logger.info(f"📐 TEMPLATE FORZATO APPLICATO: '{layout_rule_name}'")
-            logger.info(f"   Supplier modello: '{layout_rule.match.supplier}'")
-            logger.info(f"   Fields disponibili: {list(layout_rule.fields.keys())}")
-            logger.info(f"   Page count modello: {layout_rule.match.page_count or 'Tutte'}")
-            logger.info(f"   Page count documento: {page_count}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("📐 TEMPLATE FORZATO APPLICATO: '%s'", layout_rule_name)
+                logger.info("   Supplier modello: '%s'", layout_rule.match.supplier)
+                logger.info("   Fields disponibili: %s", list(layout_rule.fields.keys()))
+                logger.info("   Page count modello: %s", layout_rule.match.page_count or 'Tutte')
+                logger.info("   Page count documento: %s", page_count)
         else:
             # MATCHING AUTOMATICO: usa multiple strategie (keyword, nome file, testo) PRIMA dell'estrazione AI
-            logger.debug(f"🔍 Fase pre-detection layout model (matching automatico)...")
-            detection_result = detect_layout_model_advanced(pdf_text, file_path, page_count)
+            logger.debug("🔍 Fase pre-detection layout model (matching automatico)...")
+            detection_result = detect_layout_model_without_text(file_path, page_count)
+            if detection_result is None:
+                # Pre-check mancato: serve il testo (rilevamento regole, grounding, matching testuale)
+                text_extraction_result = artifacts.ensure_text()
+                pdf_text = text_extraction_result.text if text_extraction_result else ""
+                detection_result = detect_layout_model_advanced(pdf_text, file_path, page_count, skip_geometry=True)
             
             if detection_result:
                 layout_rule_name, layout_rule = detection_result
-                logger.info(f"📐 LAYOUT MODEL MATCHED: '{layout_rule_name}'")
-                logger.info(f"   Supplier modello: '{layout_rule.match.supplier}'")
-                logger.info(f"   Fields disponibili: {list(layout_rule.fields.keys())}")
-                logger.info(f"   Page count modello: {layout_rule.match.page_count or 'Tutte'}")
-                logger.info(f"   Page count documento: {page_count}")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("📐 LAYOUT MODEL MATCHED: '%s'", layout_rule_name)
+                    logger.info("   Supplier modello: '%s'", layout_rule.match.supplier)
+                    logger.info("   Fields disponibili: %s", list(layout_rule.fields.keys()))
+                    logger.info("   Page count modello: %s", layout_rule.match.page_count or 'Tutte')
+                    logger.info("   Page count documento: %s", page_count)
                 extraction_mode = "LAYOUT_MODEL"
             else:
-                logger.info(f"❌ LAYOUT MODEL SKIPPED: nessun match trovato nella pre-detection")
-                logger.info(f"   Motivo: nessun layout model ha superato la soglia di similarity")
+                logger.info("❌ LAYOUT MODEL SKIPPED: nessun match trovato nella pre-detection")
+                logger.info("   Motivo: nessun layout model ha superato la soglia di similarity")
                 extraction_mode = "AI_FALLBACK_FULL"
         
         # HARD FAILOVER: Se layout model matcha o è forzato, USA SOLO BOX EXTRACTION, NON chiamare LLM
         if layout_rule:
             supplier_name = layout_rule.match.supplier
             mode_label = "FORCED" if extraction_mode == "LAYOUT_MODEL_FORCED" else "MATCHED"
-            logger.info(f"📐 LAYOUT MODEL APPLIED ({mode_label}): '{layout_rule_name}' - Using LAYOUT_MODEL extraction mode (NO LLM)")
-            logger.info(f"   Supplier: '{supplier_name}'")
-            logger.info(f"   Fields disponibili nel modello: {list(layout_rule.fields.keys())}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("📐 LAYOUT MODEL APPLIED (%s): '%s' - Using LAYOUT_MODEL extraction mode (NO LLM)", mode_label, layout_rule_name)
+                logger.info("   Supplier: '%s'", supplier_name)
+                logger.info("   Fields disponibili nel modello: %s", list(layout_rule.fields.keys()))
             
             # FIX #2: Verifica OCR disponibilità PRIMA di tentare estrazione
-            from app.text_extraction.ocr_fallback import is_ocr_available
             ocr_available = is_ocr_available()
             
             if not ocr_available:
@@ -506,7 +1551,7 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                 raise ValueError(error_msg)
             
             try:
-                box_raw_data = extract_with_layout_rule(file_path, layout_rule, supplier_name, page_count)
+                box_raw_data = extract_with_layout_rule(file_path, layout_rule, supplier_name, page_count, pdf_doc=pdf_doc)
                 
                 # FIX #2: Distingui fallimento temporaneo (OCR) vs permanente (box vuoti)
                 if not box_raw_data:
@@ -523,8 +1568,9 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                 # Log diagnostico: campi estratti vs disponibili
                 total_fields = len(layout_rule.fields)
                 extracted_fields = len(box_extracted_data)
-                logger.info(f"✅ Dati estratti da box: {list(box_extracted_data.keys())}")
-                logger.info(f"📊 Box extraction stats: {extracted_fields}/{total_fields} campi estratti")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("✅ Dati estratti da box: %s", list(box_extracted_data.keys()))
+                logger.info("📊 Box extraction stats: %s/%s campi estratti", extracted_fields, total_fields)
                 
                 # Valida i dati estratti dai box
                 try:
@@ -537,8 +1583,7 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                         logger.warning(f"Errore applicazione suggerimenti apprendimento: {e}")
                     
                     # Valida usando Pydantic
-                    ddt_data = DDTData(**normalized_data)
-                    result = ddt_data.model_dump()
+                    result = _validate_ddt_data(normalized_data)
                     
                     # Imposta extraction_mode corretto: template forzato senza AI → STRICT
                     if extraction_mode == "LAYOUT_MODEL_FORCED":
@@ -550,9 +1595,9 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                     # Aggiungi extraction_mode e ai_fallback_used al risultato per audit trail
                     result["_extraction_mode"] = extraction_mode
                     result["_ai_fallback_used"] = False  # Nessun AI fallback usato
-                    logger.info(f"✅ Dati validati con successo (estrazione box)")
-                    logger.info(f"📊 Extraction mode used: {extraction_mode}")
-                    logger.info(f"📐 LAYOUT MODEL APPLIED: '{layout_rule_name}' - Estrazione completata senza AI")
+                    logger.info("✅ Dati validati con successo (estrazione box)")
+                    logger.info("📊 Extraction mode used: %s", extraction_mode)
+                    logger.info("📐 LAYOUT MODEL APPLIED: '%s' - Estrazione completata senza AI", layout_rule_name)
                     return result
                 except ValidationError as e:
                     # NUOVA STRATEGIA: Partial Layout Extraction con fallback AI mirato
@@ -578,12 +1623,14 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                             )
                         
                         # Estrazione parziale: almeno 1 campo estratto → fallback AI mirato
-                        logger.info(f"📐 Layout model '{layout_rule_name}' estrazione parziale: {extracted_count}/{total_required_fields} campi")
+                        logger.info("📐 Layout model '%s' estrazione parziale: %s/%s campi", layout_rule_name, extracted_count, total_required_fields)
                         logger.warning(f"⚠️ Campi mancanti dal layout model: {missing_fields} → fallback AI mirato")
                         
                         # Prepara dati per fallback AI (serve pdf_bytes e pdf_text)
-                        # NOTA: pdf_bytes e pdf_text sono già disponibili nel contesto della funzione extract_from_pdf
-                        # Li passeremo alla funzione extract_missing_fields_with_ai
+                        # Il testo potrebbe non essere ancora stato estratto (layout riconosciuto senza testo)
+                        if text_extraction_result is None:
+                            text_extraction_result = artifacts.ensure_text()
+                            pdf_text = text_extraction_result.text if text_extraction_result else ""
                         
                         # Estrai campi mancanti con AI
                         try:
@@ -593,14 +1640,18 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                                 already_extracted=box_extracted_data,
                                 pdf_bytes=pdf_bytes,
                                 pdf_text=pdf_text,
-                                text_extraction_result=text_extraction_result
+                                text_extraction_result=text_extraction_result,
+                                pdf_doc=pdf_doc,
+                                # Come nel percorso Vision completo: colori solo per le regole 'keep_color'
+                                grayscale=not rule_keeps_color(detect_rule(pdf_text) if pdf_text else None)
                             )
                             
                             # Unisci risultati: layout (priorità) + AI (solo mancanti)
                             # REGOLA FERREA: Layout ha priorità, AI NON sovrascrive campi layout
                             hybrid_data = {**box_extracted_data, **ai_missing_data}
                             
-                            logger.info(f"🤖 AI fallback completato per campi: {list(ai_missing_data.keys())}")
+                            if logger.isEnabledFor(logging.INFO):
+                                logger.info("🤖 AI fallback completato per campi: %s", list(ai_missing_data.keys()))
                             
                             # Applica suggerimenti di apprendimento automatico al risultato ibrido
                             try:
@@ -610,8 +1661,7 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                                 logger.warning(f"Errore applicazione suggerimenti apprendimento: {e}")
                             
                             # Valida il risultato finale completo
-                            ddt_data = DDTData(**hybrid_data)
-                            result = ddt_data.model_dump()
+                            result = _validate_ddt_data(hybrid_data)
                             
                             # Imposta extraction_mode corretto quando viene usato AI fallback
                             if extraction_mode == "LAYOUT_MODEL_FORCED":
@@ -626,10 +1676,11 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                             result["_extraction_mode"] = extraction_mode
                             result["_ai_fallback_used"] = True  # AI fallback usato per completare campi mancanti
                             result["_ai_fallback_fields"] = list(ai_missing_data.keys())  # Campi completati via AI
-                            logger.info(f"✅ Documento completato con strategia {extraction_mode}")
-                            logger.info(f"📊 Extraction mode used: {extraction_mode}")
-                            logger.info(f"🤖 AI fallback usato per campi: {list(ai_missing_data.keys())}")
-                            logger.info(f"📐 Layout model '{layout_rule_name}': {extracted_count} campi da box + {len(ai_missing_data)} campi da AI")
+                            logger.info("✅ Documento completato con strategia %s", extraction_mode)
+                            logger.info("📊 Extraction mode used: %s", extraction_mode)
+                            if logger.isEnabledFor(logging.INFO):
+                                logger.info("🤖 AI fallback usato per campi: %s", list(ai_missing_data.keys()))
+                            logger.info("📐 Layout model '%s': %s campi da box + %s campi da AI", layout_rule_name, extracted_count, len(ai_missing_data))
                             return result
                             
                         except ValueError as ai_error:
@@ -645,7 +1696,7 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                             error_msg = (
                                 f"Errore durante AI fallback per campi mancanti {missing_fields}: {ai_error}"
                             )
-                            logger.error(f"❌ {error_msg}", exc_info=True)
+                            logger.error(f"❌ {error_msg}", exc_info=logger.isEnabledFor(logging.DEBUG))
                             raise ValueError(error_msg) from ai_error
                     else:
                         # Campi presenti ma invalidi → fallback AI per correzione
@@ -664,7 +1715,7 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                 # ValueError espliciti (OCR non disponibile, box vuoti, campi mancanti) → rilanciare
                 raise
             except Exception as e:
-                logger.error(f"❌ Errore estrazione con layout rule: {e}", exc_info=True)
+                logger.error(f"❌ Errore estrazione con layout rule: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
                 error_msg = f"Errore durante estrazione con layout model '{layout_rule_name}': {e}"
                 raise ValueError(error_msg) from e
         
@@ -678,7 +1729,6 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
             logger.error(f"   Questo non dovrebbe mai accadere - tutti i casi dovrebbero essere gestiti sopra")
             
             # Distingui motivo fallimento per log chiaro
-            from app.text_extraction.ocr_fallback import is_ocr_available
             ocr_available = is_ocr_available()
             
             if not ocr_available:
@@ -687,13 +1737,13 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                     f"Installa pytesseract e tesseract-ocr: pip install pytesseract && apt-get install tesseract-ocr"
                 )
                 logger.error(f"   Motivo fallimento: OCR non disponibile")
-            elif 'box_extracted_data' in locals() and not box_extracted_data:
+            elif not box_extracted_data:
                 error_msg = (
                     f"Layout model '{layout_rule_name}' matchato ma box extraction vuota. "
                     f"Verifica che i box siano corretti nel layout model."
                 )
                 logger.error(f"   Motivo fallimento: box extraction vuota")
-            elif 'box_extracted_data' in locals():
+            elif box_extracted_data is not None:
                 error_msg = (
                     f"Layout model '{layout_rule_name}' matchato ma validazione fallita. "
                     f"Dati parziali estratti: {list(box_extracted_data.keys())}"
@@ -725,129 +1775,111 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
         rule_name = detect_rule(pdf_text) if pdf_text else None
         
         if rule_name:
-            logger.info(f"Regola '{rule_name}' rilevata per questo documento")
+            logger.info("Regola '%s' rilevata per questo documento", rule_name)
         else:
             logger.info("Nessuna regola specifica rilevata, uso prompt standard")
         
-        # Prova a ottenere annotazioni grafiche basate su un'estrazione preliminare del mittente
-        # (se disponibile dal testo estratto, solo se non abbiamo già dati dai box)
-        annotations = None
-        if pdf_text and not box_extracted_data:
-            # Estrai un possibile mittente dal testo per cercare annotazioni simili
-            # Questo è un tentativo preliminare, le annotazioni verranno usate se disponibili
-            try:
-                # Cerca pattern comuni di mittente nel testo
-                import re
-                mittente_patterns = [
-                    r'(?:Mittente|Da:|Fornitore|Spett\.le)\s*:?\s*([A-Z][A-Za-z0-9\s&\.]+)',
-                    r'([A-Z][A-Za-z0-9\s&\.]+)\s*(?:S\.r\.l\.|S\.p\.A\.|S\.A\.S\.|S\.A\.)',
-                ]
-                potential_mittente_ann = None
-                for pattern in mittente_patterns:
-                    match = re.search(pattern, pdf_text[:500], re.IGNORECASE)
-                    if match:
-                        potential_mittente_ann = match.group(1).strip()
-                        break
+        # Scala di grigi di default (DDT quasi monocromatici): immagine ~3x più piccola.
+        # Le regole con override 'keep_color' (timbri/loghi significativi) restano a colori.
+        grayscale = not rule_keeps_color(rule_name)
+        
+        # Percorso solo testo (opzionale): PDF nativo con testo affidabile, nessuna regola
+        # specifica e tutti i campi trovati senza ambiguità → niente rendering né Vision
+        raw_data = None
+        # Chiave cache Vision da scrivere solo dopo una validazione riuscita (risposta nuova)
+        vision_cache_key: Optional[str] = None
+        # Richiesta Vision effettuata (None se i dati vengono da testo o cache): base dei retry con feedback
+        vision_request: Optional[Dict[str, Any]] = None
+        content: Optional[str] = None
+        if TEXT_ONLY_EXTRACTION and not rule_name and text_extraction_result and text_extraction_result.is_reliable:
+            raw_data = _try_text_only_extract(pdf_text)
+            if raw_data is not None:
+                extraction_mode = "TEXT_ONLY"
+                logger.info("⚡ Tutti i campi trovati nel testo del PDF: chiamata Vision saltata")
+        
+        if raw_data is None:
+            # Prova a ottenere annotazioni grafiche basate su un'estrazione preliminare del mittente
+            # (se disponibile dal testo estratto, solo se non abbiamo già dati dai box)
+            annotations = None
+            if pdf_text and not box_extracted_data:
+                # Estrai un possibile mittente dal testo per cercare annotazioni simili
+                # Questo è un tentativo preliminare, le annotazioni verranno usate se disponibili
+                try:
+                    # Cerca pattern comuni di mittente nell'intestazione del testo
+                    # endpos limita la ricerca all'intestazione senza copiare il testo.
+                    # Nessuna correzione con annotazioni (caso tipico): ricerca saltata
+                    potential_mittente_ann = None
+                    if has_any_annotations():
+                        for pattern in _MITTENTE_PATTERNS:
+                            match = pattern.search(pdf_text, 0, _MITTENTE_SEARCH_CHARS)
+                            if match:
+                                potential_mittente_ann = match.group(1).strip()
+                                break
                 
-                if potential_mittente_ann:
-                    annotations = get_annotations_for_mittente(potential_mittente_ann)
-                    if annotations:
-                        logger.info(f"Trovate annotazioni grafiche per mittente simile: {potential_mittente_ann}")
-            except Exception as e:
-                logger.debug(f"Errore ricerca annotazioni preliminari: {e}")
+                    if potential_mittente_ann:
+                        annotations = get_annotations_for_mittente(potential_mittente_ann)
+                        if annotations:
+                            logger.info("Trovate annotazioni grafiche per mittente simile: %s", potential_mittente_ann)
+                except Exception as e:
+                    logger.debug("Errore ricerca annotazioni preliminari: %s", e)
         
-        # Costruisci prompt dinamico con grounding del testo (se affidabile) e annotazioni
-        extracted_text_for_grounding = pdf_text if (text_extraction_result and text_extraction_result.is_reliable) else None
-        dynamic_prompt = build_dynamic_prompt(rule_name, extracted_text=extracted_text_for_grounding, annotations=annotations)
+            # Costruisci prompt dinamico con grounding del testo (se affidabile) e annotazioni
+            extracted_text_for_grounding = pdf_text if (text_extraction_result and text_extraction_result.is_reliable) else None
+            # Istruzioni della regola nel prefisso di sistema (stabile per fornitore),
+            # annotazioni e testo del documento nel turno utente
+            rule_additions = build_prompt_additions(rule_name).strip() if rule_name else ""
+            document_context = build_document_context(extracted_text_for_grounding, annotations).strip()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Prompt Vision: ~%s token di testo (prefisso fisso ~%s)",
+                    _BASE_PROMPT_LEN_TOKENS + (len(rule_additions) + len(document_context)) // 4,
+                    _BASE_PROMPT_LEN_TOKENS,
+                )
         
-        # Converti PDF in immagini (OpenAI Vision richiede immagini, non PDF)
-        # Prova prima PyMuPDF (non richiede Poppler), poi pdf2image come fallback
-        img_b64 = None
-        image_format = "image/png"
+            # Stesso PDF + stesso prompt completo (regola, annotazioni, grounding) e stessi
+            # parametri di modello/rendering → risposta Vision dalla cache, senza rendering
+            # né chiamata. In cache va la risposta grezza: normalizzazione e suggerimenti
+            # di apprendimento vengono sempre riapplicati.
+            vision_cache_key = make_cache_key(
+                pdf_bytes, f"{BASE_PROMPT}\0{rule_additions}\0{document_context}", list(FIELD_DESCRIPTIONS),
+                grayscale,
+            )
+            raw_data = get_cached_response(vision_cache_key)
+            if raw_data is not None:
+                vision_cache_key = None
         
-        # Metodo 1: Prova con PyMuPDF (fitz) - migliore per Windows, non richiede Poppler
-        try:
-            import fitz  # PyMuPDF
-            from io import BytesIO
-            
-            logger.info("Conversione PDF in immagine con PyMuPDF...")
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            if len(doc) == 0:
-                raise ValueError("PDF vuoto o non valido")
-            
-            # Converti la prima pagina in immagine
-            page = doc[0]
-            # Matrice di trasformazione per DPI 200 (200/72 = 2.78)
-            zoom = 200 / 72.0
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Converti in PNG
-            img_bytes = pix.tobytes("png")
-            img_b64 = base64.b64encode(img_bytes).decode()
-            doc.close()
-            logger.info(f"PDF convertito in immagine PNG con PyMuPDF ({len(img_bytes)} bytes)")
-            
-        except ImportError:
-            logger.warning("PyMuPDF non disponibile, provo con pdf2image...")
-            # Metodo 2: Fallback a pdf2image (richiede Poppler su Windows)
-            try:
-                from pdf2image import convert_from_bytes
-                from io import BytesIO
-                
-                logger.info("Conversione PDF in immagine con pdf2image...")
-                images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
-                if not images:
-                    raise ValueError("Impossibile convertire il PDF in immagine")
-                
-                img_buffer = BytesIO()
-                images[0].save(img_buffer, format='PNG')
-                img_bytes = img_buffer.getvalue()
-                img_b64 = base64.b64encode(img_bytes).decode()
-                logger.info(f"PDF convertito in immagine PNG con pdf2image ({len(img_bytes)} bytes)")
-                
-            except ImportError:
-                error_msg = "Nessuna libreria disponibile per convertire PDF. Installa PyMuPDF (consigliato) o pdf2image+Poppler"
-                logger.error(error_msg)
-                raise ImportError(error_msg)
-            except Exception as e:
-                error_msg = f"Errore conversione PDF con pdf2image: {e}. Suggerimento: su Windows installa Poppler o usa PyMuPDF"
-                logger.error(error_msg, exc_info=True)
-                raise ValueError(error_msg) from e
-        except Exception as e:
-            logger.warning(f"Errore conversione PDF con PyMuPDF: {e}, provo fallback...")
-            # Fallback a pdf2image se PyMuPDF fallisce
-            try:
-                from pdf2image import convert_from_bytes
-                from io import BytesIO
-                
-                logger.info("Conversione PDF in immagine con pdf2image (fallback)...")
-                images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
-                if not images:
-                    raise ValueError("Impossibile convertire il PDF in immagine")
-                
-                img_buffer = BytesIO()
-                images[0].save(img_buffer, format='PNG')
-                img_bytes = img_buffer.getvalue()
-                img_b64 = base64.b64encode(img_bytes).decode()
-                logger.info(f"PDF convertito in immagine PNG con pdf2image (fallback) ({len(img_bytes)} bytes)")
-            except Exception as e2:
-                error_msg = f"Errore conversione PDF: PyMuPDF fallito ({e}), pdf2image fallito ({e2})"
-                logger.error(error_msg, exc_info=True)
-                raise ValueError(error_msg) from e2
-        
-        if not img_b64:
-            raise ValueError("Impossibile convertire il PDF in immagine con nessun metodo disponibile")
-        
-        # Chiama OpenAI Vision
-        try:
-            response: ChatCompletion = client.chat.completions.create(
+        if raw_data is None:
+            # Converti PDF in immagini (OpenAI Vision richiede immagini, non PDF)
+            # JPEG di default (DCT più veloce di DEFLATE e file molto più piccolo per le scansioni);
+            # PNG per le pagine vettoriali/monocromatiche, dove è più piccolo e senza artefatti
+            use_jpeg = VISION_IMAGE_FORMAT == "jpeg"
+        
+            def _render_for_vision() -> tuple[bytes, bool]:
+                # Un solo rendering della prima pagina (condiviso via cache con il
+                # fallback AI mirato); l'anteprima per il browser ha un rendering proprio
+                if pdf_doc is None:
+                    raise ValueError("PDF non apribile con PyMuPDF")
+                return _encode_vision_pixmap(pdf_doc[0], artifacts.ensure_page_pixmap(), grayscale)
+        
+            # PyMuPDF (non richiede Poppler), poi pdf2image come fallback
+            img_bytes, is_jpeg = _render_first_page(
+                pdf_bytes, _render_for_vision, use_jpeg, grayscale, purpose="Conversione PDF in immagine"
+            )
+            image_format = "image/jpeg" if is_jpeg else "image/png"
+        
+            if not img_bytes:
+                raise ValueError("Impossibile convertire il PDF in immagine con nessun metodo disponibile")
+            image_url = _image_data_url(img_bytes, image_format)
+        
+            # Chiama OpenAI Vision (eseguita dal chiamante: sincrona o asincrona)
+            vision_request = dict(
                 model=MODEL,
                 messages=[
-                    {"role": "system", "content": dynamic_prompt},
+                    *_system_messages_for(rule_additions),
                     {
                         "role": "user",
                         "content": [
+                            *([{"type": "text", "text": document_context}] if document_context else []),
                             {
                                 "type": "text",
                                 "text": (
@@ -858,38 +1890,27 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
                                        if extracted_text_for_grounding else "")
                                 )
                             },
-                            {"type": "image_url", "image_url": {"url": f"data:{image_format};base64,{img_b64}"}}
+                            {"type": "image_url", "image_url": {"url": image_url}}
                         ],
                     },
                 ],
-                response_format={"type": "json_object"},
+                response_format=_DDT_RESPONSE_FORMAT,
                 temperature=0.1,  # Bassa temperatura per risultati più deterministici
             )
-        except OpenAIError as e:
-            logger.error(f"Errore API OpenAI: {e}")
-            raise ValueError(f"Errore durante l'estrazione dati: {str(e)}") from e
-        
-        # Estrai il JSON dalla risposta
-        if not response.choices or not response.choices[0].message.content:
-            raise ValueError("Risposta vuota da OpenAI")
-        
-        import json
-        try:
-            raw_data = json.loads(response.choices[0].message.content)
-        except json.JSONDecodeError as e:
-            logger.error(f"Errore parsing JSON da OpenAI: {e}")
-            raise ValueError(f"Risposta non valida da OpenAI: {str(e)}") from e
-        
-        logger.info(f"Dati grezzi estratti: {raw_data}")
-        
-        # Normalizza i dati prima della validazione
-        normalized_data = _normalize_extracted_data(raw_data)
+            try:
+                content = yield vision_request
+            except _VISION_CALL_ERRORS as e:
+                logger.error(f"Errore API OpenAI: {e}")
+                raise ValueError(f"Errore durante l'estrazione dati: {str(e)}") from e
+            # Il JSON della risposta viene decodificato nel ciclo di validazione sotto
+        else:
+            logger.info("Dati grezzi estratti: %s", raw_data)
         
         # HARD FAILOVER: Se extraction_mode è LAYOUT_MODEL/LAYOUT_MODEL_FORCED o HYBRID_LAYOUT_AI, NON dovremmo essere qui
         # Se siamo qui, significa che extraction_mode è AI_FALLBACK
         # (Questo check non dovrebbe mai essere raggiunto dopo le modifiche, ma lo manteniamo come safety check)
         if extraction_mode in ("LAYOUT_MODEL", "LAYOUT_MODEL_FORCED", "HYBRID_LAYOUT_AI"):
-            layout_rule_name_safe = layout_rule_name if 'layout_rule_name' in locals() else 'UNKNOWN'
+            layout_rule_name_safe = layout_rule_name if layout_rule_name is not None else 'UNKNOWN'
             error_msg = (
                 f"❌ CRITICAL BUG: extraction_mode è {extraction_mode} ma siamo nella sezione AI extraction! "
                 f"Questo indica un bug nel codice - la sezione layout model dovrebbe aver già restituito."
@@ -898,88 +1919,54 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
             logger.error(f"   Stack trace completo necessario per debug")
             raise RuntimeError(error_msg)  # RuntimeError invece di ValueError per bug critico
         
-        # Applica suggerimenti di apprendimento automatico
-        try:
-            normalized_data = apply_learning_suggestions(normalized_data)
-            logger.info("Suggerimenti di apprendimento applicati")
-        except Exception as e:
-            logger.warning(f"Errore applicazione suggerimenti apprendimento: {e}")
-        
-        # Controllo preventivo: verifica che mittente e destinatario non siano identici
-        mittente = normalized_data.get("mittente", "").strip()
-        destinatario = normalized_data.get("destinatario", "").strip()
-        
-        if mittente.lower() == destinatario.lower():
-            if mittente == "Non specificato" or not mittente:
-                error_msg = (
-                    f"Impossibile estrarre mittente e destinatario dal PDF. "
-                    f"Entrambi i campi risultano vuoti o non specificati dopo la normalizzazione. "
-                    f"Verifica che il PDF contenga informazioni chiare per mittente e destinatario."
-                )
-            else:
-                error_msg = (
-                    f"Mittente e destinatario risultano identici dopo la normalizzazione: '{mittente}'. "
-                    f"Questo potrebbe indicare un errore nell'estrazione dei dati dal PDF. "
-                    f"Verifica che il PDF contenga informazioni distinte per mittente e destinatario."
-                )
-            logger.error(error_msg)
-            logger.error(f"Dati normalizzati completi: {normalized_data}")
-            logger.error(f"Dati grezzi estratti: {raw_data}")
-            raise ValueError(error_msg)
-        
         # Assicura che extraction_mode sia impostato
         if extraction_mode is None:
             extraction_mode = "AI_FALLBACK_FULL"
         
-        # Valida usando Pydantic
-        try:
-            ddt_data = DDTData(**normalized_data)
-            result = ddt_data.model_dump()
-            # Aggiungi extraction_mode e ai_fallback_used al risultato per audit trail
-            result["_extraction_mode"] = extraction_mode
-            result["_ai_fallback_used"] = True  # Solo AI usato (nessun layout model)
-            logger.info(f"✅ Dati validati con successo")
-            logger.info(f"📊 Extraction mode used: {extraction_mode}")
-            logger.info(f"🤖 Estrazione completata usando solo AI (nessun layout model)")
-            return result
-        except ValidationError as e:
-            # Estrai un messaggio più chiaro dagli errori di validazione Pydantic
-            error_messages = []
-            for error in e.errors():
-                field = error.get("loc", [])
-                field_name = " -> ".join(str(f) for f in field) if field else "campo sconosciuto"
-                error_type = error.get("type", "unknown")
-                error_msg = error.get("msg", "Errore di validazione")
-                
-                # Messaggi personalizzati per errori comuni
-                if "Mittente e destinatario non possono essere identici" in str(error_msg):
-                    mittente_val = normalized_data.get("mittente", "N/A")
-                    error_messages.append(
-                        f"Mittente e destinatario risultano identici: '{mittente_val}'. "
-                        f"Verifica che il PDF contenga informazioni distinte per mittente e destinatario."
-                    )
-                elif error_type == "value_error":
-                    error_messages.append(f"{field_name}: {error_msg}")
-                else:
-                    error_messages.append(f"{field_name}: {error_msg}")
-            
-            error_str = "; ".join(error_messages) if error_messages else str(e)
-            logger.error(f"Errore validazione Pydantic: {e}")
-            logger.error(f"Dati normalizzati: {normalized_data}")
-            raise ValueError(f"Dati estratti non validi: {error_str}") from e
-        except ValueError as e:
-            # Se l'errore è già stato gestito sopra (mittente/destinatario identici), rilancia così com'è
-            error_str = str(e)
-            if "Mittente e destinatario risultano identici" in error_str:
-                raise
-            # Altrimenti, fornisci un messaggio più chiaro
-            logger.error(f"Errore validazione dati: {e}")
-            logger.error(f"Dati normalizzati: {normalized_data}")
-            raise ValueError(f"Dati estratti non validi: {str(e)}") from e
-        except Exception as e:
-            logger.error(f"Errore validazione dati: {e}")
-            logger.error(f"Dati normalizzati: {normalized_data}")
-            raise ValueError(f"Dati estratti non validi: {str(e)}") from e
+        # Risposta Vision non valida: l'errore viene rimandato al modello come turno
+        # correttivo (stessa conversazione) invece di fallire subito
+        validation_retries = VISION_VALIDATION_RETRIES if vision_request is not None else 0
+        while True:
+            try:
+                if raw_data is None:
+                    # Risposta Vision (prima o corretta): anche una risposta vuota
+                    # o non JSON consuma un tentativo
+                    raw_data = _parse_vision_content(content)
+                    logger.info("Dati grezzi estratti: %s", raw_data)
+                result = _validate_ai_data(raw_data)
+                break
+            except ValueError as e:
+                if validation_retries <= 0:
+                    raise
+                validation_retries -= 1
+                logger.warning(f"Risposta Vision non valida ({e}): nuovo tentativo con feedback al modello")
+                vision_request["messages"] = [
+                    *vision_request["messages"],
+                    {"role": "assistant", "content": content},
+                    {
+                        "role": "user",
+                        "content": (
+                            f"La risposta precedente non supera la validazione: {e}. "
+                            "Correggi i campi indicati e restituisci solo il JSON corretto."
+                        ),
+                    },
+                ]
+                try:
+                    content = yield vision_request
+                except _VISION_CALL_ERRORS as call_error:
+                    logger.error(f"Errore API OpenAI: {call_error}")
+                    raise ValueError(f"Errore durante l'estrazione dati: {str(call_error)}") from call_error
+                raw_data = None
+        
+        # Aggiungi extraction_mode e ai_fallback_used al risultato per audit trail
+        result["_extraction_mode"] = extraction_mode
+        result["_ai_fallback_used"] = extraction_mode != "TEXT_ONLY"  # Solo AI usato (nessun layout model)
+        if vision_cache_key is not None:
+            set_cached_response(vision_cache_key, raw_data)
+        logger.info("📊 Extraction mode used: %s", extraction_mode)
+        if extraction_mode != "TEXT_ONLY":
+            logger.info("🤖 Estrazione completata usando solo AI (nessun layout model)")
+        return result
         
     except FileNotFoundError:
         raise FileNotFoundError(f"File PDF non trovato: {file_path}")
@@ -989,6 +1976,205 @@ def extract_from_pdf(file_path: str, template_id: Optional[str] = None) -> Dict[
     except Exception as e:
         logger.error(f"Errore generico durante estrazione: {e}", exc_info=True)
         raise ValueError(f"Errore durante l'elaborazione del PDF: {str(e)}") from e
+    finally:
+        if artifacts is not None:
+            artifacts.close()
+
+
+class _AsyncRateLimiter:
+    """
+    Rate limiter a intervallo minimo tra richieste (token bucket di capacità 1)
+    
+    Ogni acquire() prenota lo slot successivo e attende il proprio turno:
+    le richieste vengono distanziate di almeno 60/requests_per_minute secondi.
+    """
+    
+    def __init__(self, requests_per_minute: int):
+        self._interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        if not self._interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+async def extract_from_pdf_async(file_path: str, template_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Versione asincrona di extract_from_pdf
+    
+    Le fasi CPU/disco (testo, layout, rendering, validazione) girano in un thread,
+    la chiamata Vision con AsyncOpenAI sull'event loop: durante l'attesa di rete
+    nessun thread resta bloccato, e il rendering del documento successivo di un
+    batch si sovrappone alla chiamata Vision in corso.
+    
+    Args/Returns/Raises: come extract_from_pdf
+    """
+    steps = _extract_from_pdf_steps(file_path, template_id)
+    done, value = await asyncio.to_thread(_advance_steps, next, steps)
+    if done:
+        return value
+    
+    aclient, semaphore = _get_async_vision_resources()
+    while not done:
+        try:
+            async with semaphore:
+                content = await _stream_vision_content_async(aclient, **value)
+        except Exception as e:
+            done, value = await asyncio.to_thread(_advance_steps, steps.throw, e)
+        else:
+            done, value = await asyncio.to_thread(_advance_steps, steps.send, content)
+    return value
+
+
+async def batch_extract(
+    paths: list[str],
+    max_concurrency: int = 10,
+    requests_per_minute: Optional[int] = None
+) -> list[Union[Dict[str, Any], Exception]]:
+    """
+    Estrae dati da più PDF in concorrenza sull'event loop corrente
+    
+    Entry point asincrono del batch, utilizzabile anche da un event loop già
+    in esecuzione (es. endpoint FastAPI): al massimo max_concurrency documenti
+    sono in lavorazione contemporaneamente e un documento fallito non
+    interrompe gli altri.
+    
+    Args:
+        paths: Lista dei percorsi dei file PDF
+        max_concurrency: Numero massimo di documenti elaborati contemporaneamente
+        requests_per_minute: Limite richieste al minuto (default: VISION_REQUESTS_PER_MINUTE, 0 = nessun limite)
+        
+    Returns:
+        Lista di risultati nello stesso ordine di paths: i dati estratti,
+        oppure l'eccezione sollevata per i documenti falliti
+        
+    Raises:
+        ValueError: Se max_concurrency non è positivo
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency deve essere almeno 1")
+    if requests_per_minute is None:
+        requests_per_minute = VISION_REQUESTS_PER_MINUTE
+    
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiter = _AsyncRateLimiter(requests_per_minute)
+    
+    async def _run(path: str) -> Dict[str, Any]:
+        async with semaphore:
+            await rate_limiter.acquire()
+            return await extract_from_pdf_async(path)
+    
+    return await asyncio.gather(*(_run(path) for path in paths), return_exceptions=True)
+
+
+async def _extract_from_pdfs_batch_async(
+    file_paths: list[str],
+    max_concurrency: int,
+    requests_per_minute: int
+) -> list[Dict[str, Any]]:
+    """
+    Corpo asincrono di extract_from_pdfs_batch (eseguito in un event loop dedicato)
+    
+    Chiude il client AsyncOpenAI del loop a fine batch e converte le eccezioni
+    dei singoli documenti in {"file_path": ..., "error": ...}.
+    
+    Returns:
+        Lista di risultati nello stesso ordine di file_paths
+    """
+    try:
+        results = await batch_extract(file_paths, max_concurrency, requests_per_minute)
+    finally:
+        # Event loop creato da asyncio.run: il client non servirà più
+        await _close_async_vision_resources()
+    for i, (path, result) in enumerate(zip(file_paths, results)):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Estrazione batch fallita per {path}: {result}")
+            results[i] = {"file_path": path, "error": str(result)}
+    return results
+
+
+def extract_from_pdfs_batch(
+    file_paths: list[str],
+    max_concurrency: int = 16,
+    requests_per_minute: Optional[int] = None
+) -> list[Dict[str, Any]]:
+    """
+    Estrae dati da più PDF in parallelo (ingest batch)
+    
+    Le chiamate Vision sono quasi interamente attesa di rete: i documenti
+    vengono elaborati in concorrenza (al massimo max_concurrency alla volta)
+    e le richieste sono distanziate dal rate limiter per restare sotto il
+    limite RPM di OpenAI.
+    Le fasi PyMuPDF (testo, layout, rendering) restano serializzate da
+    _fitz_guard; per parallelizzare anche la parte CPU usare extract_many.
+    
+    Args:
+        file_paths: Lista dei percorsi dei file PDF
+        max_concurrency: Numero massimo di documenti elaborati contemporaneamente
+        requests_per_minute: Limite richieste al minuto (default: VISION_REQUESTS_PER_MINUTE, 0 = nessun limite)
+        
+    Returns:
+        Lista di risultati nello stesso ordine di file_paths: i dati estratti,
+        oppure {"file_path": ..., "error": ...} per i documenti falliti
+        
+    Raises:
+        ValueError: Se max_concurrency non è positivo
+        RuntimeError: Se chiamata da un event loop già in esecuzione
+                      (in quel caso usare direttamente batch_extract)
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency deve essere almeno 1")
+    if requests_per_minute is None:
+        requests_per_minute = VISION_REQUESTS_PER_MINUTE
+    
+    logger.info("📦 Estrazione batch di %s PDF (concorrenza %s, %s req/min)", len(file_paths), max_concurrency, requests_per_minute or '∞')
+    return asyncio.run(_extract_from_pdfs_batch_async(file_paths, max_concurrency, requests_per_minute))
+
+
+def _extract_from_pdf_or_error(file_path: str) -> Dict[str, Any]:
+    """Estrae un PDF restituendo {"file_path", "error"} in caso di errore (worker batch)"""
+    try:
+        return extract_from_pdf(file_path)
+    except Exception as e:
+        logger.error(f"❌ Estrazione fallita per {file_path}: {e}")
+        return {"file_path": file_path, "error": str(e)}
+
+
+def extract_many(paths: list[str], max_workers: int = min(os.cpu_count() or 1, 4)) -> list[Dict[str, Any]]:
+    """
+    Estrae dati da più PDF in parallelo su processi separati
+    
+    Rendering PyMuPDF, compressione immagini e OCR sono CPU-bound: con più
+    processi si usano tutti i core invece di uno solo (GIL). I worker sono
+    avviati con "spawn" per non ereditare thread, connessioni HTTP e contesto
+    MuPDF (non fork-safe) del processo padre: ogni processo apre i propri
+    fitz.Document.
+    
+    Args:
+        paths: Lista dei percorsi dei file PDF
+        max_workers: Numero di processi worker (default: min(CPU, 4))
+        
+    Returns:
+        Lista di risultati nello stesso ordine di paths: i dati estratti,
+        oppure {"file_path": ..., "error": ...} per i documenti falliti
+    """
+    if not paths:
+        return []
+    
+    max_workers = min(max_workers, len(paths))
+    if max_workers <= 1:
+        return [_extract_from_pdf_or_error(path) for path in paths]
+    
+    logger.info("📦 Estrazione di %s PDF su %s processi", len(paths), max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(executor.map(_extract_from_pdf_or_error, paths))
 
 
 def generate_preview_png(file_path: str, file_hash: str, output_dir: Optional[str] = None) -> Optional[str]:
@@ -1003,172 +2189,287 @@ def generate_preview_png(file_path: str, file_hash: str, output_dir: Optional[st
     Returns:
         Percorso del file PNG salvato o None se fallito
     """
-    from app.paths import get_preview_dir, safe_open, ensure_dir
-    
     try:
-        # Leggi il file PDF
+        # Risolvi il percorso del PDF
         file_path_obj = Path(file_path)
         if not file_path_obj.is_absolute():
-            from app.paths import get_base_dir
             file_path_obj = get_base_dir() / file_path_obj
         file_path_obj = file_path_obj.resolve()
         
-        with safe_open(file_path_obj, "rb") as f:
-            pdf_bytes = f.read()
-        
-        if not pdf_bytes:
-            logger.warning(f"File PDF vuoto: {file_path}")
-            return None
-        
         # Usa directory preview standardizzata se non specificata
         if output_dir is None:
             preview_dir = get_preview_dir()
         else:
             preview_dir = Path(output_dir)
             if not preview_dir.is_absolute():
-                from app.paths import get_base_dir
                 preview_dir = get_base_dir() / preview_dir
             preview_dir = ensure_dir(preview_dir.resolve())
         
         png_path = preview_dir / f"{file_hash}.png"
         
-        # Se esiste già, restituisci il percorso
-        if png_path.exists():
-            logger.debug(f"PNG anteprima già esistente: {png_path}")
-            return str(png_path)
+        # Se esiste già ed è più recente del PDF, restituisci il percorso
+        # (due stat, senza leggere né rasterizzare il PDF)
+        try:
+            png_mtime = png_path.stat().st_mtime
+        except FileNotFoundError:
+            png_mtime = None
+        if png_mtime is not None:
+            try:
+                is_fresh = png_mtime >= file_path_obj.stat().st_mtime
+            except FileNotFoundError:
+                is_fresh = True  # PDF già spostato/rimosso: l'anteprima resta l'unica copia
+            if is_fresh:
+                logger.debug("PNG anteprima già esistente: %s", png_path)
+                return str(png_path)
+        
+        # Leggi il file PDF
+        with safe_open(file_path_obj, "rb") as f:
+            pdf_bytes = f.read()
+        
+        if not pdf_bytes:
+            logger.warning(f"File PDF vuoto: {file_path}")
+            return None
         
-        img_bytes = None
+        def _save_with_fitz() -> tuple[bytes, bool]:
+            # Rendering dedicato a PREVIEW_RENDER_DPI (non il pixmap Vision, limitato sul
+            # lato lungo), salvato dall'encoder C di MuPDF direttamente su file
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                _render_preview_pixmap(doc).save(str(png_path))
+            return b"", False
         
-        # Metodo 1: Prova con PyMuPDF (fitz) - migliore per Windows
         try:
-            import fitz  # PyMuPDF
-            
-            logger.info(f"Generazione PNG anteprima con PyMuPDF per {file_path}...")
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            if len(doc) == 0:
-                raise ValueError("PDF vuoto o non valido")
-            
-            # Converti la prima pagina in immagine
-            page = doc[0]
-            # Matrice di trasformazione per DPI 200 (200/72 = 2.78)
-            zoom = 200 / 72.0
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Converti in PNG
-            img_bytes = pix.tobytes("png")
-            doc.close()
-            logger.info(f"PNG generata con PyMuPDF ({len(img_bytes)} bytes)")
-            
-        except ImportError:
-            logger.warning("PyMuPDF non disponibile, provo con pdf2image...")
-            # Metodo 2: Fallback a pdf2image
-            try:
-                from pdf2image import convert_from_bytes
-                from io import BytesIO
-                
-                logger.info(f"Generazione PNG anteprima con pdf2image per {file_path}...")
-                images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
-                if not images:
-                    raise ValueError("Impossibile convertire il PDF in immagine")
-                
-                img_buffer = BytesIO()
-                images[0].save(img_buffer, format='PNG')
-                img_bytes = img_buffer.getvalue()
-                logger.info(f"PNG generata con pdf2image ({len(img_bytes)} bytes)")
-                
-            except ImportError:
-                logger.error("Nessuna libreria disponibile per convertire PDF. Installa PyMuPDF (consigliato) o pdf2image+Poppler")
-                return None
-            except Exception as e:
-                logger.error(f"Errore conversione PDF con pdf2image: {e}")
-                return None
-        except Exception as e:
-            logger.warning(f"Errore conversione PDF con PyMuPDF: {e}, provo fallback...")
-            # Fallback a pdf2image se PyMuPDF fallisce
-            try:
-                from pdf2image import convert_from_bytes
-                from io import BytesIO
-                
-                logger.info(f"Generazione PNG anteprima con pdf2image (fallback) per {file_path}...")
-                images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
-                if not images:
-                    raise ValueError("Impossibile convertire il PDF in immagine")
-                
-                img_buffer = BytesIO()
-                images[0].save(img_buffer, format='PNG')
-                img_bytes = img_buffer.getvalue()
-                logger.info(f"PNG generata con pdf2image (fallback) ({len(img_bytes)} bytes)")
-            except Exception as e2:
-                logger.error(f"Errore conversione PDF: PyMuPDF fallito ({e}), pdf2image fallito ({e2})")
-                return None
-        
-        if not img_bytes:
-            logger.error("Impossibile generare PNG anteprima")
+            img_bytes, _ = _render_first_page(
+                pdf_bytes,
+                _save_with_fitz,
+                use_jpeg=False,
+                grayscale=False,
+                purpose=f"Generazione PNG anteprima per {file_path}",
+                dpi=PREVIEW_RENDER_DPI,
+            )
+        except (ImportError, ValueError):
             return None
         
-        # Salva la PNG
-        from app.paths import safe_open
-        with safe_open(png_path, 'wb') as f:
-            f.write(img_bytes)
+        # Fallback pdf2image: restituisce i bytes, da salvare qui
+        if img_bytes:
+            with safe_open(png_path, 'wb') as f:
+                f.write(img_bytes)
+        elif not png_path.exists():
+            logger.error("Impossibile generare PNG anteprima")
+            return None
         
-        logger.info(f"✅ PNG anteprima salvata: {png_path} ({len(img_bytes)} bytes)")
+        logger.info("✅ PNG anteprima salvata: %s", png_path)
         return str(png_path)
         
     except FileNotFoundError:
         logger.error(f"File PDF non trovato: {file_path}")
         return None
     except Exception as e:
-        logger.error(f"Errore generazione PNG anteprima: {e}", exc_info=True)
+        logger.error(f"Errore generazione PNG anteprima: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
 
 
-def _normalize_extracted_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
+def batch_generate_previews(
+    items: list[tuple[str, str]],
+    output_dir: Optional[str] = None,
+    max_workers: int = min(os.cpu_count() or 1, 4)
+) -> list[Optional[str]]:
     """
-    Normalizza i dati grezzi estratti prima della validazione Pydantic
+    Genera in parallelo su processi separati le PNG di anteprima di più PDF
+    
+    Rendering e compressione PNG di MuPDF trattengono il GIL e PyMuPDF non
+    supporta l'uso da più thread: come in extract_many, ogni worker è un
+    processo avviato con "spawn" che apre i propri fitz.Document.
+    
+    Args:
+        items: Lista di coppie (file_path, file_hash), come per generate_preview_png
+        output_dir: Directory dove salvare le PNG (default: usa get_preview_dir())
+        max_workers: Numero di processi worker (default: min(CPU, 4))
+        
+    Returns:
+        Lista dei percorsi PNG nello stesso ordine di items (None per le anteprime fallite)
+    """
+    if not items:
+        return []
+    
+    max_workers = min(max_workers, len(items))
+    if max_workers <= 1:
+        return [generate_preview_png(file_path, file_hash, output_dir) for file_path, file_hash in items]
+    
+    logger.info("🖼️ Generazione di %s anteprime su %s processi", len(items), max_workers)
+    file_paths, file_hashes = zip(*items)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(executor.map(
+            generate_preview_png, file_paths, file_hashes, [output_dir] * len(items)
+        ))
+
+
+# Forma canonica dei dati DDT (quella restituita da DDTData.model_dump()): date
+# YYYY-MM-DD, testi senza spazi multipli/invisibili, kg numerico >= 0
+_CANONICAL_TEXT_PATTERN = r'^(?:[^\s\u200b]+ )*[^\s\u200b]+\Z'
+_DDT_CANONICAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "data": {"type": "string", "pattern": r'^[0-9]{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12][0-9]|3[01])\Z'},
+        "mittente": {"type": "string", "pattern": _CANONICAL_TEXT_PATTERN},
+        "destinatario": {"type": "string", "pattern": _CANONICAL_TEXT_PATTERN},
+        "numero_documento": {"type": "string", "pattern": _CANONICAL_TEXT_PATTERN},
+        "totale_kg": {"type": "number", "minimum": 0},
+    },
+    "required": list(FIELD_DESCRIPTIONS),
+}
+_validate_ddt_canonical = fastjsonschema.compile(_DDT_CANONICAL_SCHEMA) if fastjsonschema is not None else None
+
+
+def _parse_vision_content(content: Optional[str]) -> Dict[str, Any]:
+    """
+    Decodifica il JSON della risposta Vision
+    
+    Raises:
+        ValueError: Se la risposta è vuota o non è JSON valido
+    """
+    if not content:
+        raise ValueError("Risposta vuota da OpenAI")
+    try:
+        return _json_loads(content)
+    except json.JSONDecodeError as e:
+        logger.error(f"Errore parsing JSON da OpenAI: {e}")
+        raise ValueError(f"Risposta non valida da OpenAI: {str(e)}") from e
+
+
+def _validate_ai_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normalizza e valida i dati grezzi restituiti da Vision
     
     Args:
         raw_data: Dati grezzi dal JSON di OpenAI
         
     Returns:
-        Dizionario normalizzato pronto per validazione
+        Dizionario dei campi validati (come DDTData.model_dump())
+        
+    Raises:
+        ValueError: Se i dati non sono validi (messaggio leggibile, usato anche
+                    come feedback al modello nei retry)
     """
-    normalized = {}
+    # Normalizza i dati prima della validazione
+    normalized_data = _normalize_extracted_data(raw_data)
     
-    # Normalizza data
-    data_raw = raw_data.get("data", "")
-    if isinstance(data_raw, str):
-        normalized["data"] = normalize_date(data_raw) or "1900-01-01"
-    else:
-        normalized["data"] = "1900-01-01"
+    # Applica suggerimenti di apprendimento automatico
+    try:
+        normalized_data = apply_learning_suggestions(normalized_data)
+        logger.info("Suggerimenti di apprendimento applicati")
+    except Exception as e:
+        logger.warning(f"Errore applicazione suggerimenti apprendimento: {e}")
+    
+    # Controllo preventivo: verifica che mittente e destinatario non siano identici
+    # (forme canoniche: senza distinzione di maiuscole e accenti)
+    mittente = normalized_data.get("mittente", "").strip()
+    mittente_canon = _canon(mittente)
     
-    # Normalizza mittente
-    mittente_raw = raw_data.get("mittente", "")
-    normalized["mittente"] = clean_company_name(str(mittente_raw)) or "Non specificato"
+    if mittente_canon == _canon(normalized_data.get("destinatario", "")):
+        if mittente_canon in ("", "non specificato"):
+            error_msg = (
+                f"Impossibile estrarre mittente e destinatario dal PDF. "
+                f"Entrambi i campi risultano vuoti o non specificati dopo la normalizzazione. "
+                f"Verifica che il PDF contenga informazioni chiare per mittente e destinatario."
+            )
+        else:
+            error_msg = (
+                f"Mittente e destinatario risultano identici dopo la normalizzazione: '{mittente}'. "
+                f"Questo potrebbe indicare un errore nell'estrazione dei dati dal PDF. "
+                f"Verifica che il PDF contenga informazioni distinte per mittente e destinatario."
+            )
+        logger.error(error_msg)
+        logger.error("Dati normalizzati completi: %s", normalized_data)
+        logger.error("Dati grezzi estratti: %s", raw_data)
+        raise ValueError(error_msg)
     
-    # Normalizza destinatario
-    destinatario_raw = raw_data.get("destinatario", "")
-    normalized["destinatario"] = clean_company_name(str(destinatario_raw)) or "Non specificato"
+    # Valida usando Pydantic
+    try:
+        result = _validate_ddt_data(normalized_data)
+        logger.info("✅ Dati validati con successo")
+        return result
+    except ValidationError as e:
+        # Estrai un messaggio più chiaro dagli errori di validazione Pydantic
+        error_messages = []
+        for error in e.errors():
+            field = error.get("loc", [])
+            field_name = " -> ".join(str(f) for f in field) if field else "campo sconosciuto"
+            error_msg = error.get("msg", "Errore di validazione")
+            error_messages.append(f"{field_name}: {error_msg}")
+        
+        error_str = "; ".join(error_messages) if error_messages else str(e)
+        logger.error(f"Errore validazione Pydantic: {e}")
+        logger.error("Dati normalizzati: %s", normalized_data)
+        raise ValueError(f"Dati estratti non validi: {error_str}") from e
+    except Exception as e:
+        logger.error(f"Errore validazione dati: {e}")
+        logger.error("Dati normalizzati: %s", normalized_data)
+        raise ValueError(f"Dati estratti non validi: {str(e)}") from e
+
+
+def _validate_ddt_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Valida i dati DDT e restituisce il dizionario dei campi (come DDTData.model_dump())
     
-    # Normalizza numero documento
-    numero_raw = raw_data.get("numero_documento", "")
-    normalized["numero_documento"] = normalize_text(str(numero_raw)) or "Non specificato"
+    Fast path: se i dati sono già in forma canonica (validatore fastjsonschema
+    compilato), la data esiste e mittente/destinatario differiscono, DDTData li restituirebbe
+    invariati e l'istanziazione del modello viene saltata. In tutti gli altri
+    casi (o senza fastjsonschema) valida DDTData, che normalizza i valori e
+    produce i messaggi di errore dettagliati.
     
-    # Normalizza totale_kg
-    kg_raw = raw_data.get("totale_kg", 0)
-    normalized["totale_kg"] = normalize_float(kg_raw) or 0.0
+    Raises:
+        ValidationError: Se i dati non sono validi
+    """
+    if _validate_ddt_canonical is not None:
+        try:
+            _validate_ddt_canonical(data)
+            # Il pattern non esclude giorni inesistenti (es. 2024-02-31)
+            date.fromisoformat(data["data"])
+        except (fastjsonschema.JsonSchemaException, ValueError):
+            pass
+        else:
+            mittente, destinatario = data["mittente"], data["destinatario"]
+            if len(mittente) != len(destinatario) or mittente.casefold() != destinatario.casefold():
+                result = {field: data[field] for field in FIELD_DESCRIPTIONS}
+                result["totale_kg"] = float(result["totale_kg"])
+                return result
+    return DDTData.model_validate(data).model_dump()
+
+
+def _canon(value: Optional[str]) -> str:
+    """Forma canonica per i confronti: casefold, senza accenti né spazi ai bordi"""
+    decomposed = unicodedata.normalize("NFKD", (value or "").casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).strip()
+
+
+def _coerce(raw: Any, normalizer: Callable[[Any], Any], default: Any) -> Any:
+    """Normalizza raw, saltando str()/regex per i valori vuoti (None, ""): default diretto"""
+    if raw is None or raw == "":
+        return default
+    return normalizer(raw) or default
+
+
+def _normalize_extracted_data(raw_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normalizza i dati grezzi estratti prima della validazione Pydantic
     
-    return normalized
+    Args:
+        raw_data: Dati grezzi dal JSON di OpenAI
+        
+    Returns:
+        Dizionario normalizzato pronto per validazione
+    """
+    return {
+        field: _coerce(raw_data.get(field), normalizer, default)
+        for field, normalizer, default in _NORMALIZATION_SPEC
+    }
 
 
 if __name__ == "__main__":
     """
     Permette di eseguire extract.py direttamente per test
-    Uso: python app/extract.py <percorso_file.pdf>
+    Uso: python app/extract.py <percorso_file.pdf | directory> [altri_file.pdf ...]
     """
-    import sys
-    import os
-    
     # Aggiungi la directory root al path Python quando eseguito come script
     script_dir = os.path.dirname(os.path.abspath(__file__))
     root_dir = os.path.dirname(script_dir)
@@ -1176,20 +2477,51 @@ if __name__ == "__main__":
         sys.path.insert(0, root_dir)
     
     if len(sys.argv) < 2:
-        print("Uso: python app/extract.py <percorso_file.pdf>")
+        print("Uso: python app/extract.py <percorso_file.pdf | directory> [altri_file.pdf ...]")
         print("\nEsempio:")
         print("  python app/extract.py inbox/file.pdf")
+        print("  python app/extract.py inbox/a.pdf inbox/b.pdf   (elaborazione batch in parallelo)")
+        print("  python app/extract.py inbox/                    (tutti i PDF della directory, multiprocesso)")
         sys.exit(1)
     
-    pdf_path = sys.argv[1]
+    pdf_paths = sys.argv[1:]
+    from_directory = len(pdf_paths) == 1 and os.path.isdir(pdf_paths[0])
     
-    if not os.path.exists(pdf_path):
-        print(f"❌ Errore: File non trovato: {pdf_path}")
-        sys.exit(1)
+    if from_directory:
+        directory = pdf_paths[0]
+        pdf_paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith('.pdf')
+        )
+        if not pdf_paths:
+            print(f"❌ Errore: Nessun PDF trovato in {directory}")
+            sys.exit(1)
     
-    if not pdf_path.lower().endswith('.pdf'):
-        print("❌ Errore: Il file deve essere un PDF")
-        sys.exit(1)
+    for pdf_path in pdf_paths:
+        if not os.path.exists(pdf_path):
+            print(f"❌ Errore: File non trovato: {pdf_path}")
+            sys.exit(1)
+        
+        if not pdf_path.lower().endswith('.pdf'):
+            print(f"❌ Errore: Il file deve essere un PDF: {pdf_path}")
+            sys.exit(1)
+    
+    if from_directory or len(pdf_paths) > 1:
+        print(f"📦 Estrazione batch di {len(pdf_paths)} PDF")
+        print("⏳ Elaborazione in corso...\n")
+        results = extract_many(pdf_paths) if from_directory else extract_from_pdfs_batch(pdf_paths)
+        failed = 0
+        for pdf_path, data in zip(pdf_paths, results):
+            if "error" in data:
+                failed += 1
+                print(f"❌ {pdf_path}: {data['error']}")
+            else:
+                print(f"✅ {pdf_path}: {data.get('data', 'N/A')} | {data.get('mittente', 'N/A')} | "
+                      f"{data.get('numero_documento', 'N/A')} | {data.get('totale_kg', 'N/A')} kg")
+        print(f"\n📋 Completati: {len(pdf_paths) - failed}/{len(pdf_paths)}")
+        sys.exit(1 if failed else 0)
+    
+    pdf_path = pdf_paths[0]
     
     print(f"📄 Estrazione dati da: {pdf_path}")
     print("⏳ Elaborazione in corso...\n")
@@ -0,0 +1,157 @@
+"""
+Cache degli artefatti di pre-elaborazione dei PDF (testo estratto)
+Chiave = SHA256 del contenuto del PDF: retry, reprocess e upload duplicati
+dello stesso file non ripetono il parsing PyMuPDF/pdfplumber
+"""
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from app.config import EXTRACT_CACHE_TTL_DAYS
+from app.text_extraction.decision import TextExtractionResult
+
+logger = logging.getLogger(__name__)
+
+# orjson (opzionale) legge e scrive direttamente bytes, senza codifica/decodifica intermedia
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+_CACHE_TTL_SECONDS = EXTRACT_CACHE_TTL_DAYS * 86400
+
+# Pulizia delle voci scadute mai più rilette: al più una scansione all'ora per processo
+_SWEEP_INTERVAL_SECONDS = 3600
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+# Livello in memoria davanti al disco (processo corrente)
+_MEMORY_CACHE_MAXSIZE = 64
+_memory_cache: "OrderedDict[str, TextExtractionResult]" = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+
+def _text_cache_file(pdf_hash: str) -> Path:
+    from app.paths import get_extract_cache_dir
+    return get_extract_cache_dir() / pdf_hash / "text.json"
+
+
+def _remember(pdf_hash: str, result: TextExtractionResult) -> None:
+    with _memory_cache_lock:
+        _memory_cache[pdf_hash] = result
+        _memory_cache.move_to_end(pdf_hash)
+        while len(_memory_cache) > _MEMORY_CACHE_MAXSIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _sweep_expired(cache_dir: Path) -> None:
+    """
+    Elimina le voci scadute (una directory per PDF) e le directory rimaste vuote, rate-limited
+    
+    Il TTL in get_cached_text_result vale solo per i PDF riletti: le voci dei
+    PDF mai rielaborati (la maggior parte) resterebbero su disco per sempre.
+    """
+    global _last_sweep
+    now = time.time()
+    with _sweep_lock:
+        if now - _last_sweep < _SWEEP_INTERVAL_SECONDS:
+            return
+        _last_sweep = now
+    
+    removed = 0
+    try:
+        with os.scandir(cache_dir) as pdf_dirs:
+            for pdf_dir in pdf_dirs:
+                if not pdf_dir.is_dir():
+                    continue
+                try:
+                    with os.scandir(pdf_dir.path) as entries:
+                        for entry in entries:
+                            if entry.is_file() and now - entry.stat().st_mtime > _CACHE_TTL_SECONDS:
+                                os.unlink(entry.path)
+                    os.rmdir(pdf_dir.path)  # Solo se vuota (altrimenti OSError)
+                    removed += 1
+                except OSError:
+                    continue
+    except OSError as e:
+        logger.warning(f"Pulizia cache testo non riuscita: {e}")
+        return
+    if removed:
+        logger.info(f"🧹 Cache testo: rimosse {removed} voci scadute")
+
+
+def get_cached_text_result(pdf_hash: str) -> Optional[TextExtractionResult]:
+    """
+    Restituisce il risultato dell'estrazione testo in cache per il PDF, se presente
+
+    Args:
+        pdf_hash: SHA256 esadecimale del contenuto del PDF
+
+    Returns:
+        TextExtractionResult in cache, o None se assente/scaduto
+    """
+    if _CACHE_TTL_SECONDS <= 0:
+        return None
+
+    with _memory_cache_lock:
+        result = _memory_cache.get(pdf_hash)
+        if result is not None:
+            _memory_cache.move_to_end(pdf_hash)
+            return result
+
+    try:
+        cache_file = _text_cache_file(pdf_hash)
+        if time.time() - cache_file.stat().st_mtime > _CACHE_TTL_SECONDS:
+            cache_file.unlink(missing_ok=True)
+            return None
+        result = TextExtractionResult(**_json_loads(cache_file.read_bytes()))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning(f"Cache testo non leggibile ({pdf_hash[:12]}): {e}")
+        return None
+
+    _remember(pdf_hash, result)
+    logger.debug("Testo estratto servito dalla cache (%s)", pdf_hash[:12])
+    return result
+
+
+def set_cached_text_result(pdf_hash: str, result: TextExtractionResult) -> None:
+    """
+    Salva in cache il risultato dell'estrazione testo (scrittura atomica: temp file + rename)
+
+    Gli errori di scrittura vengono solo loggati: la cache non deve mai
+    far fallire un'estrazione.
+
+    Args:
+        pdf_hash: SHA256 esadecimale del contenuto del PDF
+        result: Risultato della pipeline di estrazione testo
+    """
+    if _CACHE_TTL_SECONDS <= 0:
+        return
+
+    _remember(pdf_hash, result)
+    try:
+        cache_file = _text_cache_file(pdf_hash)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_file, "wb") as f:
+            f.write(_json_dumps(dataclasses.asdict(result)))
+        os.replace(temp_file, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Impossibile salvare il testo estratto in cache ({pdf_hash[:12]}): {e}")
+        return
+    _sweep_expired(cache_file.parent.parent)
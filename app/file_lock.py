@@ -2,9 +2,12 @@
 File locking cross-process usando fcntl.flock (Linux)
 Garantisce coordinamento tra processi WEB e WORKER
 """
+import atexit
 import fcntl
 import logging
 import os
+import signal
+import threading
 import time
 from contextlib import contextmanager
 from pathlib import Path
@@ -15,8 +18,92 @@ logger = logging.getLogger(__name__)
 # Timeout default per acquisizione lock (secondi)
 LOCK_TIMEOUT = 3.0
 
-# Lock file per ogni file JSON condiviso
-_lock_files: dict[Path, int] = {}
+# Lock file per ogni file JSON condiviso: fd aperto una sola volta per processo
+# e riusato, senza os.open/os.close a ogni acquisizione (vedi _LockFileState)
+_lock_files: dict[Path, "_LockFileState"] = {}
+_registry_lock = threading.Lock()
+
+# Backoff dell'attesa a polling (thread secondari): 5ms, 10ms, 20ms, 40ms, poi 50ms
+_POLL_INITIAL_DELAY = 0.005
+_POLL_MAX_DELAY = 0.05
+
+
+class _LockWaitTimeout(Exception):
+    """Sollevata dall'handler SIGALRM quando l'attesa bloccante del lock scade"""
+
+
+def _raise_lock_timeout(signum, frame):
+    raise _LockWaitTimeout()
+
+
+def _can_wait_with_alarm() -> bool:
+    """
+    True se si può attendere il lock con flock bloccante + timer SIGALRM
+    
+    I segnali si gestiscono solo nel thread principale, e il timer ITIMER_REAL
+    non deve essere già in uso da altro codice del processo.
+    """
+    return (
+        hasattr(signal, "setitimer")
+        and threading.current_thread() is threading.main_thread()
+        and signal.getitimer(signal.ITIMER_REAL)[0] == 0
+    )
+
+
+def _flock_with_alarm(lock_fd: int, lock_type: int, timeout: float) -> bool:
+    """
+    flock bloccante interrotto da SIGALRM allo scadere del timeout
+    
+    L'attesa avviene nel kernel (risveglio immediato al rilascio del lock)
+    invece che con un polling in userspace.
+    
+    Returns:
+        True se il lock è stato acquisito, False se il timeout è scaduto
+    """
+    acquired = False
+    previous_handler = signal.signal(signal.SIGALRM, _raise_lock_timeout)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            fcntl.flock(lock_fd, lock_type)
+            acquired = True
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _LockWaitTimeout:
+        # Il timer è one-shot: se scade dopo l'acquisizione, acquired resta True.
+        # Se scade tra il ritorno di flock e acquired = True il lock è preso ma non
+        # registrato: con l'fd persistente resterebbe bloccato fino all'uscita del
+        # processo. LOCK_UN è innocuo se il lock non è preso, e nessun altro thread
+        # del processo possiede il flock durante l'acquisizione (_LockFileState)
+        if not acquired:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            except OSError:
+                pass
+    finally:
+        signal.signal(signal.SIGALRM, previous_handler)
+    return acquired
+
+
+def _flock_with_polling(lock_fd: int, lock_type: int, timeout: float) -> bool:
+    """
+    Tentativi non bloccanti con backoff esponenziale (thread non principali)
+    
+    Returns:
+        True se il lock è stato acquisito, False se il timeout è scaduto
+    """
+    deadline = time.monotonic() + timeout
+    delay = _POLL_INITIAL_DELAY
+    while True:
+        try:
+            fcntl.flock(lock_fd, lock_type | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, _POLL_MAX_DELAY)
 
 
 def _get_lock_file_path(file_path: Path) -> Path:
@@ -24,6 +111,142 @@ def _get_lock_file_path(file_path: Path) -> Path:
     return file_path.parent / f".{file_path.name}.lock"
 
 
+def _flock_acquire(lock_fd: int, lock_type: int, timeout: float) -> bool:
+    """
+    Acquisisce flock entro timeout
+    
+    Returns:
+        True se il lock è stato acquisito, False se il timeout è scaduto
+    """
+    # Caso comune (lock libero): un solo tentativo non bloccante
+    try:
+        fcntl.flock(lock_fd, lock_type | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        # Lock occupato: attesa nel kernel se possibile, altrimenti polling con backoff
+        if timeout <= 0:
+            return False
+        if _can_wait_with_alarm():
+            return _flock_with_alarm(lock_fd, lock_type, timeout)
+        return _flock_with_polling(lock_fd, lock_type, timeout)
+
+
+class _LockFileState:
+    """
+    fd persistente di un file di lock e coordinamento dei thread del processo
+    
+    flock appartiene al descrittore aperto, non al thread: thread sullo stesso fd
+    non si escluderebbero e il LOCK_UN di uno rilascerebbe il lock degli altri.
+    Lock readers-writer tra thread: i lettori del processo condividono un solo
+    LOCK_SH (rilasciato dall'ultimo che esce), uno scrittore attende che non ci
+    siano lettori né altri scrittori e prende LOCK_EX.
+    """
+
+    def __init__(self, lock_fd: int):
+        self.lock_fd = lock_fd
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0  # Thread con LOCK_SH condiviso in corso
+        self._writer = False  # Un thread ha (o sta acquisendo) LOCK_EX
+        self._pending_shared = False  # Un lettore sta acquisendo LOCK_SH
+
+    def acquire(self, exclusive: bool, timeout: float) -> bool:
+        """
+        Acquisisce il lock (prima tra thread, poi flock tra processi) entro timeout
+        
+        Returns:
+            True se il lock è stato acquisito, False se il timeout è scaduto
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if exclusive:
+                can_enter = lambda: not self._writer and not self._pending_shared and self._readers == 0
+            else:
+                can_enter = lambda: not self._writer and not self._pending_shared
+            if not self._cond.wait_for(can_enter, timeout=max(timeout, 0)):
+                return False
+            if not exclusive and self._readers > 0:
+                # LOCK_SH già posseduto dal processo: nessuna syscall
+                self._readers += 1
+                return True
+            if exclusive:
+                self._writer = True
+            else:
+                self._pending_shared = True
+        
+        # flock fuori dal Condition: gli altri thread attendono su wait_for
+        lock_type = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        acquired = False
+        try:
+            acquired = _flock_acquire(self.lock_fd, lock_type, deadline - time.monotonic())
+        finally:
+            with self._cond:
+                if exclusive:
+                    self._writer = acquired
+                else:
+                    self._pending_shared = False
+                    if acquired:
+                        self._readers = 1
+                self._cond.notify_all()
+        return acquired
+
+    def release(self, exclusive: bool) -> None:
+        """Rilascia il lock: LOCK_UN solo quando esce lo scrittore o l'ultimo lettore"""
+        with self._cond:
+            try:
+                if exclusive:
+                    self._writer = False
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+                else:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            finally:
+                self._cond.notify_all()
+
+
+def _get_lock_state(lock_path: Path) -> _LockFileState:
+    """
+    Restituisce lo stato (fd persistente) del file di lock, aprendolo alla prima richiesta
+    
+    Raises:
+        OSError: Se il file di lock non può essere creato o aperto
+    """
+    with _registry_lock:
+        state = _lock_files.get(lock_path)
+        if state is None:
+            # Crea directory se non esiste
+            lock_path.parent.mkdir(parents=True, exist_ok=True)
+            # O_CLOEXEC: i sottoprocessi avviati con exec non ereditano (e non condividono) il lock
+            state = _LockFileState(os.open(str(lock_path), os.O_CREAT | os.O_RDWR | os.O_CLOEXEC))
+            _lock_files[lock_path] = state
+        return state
+
+
+def _close_lock_files() -> None:
+    """Chiude tutti i file di lock aperti dal processo"""
+    for state in _lock_files.values():
+        try:
+            os.close(state.lock_fd)
+        except OSError:
+            pass
+    _lock_files.clear()
+
+
+def _reset_after_fork() -> None:
+    """
+    Nel processo figlio (fork) gli fd ereditati condividono i lock del padre:
+    vanno chiusi e riaperti alla prima richiesta
+    """
+    global _registry_lock
+    _registry_lock = threading.Lock()
+    _close_lock_files()
+
+
+atexit.register(_close_lock_files)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 @contextmanager
 def file_lock(file_path: Path, exclusive: bool = True, timeout: float = LOCK_TIMEOUT):
     """
@@ -42,40 +265,21 @@ def file_lock(file_path: Path, exclusive: bool = True, timeout: float = LOCK_TIM
         OSError: Se c'è un errore I/O con il lock file
     """
     lock_path = _get_lock_file_path(file_path)
-    lock_fd = None
+    state = None
     
     try:
-        # Crea directory se non esiste
-        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        # fd persistente del lock file (creato alla prima richiesta)
+        lock_state = _get_lock_state(lock_path)
         
-        # Apri lock file (crea se non esiste)
-        lock_fd = os.open(str(lock_path), os.O_CREAT | os.O_RDWR)
-        
-        # Tipo di lock: LOCK_EX (esclusivo) o LOCK_SH (condiviso)
-        lock_type = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
-        
-        # Prova ad acquisire lock con timeout
-        start_time = time.time()
-        acquired = False
-        
-        while not acquired:
-            try:
-                # Prova lock non-bloccante
-                fcntl.flock(lock_fd, lock_type | fcntl.LOCK_NB)
-                acquired = True
-            except (IOError, OSError) as e:
-                # Lock già acquisito, aspetta e riprova
-                if time.time() - start_time >= timeout:
-                    error_msg = (
-                        f"Timeout acquisizione lock per {file_path} "
-                        f"(exclusive={exclusive}, timeout={timeout}s). "
-                        f"PID={os.getpid()}"
-                    )
-                    logger.error(error_msg)
-                    raise TimeoutError(error_msg) from e
-                
-                # Aspetta 50ms prima di riprovare
-                time.sleep(0.05)
+        if not lock_state.acquire(exclusive, timeout):
+            error_msg = (
+                f"Timeout acquisizione lock per {file_path} "
+                f"(exclusive={exclusive}, timeout={timeout}s). "
+                f"PID={os.getpid()}"
+            )
+            logger.error(error_msg)
+            raise TimeoutError(error_msg)
+        state = lock_state
         
         # Lock acquisito con successo
         lock_mode = "EXCLUSIVE" if exclusive else "SHARED"
@@ -84,7 +288,7 @@ def file_lock(file_path: Path, exclusive: bool = True, timeout: float = LOCK_TIM
         )
         
         # Yield per eseguire operazione protetta
-        yield lock_fd
+        yield state.lock_fd
         
     except Exception as e:
         logger.error(
@@ -93,12 +297,10 @@ def file_lock(file_path: Path, exclusive: bool = True, timeout: float = LOCK_TIM
         )
         raise
     finally:
-        # Rilascia lock
-        if lock_fd is not None:
+        # Rilascia lock (l'fd resta aperto per le acquisizioni successive)
+        if state is not None:
             try:
-                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                state.release(exclusive)
                 logger.debug(f"🔓 Lock rilasciato: {file_path.name} (PID={os.getpid()})")
             except Exception as e:
                 logger.warning(f"Errore rilascio lock per {file_path}: {e}")
-            finally:
-                os.close(lock_fd)
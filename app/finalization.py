@@ -2,6 +2,8 @@
 Sistema di finalizzazione documenti DDT
 Gestisce rinomina, spostamento e archiviazione deterministica
 """
+import filecmp
+import functools
 import os
 import shutil
 import logging
@@ -12,11 +14,36 @@ from app.config import INBOX_DIR, PROCESSATI_DIR
 
 logger = logging.getLogger(__name__)
 
+# Sequenze di caratteri non validi per nomi file (si mantengono lettere, numeri,
+# underscore, trattini e punti): una sola sostituzione per ogni sequenza
+_INVALID_FILENAME_CHARS_RE = re.compile(r'[^\w\-.]+')
+_MULTI_UNDERSCORE_RE = re.compile(r'__+')
 
+
+def _has_same_content(path_a: Path, path_b: Path) -> bool:
+    """
+    True se i due file hanno contenuto identico (confronto byte per byte)
+    
+    Args:
+        path_a: Primo file
+        path_b: Secondo file
+        
+    Returns:
+        True se i contenuti coincidono, False se differiscono o un file non è leggibile
+    """
+    try:
+        return filecmp.cmp(path_a, path_b, shallow=False)
+    except OSError:
+        return False
+
+
+@functools.lru_cache(maxsize=8192)
 def sanitize_filename(text: str) -> str:
     """
     Sanitizza un testo per usarlo come nome file
     
+    Memoizzata (funzione pura): mittenti e destinatari si ripetono in molti documenti.
+    
     Args:
         text: Testo da sanitizzare
         
@@ -26,15 +53,12 @@ def sanitize_filename(text: str) -> str:
     if not text:
         return "UNKNOWN"
     
-    # Sostituisci spazi con underscore
-    sanitized = text.replace(" ", "_")
-    
-    # Rimuovi caratteri speciali non validi per nomi file
-    # Mantieni solo lettere, numeri, underscore, trattini e punti
-    sanitized = re.sub(r'[^\w\-_.]', '', sanitized)
+    # Sostituisci spazi con underscore, poi rimuovi i caratteri speciali non validi
+    sanitized = _INVALID_FILENAME_CHARS_RE.sub('', text.replace(" ", "_"))
     
-    # Rimuovi underscore multipli
-    sanitized = re.sub(r'_+', '_', sanitized)
+    # Rimuovi underscore multipli (solo se presenti: caso raro, evita un passaggio regex)
+    if "__" in sanitized:
+        sanitized = _MULTI_UNDERSCORE_RE.sub('_', sanitized)
     
     # Rimuovi underscore iniziali/finali
     sanitized = sanitized.strip('_')
@@ -45,9 +69,10 @@ def sanitize_filename(text: str) -> str:
     return sanitized
 
 
+@functools.lru_cache(maxsize=4096)
 def generate_final_filename(mittente: str, destinatario: str, numero_documento: str) -> str:
     """
-    Genera il nome file finale standardizzato
+    Genera il nome file finale standardizzato (memoizzata: riprocessamenti dello stesso DDT)
     
     Args:
         mittente: Nome mittente
@@ -131,7 +156,8 @@ def finalize_document(
     from app.paths import get_inbox_dir, ensure_dir, safe_move
     inbox_path = get_inbox_dir()
     source_path = source_path.resolve()
-    if not str(source_path).startswith(str(inbox_path.resolve())):
+    # Confronto per componenti di path (non per prefisso di stringa: /inbox2 non è in /inbox)
+    if not source_path.is_relative_to(inbox_path.resolve()):
         error_msg = f"File non è in inbox: {file_path}"
         logger.error(f"❌ {error_msg}")
         return False, None, error_msg
@@ -153,15 +179,29 @@ def finalize_document(
         # Percorso file finale
         target_path = target_dir / final_filename
         
-        # Se il file esiste già, aggiungi un contatore
-        counter = 1
-        original_target_path = target_path
-        while target_path.exists():
-            name_part = original_target_path.stem
-            target_path = target_dir / f"{name_part}_{counter}.pdf"
-            counter += 1
-            if counter > 1000:  # Protezione contro loop infiniti
-                raise OSError(f"Troppi file duplicati per {final_filename}")
+        # Se il file esiste già, usa un suffisso derivato dall'hash del contenuto
+        # (prefisso breve, poi hash completo) invece di un contatore incrementale.
+        # Un candidato esistente con contenuto identico è lo stesso documento già archiviato
+        stem = target_path.stem
+        candidates = (
+            target_path,
+            target_dir / f"{stem}_{doc_hash[:8]}.pdf",
+            target_dir / f"{stem}_{doc_hash}.pdf",
+        )
+        for candidate in candidates:
+            if not candidate.exists():
+                target_path = candidate
+                break
+            if _has_same_content(source_path, candidate):
+                logger.info(f"♻️ Documento identico già presente in destinazione, nessuno spostamento: {candidate}")
+                try:
+                    source_path.unlink()
+                    logger.info(f"🗑️ Duplicato rimosso da inbox: {source_path}")
+                except OSError as e:
+                    logger.warning(f"⚠️ Impossibile rimuovere duplicato da inbox: {e}")
+                return True, str(candidate), None
+        else:
+            raise OSError(f"Nome file già in uso da documenti diversi: {final_filename}")
         
         # Sposta il file (operazione atomica) usando safe_move
         target_path = safe_move(source_path, target_path)
@@ -4,6 +4,7 @@ Gestisce parametri operativi globali come la data della cartella di output
 
 IMPORTANTE: Usa file locking cross-process per coordinamento WEB/WORKER
 """
+import errno
 import json
 import logging
 import os
@@ -14,23 +15,71 @@ from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# orjson (opzionale) per lettura/scrittura della config: lavora direttamente su bytes.
+# orjson.JSONDecodeError è sottoclasse di json.JSONDecodeError, gestita allo stesso modo
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
 # Lock thread-local per cache (complementare al file lock cross-process)
 _config_lock = threading.Lock()
 
 # Cache della configurazione (thread-safe)
 _config_cache: Optional[Dict[str, Any]] = None
 
+# Impostato quando la cache è popolata: i thread che trovano un caricamento già
+# in corso attendono qui il risultato invece di accodarsi su lock e file lock
+_config_loaded = threading.Event()
+
 from app.paths import get_app_dir, ensure_dir, safe_open
 from app.file_lock import file_lock
 
 # PATH UNICO E ASSOLUTO per configurazione globale
 CONFIG_FILE = get_app_dir() / "global_config.json"
+# Stringhe precalcolate per la scrittura atomica (CONFIG_FILE è già assoluto)
+_CONFIG_PATH = str(CONFIG_FILE)
+_TEMP_CONFIG_PATH = _CONFIG_PATH + ".tmp"
+# errno di os.link sui filesystem senza hard link (creazione iniziale con O_EXCL)
+_NO_HARDLINK_ERRNOS = frozenset({errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV})
+
+# Ultima data di default formattata: (ordinale del giorno, "gg-mm-yyyy")
+_default_date_cache: tuple[int, str] = (0, "")
+
 
 # Valore default per la data di output (oggi in formato gg-mm-yyyy)
-def _get_default_output_date() -> str:
-    """Restituisce la data odierna in formato gg-mm-yyyy"""
-    today = datetime.now()
-    return f"{today.day:02d}-{today.month:02d}-{today.year}"
+def _get_default_output_date(now: Optional[datetime] = None) -> str:
+    """
+    Restituisce la data odierna in formato gg-mm-yyyy
+    
+    Args:
+        now: Istante corrente già calcolato dal chiamante (default: datetime.now())
+    """
+    global _default_date_cache
+    if now is None:
+        now = datetime.now()
+    day_ordinal = now.toordinal()
+    cached_ordinal, formatted = _default_date_cache
+    if cached_ordinal != day_ordinal:
+        formatted = f"{now.day:02d}-{now.month:02d}-{now.year}"
+        _default_date_cache = (day_ordinal, formatted)
+    return formatted
+
+
+def _default_config() -> Dict[str, Any]:
+    """Configurazione di default in memoria (un solo datetime.now() per data e timestamp)"""
+    now = datetime.now()
+    return {
+        "active_output_date": _get_default_output_date(now),
+        "last_updated": now.isoformat()
+    }
 
 
 def _load_config() -> Dict[str, Any]:
@@ -54,7 +103,12 @@ def _load_config() -> Dict[str, Any]:
     if _config_cache is not None:
         return _config_cache
     
-    with _config_lock:
+    # Un solo thread (leader) legge il file; gli altri attendono il suo risultato
+    if not _config_lock.acquire(blocking=False):
+        if _config_loaded.wait(timeout=3.0) and _config_cache is not None:
+            return _config_cache
+        _config_lock.acquire()
+    try:
         # Verifica di nuovo dentro il lock (double-check)
         if _config_cache is not None:
             return _config_cache
@@ -68,15 +122,12 @@ def _load_config() -> Dict[str, Any]:
                         f"File configurazione globale non trovato: {CONFIG_FILE}, "
                         f"uso valori default in memoria (PID={os.getpid()})"
                     )
-                    _config_cache = {
-                        "active_output_date": _get_default_output_date(),
-                        "last_updated": datetime.now().isoformat()
-                    }
+                    _config_cache = _default_config()
                     return _config_cache
                 
                 # Leggi file sotto lock condiviso
-                with safe_open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    _config_cache = json.load(f)
+                with safe_open(CONFIG_FILE, 'rb') as f:
+                    _config_cache = _json_loads(f.read())
                 
                 # Assicura che la struttura sia corretta (solo in memoria)
                 if "active_output_date" not in _config_cache:
@@ -99,10 +150,7 @@ def _load_config() -> Dict[str, Any]:
                 f"Errore parsing JSON configurazione globale: {e} "
                 f"(PID={os.getpid()})"
             )
-            _config_cache = {
-                "active_output_date": _get_default_output_date(),
-                "last_updated": datetime.now().isoformat()
-            }
+            _config_cache = _default_config()
             return _config_cache
         except Exception as e:
             # Errore generico → ritorna default IN MEMORIA (NESSUNA SCRITTURA)
@@ -111,11 +159,12 @@ def _load_config() -> Dict[str, Any]:
                 f"(PID={os.getpid()})",
                 exc_info=True
             )
-            _config_cache = {
-                "active_output_date": _get_default_output_date(),
-                "last_updated": datetime.now().isoformat()
-            }
+            _config_cache = _default_config()
             return _config_cache
+    finally:
+        if _config_cache is not None:
+            _config_loaded.set()
+        _config_lock.release()
 
 
 def _save_config(config: Dict[str, Any]) -> None:
@@ -148,18 +197,18 @@ def _save_config(config: Dict[str, Any]) -> None:
                     config["last_updated"] = timestamp
                     
                     # Scrittura atomica: scrivi in file temporaneo, poi rename
-                    temp_file = CONFIG_FILE.with_suffix('.json.tmp')
-                    
-                    with safe_open(temp_file, 'w', encoding='utf-8') as f:
-                        json.dump(config, f, indent=2, ensure_ascii=False)
+                    with open(_TEMP_CONFIG_PATH, 'wb') as f:
+                        f.write(_json_dumps(config))
                         f.flush()
                         os.fsync(f.fileno())  # Forza scrittura su disco
                     
                     # Rename atomico (cross-platform)
-                    temp_file.replace(CONFIG_FILE)
+                    os.replace(_TEMP_CONFIG_PATH, _CONFIG_PATH)
                     
-                    # Aggiorna la cache
-                    _config_cache = config.copy()
+                    # Aggiorna la cache: il dict è quello restituito da _load_config
+                    # (modificato in set_active_output_date), nessuna copia necessaria
+                    _config_cache = config
+                    _config_loaded.set()
                     
                     logger.info(
                         f"✅ Configurazione globale salvata: "
@@ -196,7 +245,11 @@ def get_active_output_date() -> str:
         Data in formato gg-mm-yyyy (es: "15-01-2026")
     """
     config = _load_config()
-    return config.get("active_output_date", _get_default_output_date())
+    # Default calcolato solo se la chiave manca (non a ogni lettura)
+    try:
+        return config["active_output_date"]
+    except KeyError:
+        return _get_default_output_date()
 
 
 def set_active_output_date(date_str: str) -> None:
@@ -251,8 +304,52 @@ def reload_config() -> None:
     
     with _config_lock:
         _config_cache = None
-        _load_config()
-        logger.info("Configurazione globale ricaricata")
+        _config_loaded.clear()
+    # Fuori dal lock: _load_config lo acquisisce a sua volta (threading.Lock non è rientrante)
+    _load_config()
+    logger.info("Configurazione globale ricaricata")
+
+
+def _create_config_file_exclusive(config: Dict[str, Any]) -> bool:
+    """
+    Crea CONFIG_FILE con il contenuto indicato SOLO SE NON ESISTE, senza file lock
+    
+    Il contenuto viene scritto in un file temporaneo del processo e pubblicato
+    con os.link: come O_CREAT|O_EXCL fallisce se il file esiste già (un solo
+    vincitore tra processi concorrenti), ma i lettori non vedono mai un file parziale.
+    Sui filesystem senza hard link (es. alcuni mount di rete o FAT) si ripiega su
+    os.open con O_CREAT|O_EXCL, ugualmente esclusivo ma senza pubblicazione atomica.
+    
+    Args:
+        config: Configurazione iniziale da scrivere
+        
+    Returns:
+        True se il file è stato creato, False se esisteva già
+    """
+    temp_file = CONFIG_FILE.with_suffix(f".json.{os.getpid()}.init.tmp")
+    try:
+        with safe_open(temp_file, 'wb') as f:
+            f.write(_json_dumps(config))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temp_file, CONFIG_FILE)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in _NO_HARDLINK_ERRNOS:
+                raise
+            logger.debug(f"Hard link non supportati ({e}), creazione con O_EXCL: {CONFIG_FILE}")
+            fd = os.open(CONFIG_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_json_dumps(config))
+                f.flush()
+                os.fsync(f.fileno())
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        temp_file.unlink(missing_ok=True)
 
 
 def ensure_config_file() -> None:
@@ -263,8 +360,9 @@ def ensure_config_file() -> None:
     REGOLA FERREA:
     - Chiamata SOLO all'avvio applicazione (lifespan startup)
     - MAI chiamata da endpoint GET
-    - Usa lock esclusivo per creazione atomica cross-process
-    - NON blocca MAI lo startup: gestisce TimeoutError come caso non critico
+    - Creazione atomica cross-process senza lock (vedi _create_config_file_exclusive):
+      più processi avviati insieme non si serializzano sul file lock
+    - NON blocca MAI lo startup: gli errori vengono gestiti come caso non critico
     
     IMPORTANTE: Chiamare questa funzione UNA SOLA VOLTA all'avvio.
     NON solleva MAI eccezioni per non bloccare lo startup.
@@ -273,107 +371,47 @@ def ensure_config_file() -> None:
     
     pid = os.getpid()
     
-    # Se il file esiste, tenta solo di caricarlo (read-only, non bloccante)
-    if CONFIG_FILE.exists():
-        try:
+    try:
+        # Se il file esiste, tenta solo di caricarlo (read-only)
+        if CONFIG_FILE.exists():
             _load_config()
             logger.debug(
                 f"File configurazione globale esistente: {CONFIG_FILE} "
                 f"(PID={pid})"
             )
             return
-        except Exception as e:
-            # Se il caricamento fallisce, log warning ma continua startup
-            logger.warning(
-                f"Impossibile caricare config esistente (continuerà con default): {e} "
-                f"(PID={pid}, path={CONFIG_FILE})"
+        
+        # Assicura che la directory esista
+        ensure_dir(CONFIG_FILE.parent)
+        
+        default_config = _default_config()
+        
+        if not _create_config_file_exclusive(default_config):
+            # Creato nel frattempo da un altro processo: caricalo
+            _load_config()
+            logger.debug(
+                f"File configurazione globale creato da altro processo: {CONFIG_FILE} "
+                f"(PID={pid})"
             )
-            # Inizializza cache con default in memoria (non blocca startup)
-            _config_cache = {
-                "active_output_date": _get_default_output_date(),
-                "last_updated": datetime.now().isoformat()
-            }
             return
-    
-    # File NON esiste: tenta creazione con lock esclusivo (timeout breve)
-    try:
-        # Timeout breve (1s) per non bloccare startup se WORKER tiene il lock
-        with file_lock(CONFIG_FILE, exclusive=True, timeout=1.0):
-            with _config_lock:
-                # Double-check: file potrebbe essere stato creato da altro processo
-                if CONFIG_FILE.exists():
-                    try:
-                        _load_config()
-                        logger.debug(
-                            f"File configurazione globale creato da altro processo: {CONFIG_FILE} "
-                            f"(PID={pid})"
-                        )
-                        return
-                    except Exception as e:
-                        logger.warning(
-                            f"Impossibile caricare config dopo lock (continuerà con default): {e} "
-                            f"(PID={pid}, path={CONFIG_FILE})"
-                        )
-                        _config_cache = {
-                            "active_output_date": _get_default_output_date(),
-                            "last_updated": datetime.now().isoformat()
-                        }
-                        return
-                
-                # File non esiste, crealo con valori default
-                logger.info(
-                    f"📝 Global config inizializzata: creo {CONFIG_FILE} "
-                    f"(PID={pid})"
-                )
-                
-                # Assicura che la directory esista
-                ensure_dir(CONFIG_FILE.parent)
-                
-                default_config = {
-                    "active_output_date": _get_default_output_date(),
-                    "last_updated": datetime.now().isoformat()
-                }
-                
-                # Salva il file iniziale (sotto lock esclusivo già acquisito)
-                temp_file = CONFIG_FILE.with_suffix('.json.tmp')
-                
-                with safe_open(temp_file, 'w', encoding='utf-8') as f:
-                    json.dump(default_config, f, indent=2, ensure_ascii=False)
-                    f.flush()
-                    os.fsync(f.fileno())
-                
-                temp_file.replace(CONFIG_FILE)
-                
-                # Aggiorna cache
-                _config_cache = default_config.copy()
-                
-                logger.info(
-                    f"✅ Global config inizializzata: "
-                    f"active_output_date={default_config['active_output_date']} "
-                    f"(PID={pid}, path={CONFIG_FILE})"
-                )
-    except TimeoutError:
-        # Lock occupato: NON bloccare startup, log WARNING e continua
-        logger.warning(
-            f"Lock occupato su {CONFIG_FILE} durante startup (WORKER potrebbe tenerlo). "
-            f"Continuerà con valori default in memoria. "
-            f"Config verrà caricata al primo accesso. (PID={pid})"
+        
+        # Aggiorna cache
+        with _config_lock:
+            _config_cache = default_config
+            _config_loaded.set()
+        
+        logger.info(
+            f"✅ Global config inizializzata: "
+            f"active_output_date={default_config['active_output_date']} "
+            f"(PID={pid}, path={CONFIG_FILE})"
         )
-        # Inizializza cache con default in memoria (non blocca startup)
-        _config_cache = {
-            "active_output_date": _get_default_output_date(),
-            "last_updated": datetime.now().isoformat()
-        }
-        # NON rilanciare eccezione: startup può continuare
     except Exception as e:
-        # Altri errori: log WARNING ma NON bloccare startup
+        # Errori: log WARNING ma NON bloccare startup
         logger.warning(
             f"Errore inizializzazione configurazione globale (continuerà con default): {e} "
             f"(PID={pid}, path={CONFIG_FILE})"
         )
         # Inizializza cache con default in memoria (non blocca startup)
-        _config_cache = {
-            "active_output_date": _get_default_output_date(),
-            "last_updated": datetime.now().isoformat()
-        }
+        _config_cache = _default_config()
+        _config_loaded.set()
         # NON rilanciare eccezione: startup può continuare
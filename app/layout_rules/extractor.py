@@ -10,12 +10,31 @@ import base64
 
 from app.layout_rules.models import LayoutRule, FieldBox
 from app.text_extraction.ocr_fallback import extract_text_with_ocr, is_ocr_available
+from app.utils import normalize_date, normalize_float, normalize_text, clean_company_name
+
+# Backend opzionali, risolti una sola volta all'import
+try:
+    import fitz  # PyMuPDF
+    _HAS_FITZ = True
+except ImportError:
+    fitz = None
+    _HAS_FITZ = False
+
+try:
+    from pdf2image import convert_from_path
+except ImportError:
+    convert_from_path = None
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
 
 logger = logging.getLogger(__name__)
 
 
 def extract_field_from_box(
-    image_path: str,
+    image: Image.Image,
     field_box: FieldBox,
     image_width: int,
     image_height: int
@@ -24,7 +43,7 @@ def extract_field_from_box(
     Estrae testo da un box specifico dell'immagine usando OCR
     
     Args:
-        image_path: Percorso dell'immagine PNG
+        image: Immagine della pagina (già decodificata, condivisa tra i campi)
         field_box: Box del campo da estrarre
         image_width: Larghezza dell'immagine in pixel
         image_height: Altezza dell'immagine in pixel
@@ -47,11 +66,8 @@ def extract_field_from_box(
         
         logger.debug(f"  📦 Box coordinates: x={x}, y={y}, w={w}, h={h}")
         
-        # Carica l'immagine
-        img = Image.open(image_path)
-        
         # Ritaglia il box
-        cropped = img.crop((x, y, x + w, y + h))
+        cropped = image.crop((x, y, x + w, y + h))
         
         # OCR sul box ritagliato
         if not is_ocr_available():
@@ -59,7 +75,6 @@ def extract_field_from_box(
             return None
         
         try:
-            import pytesseract
             text = pytesseract.image_to_string(
                 cropped,
                 lang='ita+eng',
@@ -89,7 +104,8 @@ def extract_with_layout_rule(
     pdf_path: str,
     layout_rule: LayoutRule,
     supplier: str,
-    page_count: int
+    page_count: int,
+    pdf_doc: Optional[Any] = None
 ) -> Dict[str, Any]:
     """
     Estrae dati da un PDF usando una layout rule con box grafici
@@ -99,6 +115,8 @@ def extract_with_layout_rule(
         layout_rule: Regola di layout da applicare
         supplier: Nome del fornitore (per logging)
         page_count: Numero di pagine del documento
+        pdf_doc: fitz.Document già aperto (opzionale): se fornito viene riusato
+                 e NON chiuso, evitando una seconda lettura e un secondo parsing del PDF
         
     Returns:
         Dizionario con i dati estratti (può essere parziale, con fallback necessario)
@@ -106,50 +124,46 @@ def extract_with_layout_rule(
     logger.info(f"📦 Applying layout-based extraction for sender: '{supplier}'")
     logger.info(f"   Campi definiti nel modello: {list(layout_rule.fields.keys())}")
     
-    # Converti PDF in PNG (prima pagina)
+    # Converti la prima pagina in immagine, tenuta in memoria: nessun PNG
+    # temporaneo da scrivere su disco e ridecodificare per ogni campo
     try:
-        import fitz  # PyMuPDF
-        with open(pdf_path, 'rb') as f:
-            pdf_bytes = f.read()
-        
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if len(doc) == 0:
-            raise ValueError("PDF vuoto")
-        
-        # Converti prima pagina in immagine
-        page = doc[0]
-        zoom = 200 / 72.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        
-        # Salva temporaneamente l'immagine
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-            tmp_path = tmp_file.name
-            pix.save(tmp_path)
+        if not _HAS_FITZ:
+            raise ImportError("PyMuPDF non installato")
         
+        doc = pdf_doc if pdf_doc is not None else fitz.open(pdf_path)
+        try:
+            if len(doc) == 0:
+                raise ValueError("PDF vuoto")
+            
+            # Converti prima pagina in immagine
+            page = doc[0]
+            zoom = 200 / 72.0
+            mat = fitz.Matrix(zoom, zoom)
+            pix = page.get_pixmap(matrix=mat, alpha=False)
+        finally:
+            if pdf_doc is None:
+                doc.close()
+        
+        if pix.n != 3:
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
         image_width = pix.width
         image_height = pix.height
         
-        doc.close()
-        
-        logger.info(f"✅ PNG generata: {image_width}x{image_height} pixel")
+        logger.info(f"✅ Immagine generata: {image_width}x{image_height} pixel")
         
     except ImportError:
         logger.warning("PyMuPDF non disponibile, provo pdf2image...")
         try:
-            from pdf2image import convert_from_bytes
-            images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
+            if convert_from_path is None:
+                raise ImportError("pdf2image non installato")
+            images = convert_from_path(pdf_path, first_page=1, last_page=1, dpi=200)
             if not images:
                 raise ValueError("Impossibile convertire PDF")
             
-            import tempfile
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-                tmp_path = tmp_file.name
-                images[0].save(tmp_path, 'PNG')
-            
-            image_width, image_height = images[0].size
-            logger.info(f"✅ PNG generata con pdf2image: {image_width}x{image_height} pixel")
+            image = images[0]
+            image_width, image_height = image.size
+            logger.info(f"✅ Immagine generata con pdf2image: {image_width}x{image_height} pixel")
             
         except Exception as e:
             logger.error(f"Errore conversione PDF in PNG: {e}")
@@ -171,7 +185,7 @@ def extract_with_layout_rule(
                 continue
             
             logger.debug(f"  📦 Estrazione campo da box: {field_name}")
-            text = extract_field_from_box(tmp_path, field_box, image_width, image_height)
+            text = extract_field_from_box(image, field_box, image_width, image_height)
             
             if text and text.strip():
                 extracted_data[field_name] = text.strip()
@@ -183,23 +197,10 @@ def extract_with_layout_rule(
         
         logger.info(f"📊 Estrazione box completata: {fields_extracted} campi estratti, {fields_failed} falliti")
         
-        # Pulisci file temporaneo
-        import os
-        try:
-            os.unlink(tmp_path)
-        except:
-            pass
-        
         return extracted_data
         
     except Exception as e:
         logger.error(f"Errore durante estrazione con layout rule: {e}", exc_info=True)
-        # Pulisci file temporaneo
-        import os
-        try:
-            os.unlink(tmp_path)
-        except:
-            pass
         raise
 
 
@@ -213,8 +214,6 @@ def normalize_extracted_box_data(raw_data: Dict[str, str]) -> Dict[str, Any]:
     Returns:
         Dizionario normalizzato pronto per validazione
     """
-    from app.utils import normalize_date, normalize_float, normalize_text, clean_company_name
-    
     normalized = {}
     
     # Normalizza ogni campo
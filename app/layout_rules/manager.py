@@ -2,13 +2,22 @@
 Manager per la gestione delle regole di layout DDT
 Gestisce il salvataggio, caricamento e matching delle regole
 """
+import difflib
 import json
 import logging
+import math
+import re
 import time
 from pathlib import Path
 from typing import Optional, Dict, Any, List
 from app.layout_rules.models import LayoutRule, LayoutRulesFile, BoxCoordinates, FieldBox, LayoutRuleMatch
 
+# pdfplumber è opzionale (signature geometrica): disponibilità risolta all'import
+try:
+    import pdfplumber
+except ImportError:
+    pdfplumber = None
+
 logger = logging.getLogger(__name__)
 
 # Percorso del file delle regole
@@ -24,6 +33,53 @@ LAYOUT_MODEL_SIMILARITY_THRESHOLD = 0.6
 # Soglia di similarità geometrica per layout matching (più alta = più rigorosa)
 LAYOUT_GEOMETRY_SIMILARITY_THRESHOLD = 0.85  # 85% di similarità geometrica richiesta
 
+# Pattern precompilati (una volta all'import, non a ogni chiamata)
+# Suffissi societari rimossi da normalize_sender, applicati nell'ordine
+_SENDER_SUFFIX_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'\bspa\b',
+    r'\bsrl\b',
+    r'\bs\.r\.l\.',
+    r'\bs\.p\.a\.',
+    r'\bspa\.',
+    r'\bsas\b',
+    r'\bs\.a\.s\.',
+    r'\bsa\b',
+    r'\bs\.a\.',
+    r'\bcon socio unico\b',
+    r'\bcon socio unico\.',
+    r'\bsocietà\b',
+    r'\bsocieta\b',
+    r'\bsnc\b',
+    r'\bs\.n\.c\.',
+    r'\bsas\b',
+    r'\bs\.a\.s\.',
+))
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Label dei campi standard cercate nelle parole della pagina (firma del layout)
+_FIELD_LABEL_PATTERNS = {
+    field_name: tuple(re.compile(p, re.IGNORECASE) for p in patterns)
+    for field_name, patterns in {
+        'mittente': [r'mittente', r'da:', r'fornitore', r'spett\.le'],
+        'destinatario': [r'destinatario', r'a:', r'cliente', r'consegna'],
+        'data': [r'data', r'data\s+ddt', r'data\s+documento', r'emissione'],
+        'numero_documento': [r'numero', r'ddt\s+n\.', r'numero\s+ddt', r'documento\s+n\.'],
+        'totale_kg': [r'totale\s+kg', r'peso\s+totale', r'kg\s+complessivi', r'totale\s+peso'],
+    }.items()
+}
+
+# Potenziali mittenti nell'intestazione del testo (pre-detection fuzzy)
+_MITTENTE_PREDETECT_PATTERNS = (
+    re.compile(r'(?:Mittente|Da:|Fornitore|Spett\.le)\s*:?\s*([A-Z][A-Za-z0-9\s&\.]+(?:S\.r\.l\.|S\.p\.A\.|S\.A\.S\.|S\.A\.|SRL|SPA)?)', re.IGNORECASE),
+    re.compile(r'([A-Z][A-Za-z0-9\s&\.]+)\s*(?:S\.r\.l\.|S\.p\.A\.|S\.A\.S\.|S\.A\.|SRL|SPA)', re.IGNORECASE),
+)
+
+# Parole non discriminanti da ignorare nel matching dei mittenti
+_SENDER_STOP_WORDS = frozenset({
+    'srl', 'spa', 'sas', 'snc', 'societa', 'società', 'con', 'socio', 'unico',
+    'di', 'da', 'e', 'il', 'la', 'le', 'un', 'una', 'per', 'in', 'a',
+})
+
 
 def calculate_sender_similarity(sender1: str, sender2: str) -> float:
     """
@@ -41,23 +97,15 @@ def calculate_sender_similarity(sender1: str, sender2: str) -> float:
     Returns:
         Score di similarità tra 0.0 e 1.0
     """
-    import difflib
-    
     if not sender1 or not sender2:
         return 0.0
     
-    # Parole non discriminanti da ignorare nel matching
-    stop_words = {'srl', 'spa', 'sas', 'snc', 'srl', 'spa', 'sas', 'snc', 
-                  'societa', 'società', 'con', 'socio', 'unico', 'di', 'da', 
-                  'e', 'il', 'la', 'le', 'un', 'una', 'per', 'in', 'a'}
+    sender1 = sender1.lower()
+    sender2 = sender2.lower()
     
     # Tokenizza e filtra stop words
-    def tokenize_and_filter(text: str) -> set:
-        tokens = set(text.lower().split())
-        return tokens - stop_words
-    
-    tokens1 = tokenize_and_filter(sender1)
-    tokens2 = tokenize_and_filter(sender2)
+    tokens1 = set(sender1.split()) - _SENDER_STOP_WORDS
+    tokens2 = set(sender2.split()) - _SENDER_STOP_WORDS
     
     # Calcola token overlap (Jaccard similarity)
     if tokens1 or tokens2:
@@ -68,7 +116,7 @@ def calculate_sender_similarity(sender1: str, sender2: str) -> float:
         token_similarity = 0.0
     
     # Calcola sequence similarity (difflib)
-    sequence_similarity = difflib.SequenceMatcher(None, sender1.lower(), sender2.lower()).ratio()
+    sequence_similarity = difflib.SequenceMatcher(None, sender1, sender2).ratio()
     
     # Combina i due score (media pesata: 60% token, 40% sequence)
     # Token overlap è più robusto per variazioni OCR
@@ -96,8 +144,6 @@ def normalize_sender(name: str) -> str:
     if not name:
         return ""
     
-    import re
-    
     # Lowercase
     normalized = name.lower().strip()
     
@@ -110,31 +156,11 @@ def normalize_sender(name: str) -> str:
     normalized = normalized.replace("\\", " ")
     
     # Rimuovi suffissi comuni (case-insensitive)
-    suffixes = [
-        r'\bspa\b',
-        r'\bsrl\b',
-        r'\bs\.r\.l\.',
-        r'\bs\.p\.a\.',
-        r'\bspa\.',
-        r'\bsas\b',
-        r'\bs\.a\.s\.',
-        r'\bsa\b',
-        r'\bs\.a\.',
-        r'\bcon socio unico\b',
-        r'\bcon socio unico\.',
-        r'\bsocietà\b',
-        r'\bsocieta\b',
-        r'\bsnc\b',
-        r'\bs\.n\.c\.',
-        r'\bsas\b',
-        r'\bs\.a\.s\.',
-    ]
-    
-    for suffix in suffixes:
-        normalized = re.sub(suffix, '', normalized, flags=re.IGNORECASE)
+    for suffix_pattern in _SENDER_SUFFIX_PATTERNS:
+        normalized = suffix_pattern.sub('', normalized)
     
     # Normalizza spazi multipli in singolo spazio
-    normalized = re.sub(r'\s+', ' ', normalized)
+    normalized = _WHITESPACE_RE.sub(' ', normalized)
     
     # Trim finale
     normalized = normalized.strip()
@@ -169,23 +195,25 @@ def load_layout_rules(force_reload: bool = False) -> Dict[str, LayoutRule]:
     """
     global _layout_rules_cache, _layout_rules_cache_timestamp
     
+    # Un solo stat() per chiamata: mtime None = file assente/non accessibile.
+    # La cache vale anche per i casi vuoto/invalido/assente (niente rilettura né
+    # warning ripetuti a ogni PDF finché il file non cambia)
+    try:
+        file_mtime: Optional[float] = LAYOUT_RULES_FILE.stat().st_mtime
+    except OSError:
+        file_mtime = None
+    
     # Usa cache se disponibile e file non modificato
-    if not force_reload and _layout_rules_cache is not None and LAYOUT_RULES_FILE.exists():
-        try:
-            file_mtime = LAYOUT_RULES_FILE.stat().st_mtime
-            if _layout_rules_cache_timestamp == file_mtime:
-                return _layout_rules_cache
-        except Exception:
-            # Se errore controllo timestamp, ricarica
-            pass
+    if not force_reload and _layout_rules_cache is not None and _layout_rules_cache_timestamp == file_mtime:
+        return _layout_rules_cache
     
     # FAIL-FAST: Se file non esiste → WARNING + ritorna dict vuoto
-    if not LAYOUT_RULES_FILE.exists():
+    if file_mtime is None:
         logger.warning("File layout rules non trovato: %s", str(LAYOUT_RULES_FILE))
         logger.info("Nessun layout rule caricato (fallback automatico su AI)")
         # Aggiorna cache vuota
         _layout_rules_cache = {}
-        _layout_rules_cache_timestamp = None
+        _layout_rules_cache_timestamp = file_mtime
         return {}
     
     # FAIL-FAST: Caricamento one-shot, no retry
@@ -199,7 +227,7 @@ def load_layout_rules(force_reload: bool = False) -> Dict[str, LayoutRule]:
             logger.info("Nessun layout rule caricato (fallback automatico su AI)")
             # Aggiorna cache vuota
             _layout_rules_cache = {}
-            _layout_rules_cache_timestamp = None
+            _layout_rules_cache_timestamp = file_mtime
             return {}
         
         # FAIL-FAST: JSON invalido → ERROR + cache vuota + ritorna dict vuoto
@@ -210,7 +238,7 @@ def load_layout_rules(force_reload: bool = False) -> Dict[str, LayoutRule]:
             logger.info("Nessun layout rule caricato (fallback automatico su AI)")
             # Aggiorna cache vuota
             _layout_rules_cache = {}
-            _layout_rules_cache_timestamp = None
+            _layout_rules_cache_timestamp = file_mtime
             return {}
         
         # Validazione: deve essere un dict
@@ -219,7 +247,7 @@ def load_layout_rules(force_reload: bool = False) -> Dict[str, LayoutRule]:
             logger.info("Nessun layout rule caricato (fallback automatico su AI)")
             # Aggiorna cache vuota
             _layout_rules_cache = {}
-            _layout_rules_cache_timestamp = None
+            _layout_rules_cache_timestamp = file_mtime
             return {}
         
         # JSON valido ma senza regole → WARNING + cache vuota + ritorna dict vuoto
@@ -228,7 +256,7 @@ def load_layout_rules(force_reload: bool = False) -> Dict[str, LayoutRule]:
             logger.info("Nessun layout rule caricato (fallback automatico su AI)")
             # Aggiorna cache vuota
             _layout_rules_cache = {}
-            _layout_rules_cache_timestamp = None
+            _layout_rules_cache_timestamp = file_mtime
             return {}
         
         # CASO NORMALE: Converti JSON in oggetti LayoutRule
@@ -256,10 +284,7 @@ def load_layout_rules(force_reload: bool = False) -> Dict[str, LayoutRule]:
         
         # Aggiorna cache
         _layout_rules_cache = rules
-        try:
-            _layout_rules_cache_timestamp = LAYOUT_RULES_FILE.stat().st_mtime if LAYOUT_RULES_FILE.exists() else None
-        except Exception:
-            _layout_rules_cache_timestamp = None
+        _layout_rules_cache_timestamp = file_mtime
         
         # Log esplicito con lista delle chiavi (solo in DEBUG per ridurre verbosity)
         rule_keys = list(rules.keys())
@@ -324,8 +349,6 @@ def save_layout_rules(rules: Dict[str, LayoutRule]):
             sender_counts[sender_normalized] = sender_counts.get(sender_normalized, 0) + 1
         
         # PROTEZIONE: Salva prima in file temporaneo, poi rinomina (atomic write)
-        import tempfile
-        import shutil
         temp_file = None
         try:
             # Crea file temporaneo nella stessa directory
@@ -511,18 +534,11 @@ def extract_pdf_layout_signature(file_path: str, page_count: Optional[int] = Non
     Returns:
         Lista di float rappresentante la signature geometrica o None se fallito
     """
+    if pdfplumber is None:
+        logger.debug("pdfplumber non disponibile per estrazione signature")
+        return None
+    
     try:
-        import pdfplumber
-        
-        # Campi standard da cercare con i loro pattern di label
-        field_patterns = {
-            'mittente': [r'mittente', r'da:', r'fornitore', r'spett\.le'],
-            'destinatario': [r'destinatario', r'a:', r'cliente', r'consegna'],
-            'data': [r'data', r'data\s+ddt', r'data\s+documento', r'emissione'],
-            'numero_documento': [r'numero', r'ddt\s+n\.', r'numero\s+ddt', r'documento\s+n\.'],
-            'totale_kg': [r'totale\s+kg', r'peso\s+totale', r'kg\s+complessivi', r'totale\s+peso']
-        }
-        
         signature = []
         page_to_use = 0  # Prima pagina (base 0)
         
@@ -547,7 +563,7 @@ def extract_pdf_layout_signature(file_path: str, page_count: Optional[int] = Non
             page_height = float(page.height)
             
             # Per ogni campo standard, cerca il pattern e estrai posizione
-            for field_name, patterns in field_patterns.items():
+            for field_name, patterns in _FIELD_LABEL_PATTERNS.items():
                 field_found = False
                 
                 # Cerca pattern nei testi
@@ -556,8 +572,7 @@ def extract_pdf_layout_signature(file_path: str, page_count: Optional[int] = Non
                     
                     # Verifica se il testo corrisponde a uno dei pattern
                     for pattern in patterns:
-                        import re
-                        if re.search(pattern, word_text, re.IGNORECASE):
+                        if pattern.search(word_text):
                             # Trovato! Estrai posizione del valore (di solito a destra del label)
                             x0 = word.get('x0', 0)
                             y0 = word.get('top', 0)  # pdfplumber usa 'top' invece di 'y0'
@@ -590,9 +605,6 @@ def extract_pdf_layout_signature(file_path: str, page_count: Optional[int] = Non
         
         return signature
         
-    except ImportError:
-        logger.debug("pdfplumber non disponibile per estrazione signature")
-        return None
     except Exception as e:
         logger.debug(f"Errore estrazione signature PDF: {e}")
         return None
@@ -618,7 +630,6 @@ def calculate_geometry_similarity(signature1: List[float], signature2: List[floa
         return 0.0
     
     # Calcola distanza euclidea normalizzata
-    import math
     squared_diff = sum((a - b) ** 2 for a, b in zip(signature1, signature2))
     euclidean_distance = math.sqrt(squared_diff)
     
@@ -725,11 +736,56 @@ def detect_layout_model_by_geometry(
         return None
 
 
+def detect_layout_model_without_text(
+    file_path: str,
+    page_count: Optional[int] = None
+) -> Optional[tuple[str, LayoutRule]]:
+    """
+    Pre-check veloce del layout model, senza testo estratto dal PDF
+    
+    Usa solo le strategie che non richiedono l'estrazione del testo:
+    1. Layout similarity (box geometry), come in detect_layout_model_advanced
+    2. Nome file che contiene il supplier normalizzato completo di UNA sola regola
+       con page count compatibile (con più candidati decide il matching testuale)
+    
+    Args:
+        file_path: Percorso del file PDF
+        page_count: Numero di pagine del documento
+        
+    Returns:
+        Tupla (rule_name, LayoutRule) se trovata con confidenza, None altrimenti
+    """
+    geometry_match = detect_layout_model_by_geometry(file_path, page_count)
+    if geometry_match:
+        logger.info(f"✅ LAYOUT MODEL MATCHED via GEOMETRY: '{geometry_match[0]}' (skip estrazione testo)")
+        return geometry_match
+    
+    rules = load_layout_rules()
+    if not rules:
+        return None
+    
+    file_name = Path(file_path).stem.lower()
+    filename_matches = []
+    for rule_name, rule in rules.items():
+        if rule.match.page_count is not None and rule.match.page_count != page_count:
+            continue
+        supplier_normalized = normalize_sender(rule.match.supplier)
+        if supplier_normalized and supplier_normalized in file_name:
+            filename_matches.append((rule_name, rule))
+    
+    if len(filename_matches) == 1:
+        rule_name, rule = filename_matches[0]
+        logger.info(f"✅ LAYOUT MODEL MATCHED via NOME FILE: '{rule_name}' (supplier: '{rule.match.supplier}', skip estrazione testo)")
+        return filename_matches[0]
+    return None
+
+
 def detect_layout_model_advanced(
     pdf_text: str,
     file_path: str,
     page_count: Optional[int] = None,
-    similarity_threshold: float = LAYOUT_MODEL_SIMILARITY_THRESHOLD
+    similarity_threshold: float = LAYOUT_MODEL_SIMILARITY_THRESHOLD,
+    skip_geometry: bool = False
 ) -> Optional[tuple[str, LayoutRule]]:
     """
     Pre-detection avanzata del layout model usando STRATEGIE COMBINATE
@@ -747,19 +803,21 @@ def detect_layout_model_advanced(
         file_path: Percorso del file PDF
         page_count: Numero di pagine del documento
         similarity_threshold: Soglia minima di similarità per fallback testuale (default: 0.6)
+        skip_geometry: Salta la strategia geometrica (già provata da detect_layout_model_without_text)
         
     Returns:
         Tupla (rule_name, LayoutRule) se trovata, None altrimenti
     """
     # STRATEGIA 1: Layout similarity (GEOMETRY) - PRIORITARIA
     # Ignora completamente il testo, confronta solo le posizioni delle box
-    logger.debug(f"🔍 Strategia 1: Layout matching geometrico (PRIORITARIA)")
-    geometry_match = detect_layout_model_by_geometry(file_path, page_count)
-    
-    if geometry_match:
-        rule_name, rule = geometry_match
-        logger.info(f"✅ LAYOUT MODEL MATCHED via GEOMETRY: '{rule_name}' (skip fallback testuale)")
-        return geometry_match
+    if not skip_geometry:
+        logger.debug(f"🔍 Strategia 1: Layout matching geometrico (PRIORITARIA)")
+        geometry_match = detect_layout_model_by_geometry(file_path, page_count)
+        
+        if geometry_match:
+            rule_name, rule = geometry_match
+            logger.info(f"✅ LAYOUT MODEL MATCHED via GEOMETRY: '{rule_name}' (skip fallback testuale)")
+            return geometry_match
     
     # STRATEGIA 2: Fallback a matching testuale (solo se geometry fallisce)
     logger.debug(f"🔍 Strategia 2: Layout matching testuale (fallback)")
@@ -769,10 +827,6 @@ def detect_layout_model_advanced(
         logger.debug("⚠️ Nessuna regola di layout disponibile per pre-detection")
         return None
     
-    import os
-    import re
-    from pathlib import Path
-    
     file_name = Path(file_path).stem.lower()
     logger.debug(f"🔍 Layout pre-detection avanzata: analizzando file '{file_name}' (threshold: {similarity_threshold:.2f})")
     
@@ -783,18 +837,18 @@ def detect_layout_model_advanced(
     extracted_mittenti = []
     if pdf_text:
         try:
-            mittente_patterns = [
-                r'(?:Mittente|Da:|Fornitore|Spett\.le)\s*:?\s*([A-Z][A-Za-z0-9\s&\.]+(?:S\.r\.l\.|S\.p\.A\.|S\.A\.S\.|S\.A\.|SRL|SPA)?)',
-                r'([A-Z][A-Za-z0-9\s&\.]+)\s*(?:S\.r\.l\.|S\.p\.A\.|S\.A\.S\.|S\.A\.|SRL|SPA)',
-            ]
-            for pattern in mittente_patterns:
-                match = re.search(pattern, pdf_text[:1000], re.IGNORECASE)
+            for pattern in _MITTENTE_PREDETECT_PATTERNS:
+                match = pattern.search(pdf_text, 0, 1000)
                 if match:
                     extracted_mittente = match.group(1).strip()
                     extracted_mittenti.append(extracted_mittente)
         except Exception as e:
             logger.debug(f"Errore estrazione mittente per pre-detection: {e}")
     
+    # Pre-elaborazione una sola volta per chiamata (non per regola)
+    extracted_normalized = [(mittente, normalize_sender(mittente)) for mittente in extracted_mittenti]
+    file_tokens = set(file_name.split('_'))
+    
     candidate_rules = []
     
     for rule_name, rule in rules.items():
@@ -817,17 +871,21 @@ def detect_layout_model_advanced(
         best_similarity = 0.0
         match_reason = None
         
+        # Similarità migliore tra i mittenti estratti e il supplier (calcolata una sola
+        # volta: la usano sia il Test 1 che il Test 3)
+        mittente_similarity = 0.0
+        best_mittente = None
+        for extracted_mittente, mittente_normalized in extracted_normalized:
+            similarity = calculate_sender_similarity(mittente_normalized, supplier_normalized)
+            if similarity > mittente_similarity:
+                mittente_similarity = similarity
+                best_mittente = extracted_mittente
+        
         # Test 1: Keyword nel testo + fuzzy matching su mittenti estratti
-        if keywords and text_sample:
-            keyword_found = any(keyword in text_sample for keyword in keywords)
-            if keyword_found:
-                # Se keyword trovata, prova fuzzy matching con mittenti estratti
-                for extracted_mittente in extracted_mittenti:
-                    extracted_normalized = normalize_sender(extracted_mittente)
-                    similarity = calculate_sender_similarity(extracted_normalized, supplier_normalized)
-                    if similarity > best_similarity:
-                        best_similarity = similarity
-                        match_reason = f"keyword '{keywords[0]}' + fuzzy match (mittente estratto: '{extracted_mittente}')"
+        if best_mittente is not None and keywords and text_sample:
+            if any(keyword in text_sample for keyword in keywords):
+                best_similarity = mittente_similarity
+                match_reason = f"keyword '{keywords[0]}' + fuzzy match (mittente estratto: '{best_mittente}')"
         
         # Test 2: Nome file + fuzzy matching
         if supplier_normalized:
@@ -838,9 +896,7 @@ def detect_layout_model_advanced(
                     best_similarity = similarity
                     match_reason = "nome file contiene supplier completo"
             else:
-                # Prova fuzzy matching con nome file
-                # Estrai potenziali mittenti dal nome file
-                file_tokens = set(file_name.split('_'))
+                # Prova fuzzy matching con nome file (token del nome file calcolati sopra)
                 supplier_tokens = set(supplier_normalized.split())
                 if supplier_tokens & file_tokens:  # Se ci sono token comuni
                     similarity = calculate_sender_similarity(file_name, supplier_normalized)
@@ -849,12 +905,9 @@ def detect_layout_model_advanced(
                         match_reason = f"fuzzy match con nome file"
         
         # Test 3: Fuzzy matching diretto con mittenti estratti
-        for extracted_mittente in extracted_mittenti:
-            extracted_normalized = normalize_sender(extracted_mittente)
-            similarity = calculate_sender_similarity(extracted_normalized, supplier_normalized)
-            if similarity > best_similarity:
-                best_similarity = similarity
-                match_reason = f"fuzzy match diretto (mittente estratto: '{extracted_mittente}')"
+        if mittente_similarity > best_similarity:
+            best_similarity = mittente_similarity
+            match_reason = f"fuzzy match diretto (mittente estratto: '{best_mittente}')"
         
         # FIX #3: Se page_count mismatch ma similarity alta (>= 0.8) → procedi con warning
         if best_similarity >= similarity_threshold:
@@ -1,10 +1,11 @@
 """
 Modelli Pydantic per validazione e normalizzazione dati DDT
 """
-from datetime import datetime
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field, field_validator, model_validator
 
+from app.utils import normalize_date, normalize_float, normalize_text
+
 
 class DDTData(BaseModel):
     """Modello per i dati estratti da un DDT"""
@@ -14,64 +15,38 @@ class DDTData(BaseModel):
     numero_documento: str = Field(..., min_length=1, description="Numero del documento DDT")
     totale_kg: float = Field(..., ge=0, description="Peso totale in kg (>= 0)")
 
-    @field_validator('data')
+    # Coercizione in modalità "before" con gli stessi normalizzatori di app.utils
+    # usati dall'estrazione: il modello accetta direttamente i valori grezzi di
+    # Vision e i valori già normalizzati passano invariati (fast path)
+    @field_validator('data', mode='before')
     @classmethod
-    def validate_date(cls, v: str) -> str:
-        """Valida e normalizza la data"""
+    def validate_date(cls, v) -> str:
+        """Valida e normalizza la data in formato YYYY-MM-DD"""
         if not v:
             raise ValueError("La data non può essere vuota")
-        
-        # Prova vari formati di data comuni
-        date_formats = [
-            '%Y-%m-%d',
-            '%d/%m/%Y',
-            '%d-%m-%Y',
-            '%Y/%m/%d',
-            '%d.%m.%Y',
-        ]
-        
-        # Se è già nel formato corretto, restituiscilo
-        try:
-            datetime.strptime(v, '%Y-%m-%d')
-            return v
-        except ValueError:
-            pass
-        
-        # Prova a parsare altri formati
-        for fmt in date_formats:
-            try:
-                dt = datetime.strptime(v.strip(), fmt)
-                return dt.strftime('%Y-%m-%d')
-            except ValueError:
-                continue
-        
-        raise ValueError(f"Formato data non valido: {v}. Atteso formato YYYY-MM-DD o varianti comuni")
+        normalized = normalize_date(v if isinstance(v, str) else str(v))
+        if normalized is None:
+            raise ValueError(f"Formato data non valido: {v}. Atteso formato YYYY-MM-DD o varianti comuni")
+        return normalized
 
     @field_validator('totale_kg', mode='before')
     @classmethod
     def normalize_kg(cls, v) -> float:
         """Normalizza il valore dei kg convertendo stringhe in float"""
-        if isinstance(v, (int, float)):
-            return float(v)
-        if isinstance(v, str):
-            # Rimuovi spazi e caratteri non numerici eccetto punto e virgola
-            cleaned = v.strip().replace(',', '.').replace(' ', '')
-            try:
-                return float(cleaned)
-            except ValueError:
-                raise ValueError(f"Impossibile convertire '{v}' in numero per totale_kg")
-        raise ValueError(f"Tipo non valido per totale_kg: {type(v)}")
+        if not isinstance(v, (int, float, str)):
+            raise ValueError(f"Tipo non valido per totale_kg: {type(v)}")
+        normalized = normalize_float(v)
+        if normalized is None:
+            raise ValueError(f"Impossibile convertire '{v}' in numero per totale_kg")
+        return normalized
 
     @field_validator('mittente', 'destinatario', 'numero_documento', mode='before')
     @classmethod
-    def normalize_text(cls, v) -> str:
-        """Normalizza i testi rimuovendo spazi extra"""
+    def normalize_text_fields(cls, v) -> str:
+        """Normalizza i testi rimuovendo spazi extra e caratteri invisibili"""
         if not v:
             return ""
-        if not isinstance(v, str):
-            v = str(v)
-        # Rimuovi spazi multipli e trim
-        normalized = ' '.join(v.strip().split())
+        normalized = normalize_text(v if isinstance(v, str) else str(v))
         if not normalized:
             raise ValueError("Il campo non può essere vuoto dopo la normalizzazione")
         return normalized
@@ -79,8 +54,8 @@ class DDTData(BaseModel):
     @model_validator(mode='after')
     def validate_consistency(self):
         """Validazioni aggiuntive di coerenza"""
-        # Mittente e destinatario non possono essere uguali
-        if self.mittente.lower() == self.destinatario.lower():
+        # Mittente e destinatario non possono essere uguali (confronto lunghezze prima del casefold)
+        if len(self.mittente) == len(self.destinatario) and self.mittente.casefold() == self.destinatario.casefold():
             raise ValueError("Mittente e destinatario non possono essere identici")
         
         return self
@@ -101,6 +76,7 @@ class RuleOverride(BaseModel):
     """Modello per gli override di una regola"""
     totale_kg_mode: Optional[str] = Field(None, description="Modalità calcolo totale kg (es: 'sum_rows')")
     multipage: Optional[bool] = Field(None, description="Se il documento è multipagina")
+    keep_color: Optional[bool] = Field(None, description="Se inviare l'immagine a colori (timbri/loghi rilevanti)")
 
 
 class RuleData(BaseModel):
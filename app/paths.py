@@ -150,6 +150,16 @@ def get_preview_dir() -> Path:
     return ensure_dir(get_path("tmp", "preview"))
 
 
+def get_vision_cache_dir() -> Path:
+    """Restituisce il path assoluto della directory tmp/vision_cache"""
+    return ensure_dir(get_path("tmp", "vision_cache"))
+
+
+def get_extract_cache_dir() -> Path:
+    """Restituisce il path assoluto della directory tmp/extract_cache"""
+    return ensure_dir(get_path("tmp", "extract_cache"))
+
+
 def get_app_dir() -> Path:
     """Restituisce il path assoluto della directory app"""
     return ensure_dir(get_path("app"))
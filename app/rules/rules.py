@@ -2,6 +2,7 @@
 Gestione dinamica delle regole per l'estrazione DDT
 Carica, salva e applica regole personalizzate per fornitori specifici
 """
+import functools
 import json
 import logging
 import os
@@ -115,6 +116,8 @@ def _save_rules(rules: Dict[str, Any]) -> None:
             
             # Aggiorna la cache
             _rules_cache = rules.copy()
+            build_prompt_additions.cache_clear()
+            _detect_rule_cached.cache_clear()
             logger.info("Regole salvate in %s", str(RULES_FILE))
         except (OSError, IOError, PermissionError):
             # Errori di I/O su path critici: propaga esplicitamente senza mascherare
@@ -129,6 +132,8 @@ def reload_rules() -> None:
     global _rules_cache
     with _rules_lock:
         _rules_cache = None
+    build_prompt_additions.cache_clear()
+    _detect_rule_cached.cache_clear()
     _load_rules()
 
 
@@ -201,7 +206,16 @@ def detect_rule(text: str) -> Optional[str]:
     """
     if not text:
         return None
-    
+    return _detect_rule_cached(text)
+
+
+@functools.lru_cache(maxsize=128)
+def _detect_rule_cached(text: str) -> Optional[str]:
+    """
+    Scansione delle regole per detect_rule, memoizzata sul testo completo:
+    reprocess e upload duplicati dello stesso DDT non ripetono la scansione
+    (la cache viene svuotata da _save_rules/reload_rules)
+    """
     text_upper = text.upper()
     rules = _load_rules()
     
@@ -220,9 +234,11 @@ def detect_rule(text: str) -> Optional[str]:
     return None
 
 
+@functools.lru_cache(maxsize=64)
 def build_prompt_additions(rule_name: str) -> str:
     """
     Costruisce le aggiunte al prompt basate sulla regola
+    (memoizzata: la cache viene svuotata da _save_rules/reload_rules)
     
     Args:
         rule_name: Nome della regola
@@ -252,3 +268,21 @@ def build_prompt_additions(rule_name: str) -> str:
     
     return "\n".join(additions)
 
+
+def rule_keeps_color(rule_name: Optional[str]) -> bool:
+    """
+    Indica se la regola richiede l'immagine a colori per l'estrazione Vision
+    (es. timbri o loghi colorati significativi per il fornitore)
+    
+    Args:
+        rule_name: Nome della regola (opzionale)
+        
+    Returns:
+        True se la regola ha l'override 'keep_color', False altrimenti
+    """
+    if not rule_name:
+        return False
+    rule = get_rule(rule_name)
+    if not rule:
+        return False
+    return bool(rule.get("overrides", {}).get("keep_color"))
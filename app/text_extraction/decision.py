@@ -9,6 +9,11 @@ from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
+# Pattern OCR-like penalizzati nel punteggio di qualità (precompilati)
+_ISOLATED_LETTER_RE = re.compile(r'\s[a-zA-Z]\s')
+# Nota: il trattino - deve essere escapato o messo alla fine/inizio della classe caratteri
+_STRANGE_SEQUENCE_RE = re.compile(r'[^\w\s.,;:/()\[\]{}-]{3,}')
+
 
 @dataclass
 class TextExtractionResult:
@@ -67,12 +72,11 @@ def _calculate_readability_score(text: str) -> float:
     
     # Penalizza pattern OCR-like (molte lettere isolate)
     # Pattern: spazio + singola lettera + spazio (es. " a b c ")
-    isolated_letters = len(re.findall(r'\s[a-zA-Z]\s', text))
+    isolated_letters = len(_ISOLATED_LETTER_RE.findall(text))
     isolated_penalty = min(isolated_letters / max(len(text.split()), 1), 0.3)
     
     # Penalizza sequenze di caratteri strani ripetuti
-    # Nota: il trattino - deve essere escapato o messo alla fine/inizio della classe caratteri
-    strange_patterns = len(re.findall(r'[^\w\s.,;:/()\[\]{}-]{3,}', text))
+    strange_patterns = len(_STRANGE_SEQUENCE_RE.findall(text))
     strange_penalty = min(strange_patterns * 0.1, 0.2)
     
     final_score = readability_ratio - isolated_penalty - strange_penalty
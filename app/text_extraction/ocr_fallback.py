@@ -3,9 +3,21 @@ OCR fallback usando pytesseract
 Usato SOLO quando PyMuPDF e pdfplumber falliscono
 NON è il metodo di default - solo come ultima risorsa
 """
+import functools
 import logging
 from typing import Optional, Tuple
 
+# Dipendenze OCR opzionali, risolte una sola volta all'import:
+# _OCR_MISSING_MODULE è il primo modulo mancante (None se tutto installato)
+try:
+    import pytesseract
+    from pdf2image import convert_from_path
+    _OCR_MISSING_MODULE: Optional[str] = None
+except ImportError as e:
+    pytesseract = None
+    convert_from_path = None
+    _OCR_MISSING_MODULE = e.name or "unknown"
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,11 +38,15 @@ def extract_text_with_ocr(file_path: str, max_pages: int = 3, dpi: int = 300) ->
         - testo_estratto: Testo estratto o None se fallito
         - metadati: Dict con info su estrazione
     """
+    if _OCR_MISSING_MODULE is not None:
+        logger.debug(f"OCR non disponibile: {_OCR_MISSING_MODULE} non installato")
+        return None, {
+            "method": "ocr",
+            "error": f"not_installed_{_OCR_MISSING_MODULE}",
+            "success": False
+        }
+    
     try:
-        import pytesseract
-        from pdf2image import convert_from_path
-        from PIL import Image
-        
         metadata = {
             "method": "ocr",
             "pages_processed": 0,
@@ -80,33 +96,28 @@ def extract_text_with_ocr(file_path: str, max_pages: int = 3, dpi: int = 300) ->
             logger.warning(f"OCR: nessun testo estratto da {file_path}")
             return None, metadata
             
-    except ImportError as e:
-        missing_module = str(e).split()[-1] if " " in str(e) else "unknown"
-        logger.debug(f"OCR non disponibile: {missing_module} non installato")
-        return None, {
-            "method": "ocr",
-            "error": f"not_installed_{missing_module}",
-            "success": False
-        }
     except Exception as e:
         logger.warning(f"Errore estrazione OCR: {e}")
         return None, {"method": "ocr", "error": str(e), "success": False}
 
 
+@functools.lru_cache(maxsize=1)
 def is_ocr_available() -> bool:
     """
     Verifica se OCR è disponibile nel sistema
     
+    Memoizzata: la verifica di tesseract avvia un processo esterno e
+    l'installazione non cambia durante la vita del processo.
+    
     Returns:
         True se pytesseract e pdf2image sono installati e funzionanti
     """
+    if _OCR_MISSING_MODULE is not None:
+        return False
     try:
-        import pytesseract
-        from pdf2image import convert_from_path
-        
         # Prova a verificare che tesseract sia installato
         pytesseract.get_tesseract_version()
         return True
-    except (ImportError, Exception):
+    except Exception:
         return False
 
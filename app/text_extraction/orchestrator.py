@@ -3,7 +3,7 @@ Orchestratore della pipeline di estrazione testo
 Gestisce la sequenza: PyMuPDF -> pdfplumber -> OCR (solo se necessario)
 """
 import logging
-from typing import Optional
+from typing import Any, Optional
 
 from app.text_extraction.pymupdf_extractor import extract_text_with_pymupdf
 from app.text_extraction.pdfplumber_extractor import extract_text_with_pdfplumber
@@ -13,7 +13,12 @@ from app.text_extraction.decision import evaluate_extraction_result, TextExtract
 logger = logging.getLogger(__name__)
 
 
-def extract_text_pipeline(file_path: str, max_pages: int = 5, enable_ocr: bool = True) -> TextExtractionResult:
+def extract_text_pipeline(
+    file_path: str,
+    max_pages: int = 5,
+    enable_ocr: bool = True,
+    pdf_doc: Optional[Any] = None
+) -> TextExtractionResult:
     """
     Pipeline completa di estrazione testo con fallback controllati
     
@@ -26,13 +31,15 @@ def extract_text_pipeline(file_path: str, max_pages: int = 5, enable_ocr: bool =
         file_path: Percorso del file PDF
         max_pages: Numero massimo di pagine da processare
         enable_ocr: Se True, permette fallback OCR (default: True)
+        pdf_doc: fitz.Document già aperto dal chiamante: PyMuPDF lo riusa
+                 invece di riaprire il file (opzionale)
         
     Returns:
         TextExtractionResult con testo estratto e valutazione
     """
     # Step 1: Prova PyMuPDF (più veloce)
     logger.debug(f"Pipeline estrazione testo: tentativo PyMuPDF per {file_path}")
-    text, metadata = extract_text_with_pymupdf(file_path, max_pages=max_pages)
+    text, metadata = extract_text_with_pymupdf(file_path, max_pages=max_pages, pdf_doc=pdf_doc)
     
     if text:
         result = evaluate_extraction_result(text, "pymupdf", metadata)
@@ -85,7 +92,10 @@ def extract_text_pipeline(file_path: str, max_pages: int = 5, enable_ocr: bool =
 def extract_text_for_rule_detection(file_path: str) -> str:
     """
     Estrae testo ottimizzato per rule detection
-    Usa la pipeline completa ma ritorna solo il testo (compatibilità legacy)
+    
+    Per il matching delle regole basta il testo grezzo: quello di PyMuPDF viene
+    usato anche se non supera le soglie di affidabilità del grounding. La pipeline
+    completa (pdfplumber) serve solo se PyMuPDF non estrae nulla o fallisce.
     
     Args:
         file_path: Percorso del file PDF
@@ -93,6 +103,10 @@ def extract_text_for_rule_detection(file_path: str) -> str:
     Returns:
         Testo estratto (stringa vuota se fallito)
     """
+    text, _ = extract_text_with_pymupdf(file_path, max_pages=5)
+    if text:
+        return text
+    
     result = extract_text_pipeline(file_path, max_pages=5, enable_ocr=False)  # OCR non necessario per rule detection
     return result.text if result else ""
 
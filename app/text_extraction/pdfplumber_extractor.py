@@ -5,6 +5,14 @@ Mantenuto per rule detection e parsing mirato di tabelle/strutture complesse
 import logging
 from typing import Optional, Tuple
 
+# pdfplumber è opzionale: disponibilità risolta una sola volta all'import
+try:
+    import pdfplumber
+    _HAS_PDFPLUMBER = True
+except ImportError:
+    pdfplumber = None
+    _HAS_PDFPLUMBER = False
+
 logger = logging.getLogger(__name__)
 
 
@@ -21,9 +29,11 @@ def extract_text_with_pdfplumber(file_path: str, max_pages: int = 5) -> Tuple[Op
         - testo_estratto: Testo estratto o None se fallito
         - metadati: Dict con info su estrazione
     """
+    if not _HAS_PDFPLUMBER:
+        logger.debug("pdfplumber non disponibile")
+        return None, {"method": "pdfplumber", "error": "not_installed", "success": False}
+    
     try:
-        import pdfplumber
-        
         text_parts = []
         metadata = {
             "method": "pdfplumber",
@@ -57,9 +67,6 @@ def extract_text_with_pdfplumber(file_path: str, max_pages: int = 5) -> Tuple[Op
             logger.warning(f"pdfplumber: nessun testo estratto da {file_path}")
             return None, metadata
             
-    except ImportError:
-        logger.debug("pdfplumber non disponibile")
-        return None, {"method": "pdfplumber", "error": "not_installed", "success": False}
     except Exception as e:
         logger.warning(f"Errore estrazione pdfplumber: {e}")
         return None, {"method": "pdfplumber", "error": str(e), "success": False}
@@ -5,6 +5,14 @@ import re
 from datetime import datetime
 from typing import Optional
 
+# Pattern precompilati usati a ogni estrazione
+_NON_NUMERIC_RE = re.compile(r'[^\d\.\-]')
+# Prefissi comuni che potrebbero confondere il nome dell'azienda
+_COMPANY_PREFIX_PATTERNS = (
+    re.compile(r'^(Spett\.le|Spettabile|Spett\s+\.?\s*le)\s+', re.IGNORECASE),
+    re.compile(r'^(A|Da|Per|Consegna a|Cantiere|Cliente|Destinatario|Mittente)[:\s]+', re.IGNORECASE),
+)
+
 
 def normalize_date(date_str: str) -> Optional[str]:
     """
@@ -57,7 +65,7 @@ def normalize_float(value) -> Optional[float]:
         # Rimuovi spazi e converti virgola in punto
         cleaned = value.strip().replace(',', '.').replace(' ', '').replace('kg', '').replace('Kg', '')
         # Rimuovi tutti i caratteri non numerici tranne punto e segno meno
-        cleaned = re.sub(r'[^\d\.\-]', '', cleaned)
+        cleaned = _NON_NUMERIC_RE.sub('', cleaned)
         
         try:
             return float(cleaned) if cleaned else None
@@ -87,13 +95,8 @@ def clean_company_name(name: str) -> str:
     name = normalize_text(name)
     
     # Rimuovi prefissi comuni che potrebbero confondere
-    prefixes_to_remove = [
-        r'^(Spett\.le|Spettabile|Spett\s+\.?\s*le)\s+',
-        r'^(A|Da|Per|Consegna a|Cantiere|Cliente|Destinatario|Mittente)[:\s]+',
-    ]
-    
-    for prefix in prefixes_to_remove:
-        name = re.sub(prefix, '', name, flags=re.IGNORECASE)
+    for prefix_pattern in _COMPANY_PREFIX_PATTERNS:
+        name = prefix_pattern.sub('', name)
     
     return normalize_text(name)
 
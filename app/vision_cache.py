@@ -0,0 +1,164 @@
+"""
+Cache persistente su disco delle risposte OpenAI Vision
+Evita una nuova chiamata (lenta e a pagamento) quando lo stesso PDF
+viene rielaborato con lo stesso prompt (reprocess, retry, ricaricamenti)
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from app.config import (
+    MODEL, VISION_IMAGE_FORMAT, VISION_JPEG_QUALITY, VISION_CACHE_TTL_DAYS,
+    VISION_RENDER_DPI, VISION_MAX_LONG_EDGE,
+)
+
+logger = logging.getLogger(__name__)
+
+# orjson (opzionale) legge e scrive direttamente bytes, senza codifica/decodifica intermedia
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+_CACHE_TTL_SECONDS = VISION_CACHE_TTL_DAYS * 86400
+
+# Pulizia delle voci scadute mai più rilette: al più una scansione all'ora per processo
+_SWEEP_INTERVAL_SECONDS = 3600
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+
+def make_cache_key(pdf_bytes: bytes, prompt: str, fields: list[str], grayscale: bool) -> str:
+    """
+    Calcola la chiave di cache per una chiamata Vision
+    
+    La chiave dipende dal contenuto del PDF, dal prompt, dai campi richiesti,
+    dal modello e dai parametri di rendering dell'immagine: cambiando uno
+    qualsiasi di questi elementi la risposta in cache non viene riusata.
+    
+    Args:
+        pdf_bytes: Contenuto del PDF in bytes
+        prompt: Prompt di sistema inviato al modello
+        fields: Campi richiesti al modello
+        grayscale: Immagine inviata in scala di grigi (False per le regole 'keep_color')
+        
+    Returns:
+        Digest esadecimale BLAKE2b
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(pdf_bytes)
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update("\0".join(fields).encode("utf-8"))
+    digest.update(
+        f"\0{MODEL}\0{VISION_IMAGE_FORMAT}\0{VISION_JPEG_QUALITY}\0{VISION_RENDER_DPI}"
+        f"\0{VISION_MAX_LONG_EDGE}\0{int(grayscale)}".encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+def _cache_file(key: str) -> Path:
+    from app.paths import get_vision_cache_dir
+    return get_vision_cache_dir() / f"{key}.json"
+
+
+def _sweep_expired(cache_dir: Path) -> None:
+    """
+    Elimina i file di cache scaduti (anche temp file orfani), rate-limited
+    
+    Il TTL in get_cached_response vale solo per le chiavi rilette: le risposte
+    dei PDF mai rielaborati (la maggior parte) resterebbero su disco per sempre.
+    """
+    global _last_sweep
+    now = time.time()
+    with _sweep_lock:
+        if now - _last_sweep < _SWEEP_INTERVAL_SECONDS:
+            return
+        _last_sweep = now
+    
+    removed = 0
+    try:
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and now - entry.stat().st_mtime > _CACHE_TTL_SECONDS:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+    except OSError as e:
+        logger.warning(f"Pulizia cache Vision non riuscita: {e}")
+        return
+    if removed:
+        logger.info(f"🧹 Cache Vision: rimosse {removed} voci scadute")
+
+
+def get_cached_response(key: str) -> Optional[Dict[str, Any]]:
+    """
+    Restituisce la risposta in cache per la chiave, se presente e non scaduta
+    
+    Args:
+        key: Chiave calcolata con make_cache_key
+        
+    Returns:
+        Dati grezzi restituiti dal modello, o None se non in cache
+    """
+    if _CACHE_TTL_SECONDS <= 0:
+        return None
+    
+    try:
+        cache_file = _cache_file(key)
+        if time.time() - cache_file.stat().st_mtime > _CACHE_TTL_SECONDS:
+            cache_file.unlink(missing_ok=True)
+            return None
+        data = _json_loads(cache_file.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cache Vision non leggibile ({key[:12]}): {e}")
+        return None
+    
+    if not isinstance(data, dict):
+        return None
+    
+    logger.info(f"⚡ Risposta Vision servita dalla cache ({key[:12]})")
+    return data
+
+
+def set_cached_response(key: str, data: Dict[str, Any]) -> None:
+    """
+    Salva in cache la risposta del modello (scrittura atomica: temp file + rename)
+    
+    Gli errori di scrittura vengono solo loggati: la cache non deve mai
+    far fallire un'estrazione.
+    
+    Args:
+        key: Chiave calcolata con make_cache_key
+        data: Dati grezzi restituiti dal modello
+    """
+    if _CACHE_TTL_SECONDS <= 0:
+        return
+    
+    try:
+        cache_file = _cache_file(key)
+        temp_file = cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_file, "wb") as f:
+            f.write(_json_dumps(data))
+        os.replace(temp_file, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Impossibile salvare la risposta Vision in cache ({key[:12]}): {e}")
+        return
+    _sweep_expired(cache_file.parent)